@@ -0,0 +1,73 @@
+"""
+Microbenchmark for the JSON backends in `elastic_wikidata.serialization`. Times parsing dump lines and
+serializing simplified documents for bulk indexing with each installed backend.
+
+    python benchmarks/bench_json.py --path latest-all.json.gz -n 20000
+"""
+
+import argparse
+import time
+from elastic_wikidata import serialization
+from elastic_wikidata.wd_entities import simplify_wbgetentities_result
+from fixtures import load_dump_lines
+
+
+def best_of(func, items: list, repeat: int) -> float:
+    """
+    Best time of `repeat` runs calling `func` on each of `items`. Results are discarded as they would be
+    in a load, so that the timings aren't dominated by garbage collection of the parsed entities.
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--path", help="sample of a Wikidata JSON dump (optional)")
+    parser.add_argument("-n", type=int, default=5000, help="number of entities")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    lines = load_dump_lines(args.n, args.path)
+    mb = sum(len(line) for line in lines) / 1e6
+    docs = [
+        simplify_wbgetentities_result(
+            serialization.loads_line(line), "en", ["P31", "P569", "P570"]
+        )
+        for line in lines
+    ]
+
+    print(f"{len(lines)} entities, {mb:.1f} MB")
+    print(f"{'backend':<10}{'parse (ent/s)':>16}{'MB/s':>10}{'serialize (doc/s)':>20}")
+
+    results = {}
+
+    for name in serialization.BACKENDS:
+        serialization.set_backend(name)
+        parse = best_of(serialization.loads_line, lines, args.repeat)
+        serialize = best_of(serialization.dumps, docs, args.repeat)
+        results[name] = (parse, serialize)
+
+        print(
+            f"{name:<10}{len(lines) / parse:>16,.0f}{mb / parse:>10.1f}{len(docs) / serialize:>20,.0f}"
+        )
+
+    json_parse, json_serialize = results["json"]
+
+    for name, (parse, serialize) in results.items():
+        if name != "json":
+            print(
+                f"{name}: parsing {json_parse / parse:.1f}x, serializing {json_serialize / serialize:.1f}x faster than json"
+            )
+
+
+if __name__ == "__main__":
+    main()
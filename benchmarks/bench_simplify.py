@@ -0,0 +1,139 @@
+"""
+Microbenchmark for simplifying entities. Compares `wd_entities.EntitySimplifier`, per entity and in
+batches, with the implementation of `simplify_wbgetentities_result` it replaced, after checking that
+they produce the same documents.
+
+    python benchmarks/bench_simplify.py --path latest-all.json.gz -n 20000 --properties P31 P279 P569
+"""
+
+import argparse
+import gc
+import time
+from elastic_wikidata import serialization
+from elastic_wikidata.wd_entities import EntitySimplifier
+from fixtures import load_dump_lines
+
+
+def legacy_simplify(doc: dict, lang: str, properties: list) -> dict:
+    """
+    `simplify_wbgetentities_result` before `EntitySimplifier`, kept as the baseline. Snaks without a value
+    are skipped rather than printing a warning, so that printing doesn't dominate the timings.
+    """
+
+    wd_type_mapping = {
+        "wikibase-entityid": "id",
+        "time": "time",
+        "monolingualtext": "text",
+        "quantity": "amount",
+    }
+
+    if "redirects" in doc:
+        newdoc = {"id": doc["redirects"]["from"]}
+    else:
+        newdoc = {"id": doc["id"]}
+
+    for key in ("lastrevid", "modified"):
+        if key in doc:
+            newdoc[key] = doc[key]
+
+    if lang in doc.get("labels", {}):
+        newdoc["labels"] = doc["labels"][lang]["value"]
+
+    if lang in doc.get("descriptions", {}):
+        newdoc["descriptions"] = doc["descriptions"][lang]["value"]
+
+    if (len(doc.get("aliases", {})) > 0) and (lang in doc.get("aliases", {})):
+        newdoc["aliases"] = [i["value"] for i in doc["aliases"][lang]]
+    else:
+        newdoc["aliases"] = []
+
+    newdoc["claims"] = {}
+
+    if "claims" in doc:
+        for p in properties:
+            if p in doc["claims"]:
+                claims = []
+                for i in doc["claims"][p]:
+                    try:
+                        value_type = i["mainsnak"]["datavalue"]["type"]
+                        if value_type in wd_type_mapping.keys():
+                            value_name = wd_type_mapping[value_type]
+                            claims.append(
+                                i["mainsnak"]["datavalue"]["value"][value_name]
+                            )
+                        else:
+                            claims.append(i["mainsnak"]["datavalue"]["value"])
+                    except KeyError:
+                        pass
+
+                newdoc["claims"][p] = claims
+
+    return newdoc
+
+
+def best_of(func, repeat: int) -> float:
+    """
+    Best time of `repeat` runs of `func`. The garbage collector is paused while timing, as collections
+    traverse every parsed entity and would otherwise dominate the timings.
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--path", help="sample of a Wikidata JSON dump (optional)")
+    parser.add_argument("-n", type=int, default=5000, help="number of entities")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--lang", default="en")
+    parser.add_argument("--properties", nargs="+", default=["P31", "P569", "P570"])
+    args = parser.parse_args()
+
+    entities = [
+        serialization.loads_line(line) for line in load_dump_lines(args.n, args.path)
+    ]
+    simplifier = EntitySimplifier(args.lang, args.properties)
+
+    expected = [legacy_simplify(e, args.lang, args.properties) for e in entities]
+    assert simplifier.simplify_batch(entities) == expected
+    assert [simplifier.simplify(e) for e in entities] == expected
+
+    timings = {
+        "legacy": best_of(
+            lambda: [legacy_simplify(e, args.lang, args.properties) for e in entities],
+            args.repeat,
+        ),
+        "simplify": best_of(
+            lambda: [simplifier.simplify(e) for e in entities], args.repeat
+        ),
+        "simplify_batch": best_of(
+            lambda: simplifier.simplify_batch(entities), args.repeat
+        ),
+    }
+
+    print(f"{len(entities)} entities, properties {' '.join(args.properties)}")
+    print(f"{'implementation':<16}{'ent/s':>12}{'us/ent':>10}")
+
+    for name, seconds in timings.items():
+        print(
+            f"{name:<16}{len(entities) / seconds:>12,.0f}{seconds / len(entities) * 1e6:>10.2f}"
+        )
+
+    for name in ("simplify", "simplify_batch"):
+        print(f"{name}: {timings['legacy'] / timings[name]:.2f}x faster than legacy")
+
+
+if __name__ == "__main__":
+    main()
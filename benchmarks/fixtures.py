@@ -0,0 +1,144 @@
+"""
+Entity fixtures for the benchmarks. Entities are either read from a sample of a real Wikidata dump,
+or generated with the same structure as the entities in the official JSON dumps.
+"""
+
+import json
+import random
+from itertools import islice
+from elastic_wikidata.dump_reader import open_dump, iter_dump_lines
+
+LANGUAGES = ["en", "fr", "de", "es", "it", "nl", "pl", "ru", "ja", "zh", "ar", "pt"]
+
+
+def _snak(pid: str, rng: random.Random) -> dict:
+    kind = rng.random()
+
+    if kind < 0.6:
+        qid = f"Q{rng.randint(1, 100_000_000)}"
+        datavalue = {
+            "value": {"entity-type": "item", "numeric-id": int(qid[1:]), "id": qid},
+            "type": "wikibase-entityid",
+        }
+        datatype = "wikibase-item"
+    elif kind < 0.75:
+        datavalue = {
+            "value": {
+                "time": f"+{rng.randint(1000, 2020)}-01-01T00:00:00Z",
+                "timezone": 0,
+                "before": 0,
+                "after": 0,
+                "precision": 9,
+                "calendarmodel": "http://www.wikidata.org/entity/Q1985727",
+            },
+            "type": "time",
+        }
+        datatype = "time"
+    elif kind < 0.85:
+        datavalue = {
+            "value": {"amount": f"+{rng.randint(1, 10_000)}", "unit": "1"},
+            "type": "quantity",
+        }
+        datatype = "quantity"
+    else:
+        datavalue = {"value": f"id-{rng.randint(1, 10**9)}", "type": "string"}
+        datatype = "external-id"
+
+    return {
+        "snaktype": "value",
+        "property": pid,
+        "hash": "%040x" % rng.getrandbits(160),
+        "datavalue": datavalue,
+        "datatype": datatype,
+    }
+
+
+def _statement(pid: str, rng: random.Random) -> dict:
+    statement = {
+        "mainsnak": _snak(pid, rng),
+        "type": "statement",
+        "id": "Q1$%08x-0000-0000-0000-%012x"
+        % (rng.getrandbits(32), rng.getrandbits(48)),
+        "rank": rng.choice(["normal"] * 8 + ["preferred", "deprecated"]),
+    }
+
+    if rng.random() < 0.3:
+        statement["qualifiers"] = {"P580": [_snak("P580", rng)]}
+        statement["qualifiers-order"] = ["P580"]
+
+    statement["references"] = [
+        {
+            "hash": "%040x" % rng.getrandbits(160),
+            "snaks": {"P248": [_snak("P248", rng)]},
+            "snaks-order": ["P248"],
+        }
+        for _ in range(rng.randint(0, 2))
+    ]
+
+    return statement
+
+
+def generate_entity(qid: str, rng: random.Random = None) -> dict:
+    """
+    Generates an item with labels, descriptions, aliases, sitelinks and claims shaped like those of
+    an entity in the Wikidata JSON dump.
+    """
+
+    rng = rng or random.Random(qid)
+    languages = rng.sample(LANGUAGES, rng.randint(1, len(LANGUAGES)))
+    pids = ["P31"] + [f"P{rng.randint(17, 3000)}" for _ in range(rng.randint(2, 30))]
+
+    return {
+        "type": "item",
+        "id": qid,
+        "labels": {
+            lang: {"language": lang, "value": f"label {qid} {lang}"}
+            for lang in languages
+        },
+        "descriptions": {
+            lang: {"language": lang, "value": f"description of {qid} in {lang}"}
+            for lang in languages
+        },
+        "aliases": {
+            lang: [{"language": lang, "value": f"alias {i} {qid}"} for i in range(2)]
+            for lang in languages[:3]
+        },
+        "claims": {
+            pid: [_statement(pid, rng) for _ in range(rng.randint(1, 3))]
+            for pid in pids
+        },
+        "sitelinks": {
+            f"{lang}wiki": {
+                "site": f"{lang}wiki",
+                "title": f"Title {qid}",
+                "badges": [],
+            }
+            for lang in languages[:4]
+        },
+        "lastrevid": rng.randint(1, 10**9),
+        "modified": "2020-07-01T00:00:00Z",
+    }
+
+
+def generate_entities(n: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+
+    return [generate_entity(f"Q{i}", rng) for i in range(1, n + 1)]
+
+
+def load_dump_lines(n: int, path: str = None, seed: int = 0) -> list:
+    """
+    Returns `n` raw dump lines: the first `n` entities in the dump at `path` if given, otherwise
+    generated entities serialized like the lines of an array-wrapped dump.
+    """
+
+    if path:
+        with open_dump(path) as f:
+            return list(islice(iter_dump_lines(f), n))
+
+    return [
+        (json.dumps(entity, ensure_ascii=False, separators=(",", ":")) + ",\n").encode(
+            "utf-8"
+        )
+        for entity in generate_entities(n, seed)
+    ]
@@ -0,0 +1,307 @@
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from elastic_wikidata import dump_to_es, serialization, sparql_helpers
+from elastic_wikidata.wd_entities import get_entities, simplify_wbgetentities_result
+from bench_simplify import best_of
+from fixtures import generate_entity, load_dump_lines
+
+# the stand-ins for Wikidata, the Query Service and Elasticsearch live with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+from stand_ins import (  # noqa: E402
+    ElasticsearchStandIn,
+    SparqlStandIn,
+    WbgetentitiesStandIn,
+)
+
+PROPERTIES = ["P31", "P569", "P570"]
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+class Fixture:
+    def __init__(self, n: int, path: str = None):
+        """
+        Entities shared by the stages: raw dump lines, sampled from a dump at `path` or generated, and their
+        parsed versions and QIDs.
+        """
+
+        self.lines = load_dump_lines(n, path)
+        self.entities = [serialization.loads_line(line) for line in self.lines]
+        self.qids = [entity["id"] for entity in self.entities]
+        self._by_qid = dict(zip(self.qids, self.entities))
+
+    def get_entity(self, qid: str) -> dict:
+        return self._by_qid.get(qid) or generate_entity(qid)
+
+
+class FixtureWbgetentitiesStandIn(WbgetentitiesStandIn):
+    """
+    wbgetentities stand-in answering with the fixture's entities rather than minimal ones.
+    """
+
+    def __init__(self, fixture: Fixture):
+        super().__init__()
+        self.fixture = fixture
+
+    def get_entity(self, qid: str) -> dict:
+        return self.fixture.get_entity(qid)
+
+
+@contextmanager
+def parse_stage(fixture: Fixture):
+    loads_line = serialization.loads_line
+
+    def run() -> int:
+        for line in fixture.lines:
+            loads_line(line)
+        return len(fixture.lines)
+
+    yield run
+
+
+@contextmanager
+def simplify_stage(fixture: Fixture):
+    def run() -> int:
+        return len(simplify_wbgetentities_result(fixture.entities, "en", PROPERTIES))
+
+    yield run
+
+
+@contextmanager
+def fetch_stage(fixture: Fixture, workers: int = 4):
+    with FixtureWbgetentitiesStandIn(fixture) as wikidata:
+
+        class local_entities(get_entities):
+            def __init__(self):
+                super().__init__()
+                self.endpoint = wikidata.endpoint
+
+        def run() -> int:
+            pages = local_entities.result_generator(
+                fixture.qids, page_limit=50, workers=workers
+            )
+            return sum(len(page) for page in pages)
+
+        yield run
+
+
+@contextmanager
+def sparql_stage(fixture: Fixture, page_size: int = 1000):
+    query = "SELECT ?item WHERE { ?item wdt:P31 wd:Q5 } ORDER BY ?item"
+
+    with SparqlStandIn(fixture.qids) as sparql:
+
+        def run() -> int:
+            count = 0
+            for paginated_query in sparql_helpers.paginate_sparql_query(
+                query, page_size
+            ):
+                bindings = sparql_helpers.run_query(paginated_query, sparql.endpoint)[
+                    "results"
+                ]["bindings"]
+                if not bindings:
+                    return count
+                count += len(bindings)
+
+        yield run
+
+
+@contextmanager
+def sparql_keyset_stage(fixture: Fixture, page_size: int = 1000):
+    query = "SELECT ?item WHERE { ?item wdt:P31 wd:Q5 }"
+
+    with SparqlStandIn(fixture.qids) as sparql:
+
+        def run() -> int:
+            return sum(
+                len(bindings)
+                for _, bindings in sparql_helpers.paginate_sparql_query_keyset(
+                    query, page_size, endpoint_url=sparql.endpoint
+                )
+            )
+
+        yield run
+
+
+@contextmanager
+def bulk_stage(fixture: Fixture):
+    with tempfile.TemporaryDirectory() as tmp_dir, ElasticsearchStandIn() as es:
+        path = os.path.join(tmp_dir, "dump.ndjson")
+        with open(path, "wb") as f:
+            f.writelines(fixture.lines)
+
+        def run() -> int:
+            d = dump_to_es.processDump(
+                dump=path,
+                es_credentials={
+                    "ELASTICSEARCH_CLUSTER": es.url,
+                    "ELASTICSEARCH_USER": "user",
+                    "ELASTICSEARCH_PASSWORD": "password",
+                },
+                index_name="bench",
+                disable_refresh_on_index=False,
+                properties=PROPERTIES,
+            )
+            d.start_elasticsearch()
+            ok, _ = d.dump_to_es()
+            return ok
+
+        yield run
+
+
+STAGES = {
+    "parse": parse_stage,
+    "simplify": simplify_stage,
+    "fetch": fetch_stage,
+    "sparql": sparql_stage,
+    "sparql_keyset": sparql_keyset_stage,
+    "bulk": bulk_stage,
+}
+
+
+def run_stage(stage, fixture: Fixture, repeat: int) -> dict:
+    """
+    Returns {'entities', 'entities_per_sec', 'peak_mb'} for a stage. Anything the stage prints is discarded.
+    """
+
+    with stage(fixture) as run, redirect_stdout(io.StringIO()):
+        counts = []
+        seconds = best_of(lambda: counts.append(run()), repeat)
+
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "entities": counts[-1],
+        "entities_per_sec": counts[-1] / seconds,
+        "peak_mb": peak / 1e6,
+    }
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "json_backend": serialization.get_backend(),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Prints each stage's results next to the baseline, and returns the stages that regressed.
+    """
+
+    regressions = []
+
+    print(
+        f"{'stage':<15}{'entities':>10}{'ent/s':>12}{'peak MB':>10}{'baseline ent/s':>16}{'change':>9}"
+    )
+
+    for name, result in results.items():
+        base = baseline.get("stages", {}).get(name)
+        change = ""
+        base_rate = ""
+
+        if base:
+            ratio = result["entities_per_sec"] / base["entities_per_sec"]
+            change = f"{ratio - 1:+.0%}"
+            base_rate = f"{base['entities_per_sec']:,.0f}"
+
+            if ratio < 1 - tolerance or result["peak_mb"] > base["peak_mb"] * (
+                1 + tolerance
+            ):
+                regressions.append(name)
+                change += " !"
+
+        print(
+            f"{name:<15}{result['entities']:>10}{result['entities_per_sec']:>12,.0f}{result['peak_mb']:>10.1f}{base_rate:>16}{change:>9}"
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="sample of a Wikidata JSON dump (optional)")
+    parser.add_argument("-n", type=int, default=2000, help="number of entities")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs to take the best time of"
+    )
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=None)
+    parser.add_argument(
+        "--baseline",
+        default=DEFAULT_BASELINE,
+        help="baseline to compare with, by default the one in the repository",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save the results as the baseline"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="exit with an error if a stage regressed against the baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction slower, or more memory, than the baseline that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    fixture = Fixture(args.n, args.path)
+    stages = args.stages or list(STAGES)
+    results = {name: run_stage(STAGES[name], fixture, args.repeat) for name in stages}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+        if baseline.get("environment") != environment():
+            print(
+                f"WARNING: the baseline was recorded in a different environment: {baseline.get('environment')}"
+            )
+
+        # throughput depends on the number of entities, so results for other fixtures can't be compared
+        if baseline.get("n") != args.n or baseline.get("path") != args.path:
+            print(
+                f"WARNING: the baseline was recorded with different fixtures (-n {baseline.get('n')}, --path {baseline.get('path')}), so isn't compared"
+            )
+            baseline = {}
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        stages_to_save = dict(baseline.get("stages", {}), **results)
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "n": args.n,
+                    "path": args.path,
+                    "stages": stages_to_save,
+                },
+                f,
+                indent=2,
+            )
+        print(f"Saved baseline to {args.baseline}")
+
+    if regressions:
+        print(f"Regressed: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
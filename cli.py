@@ -1,8 +1,21 @@
-from elastic_wikidata import dump_to_es, sparql_to_es
+from elastic_wikidata import (
+    dump_to_es,
+    dump_split,
+    label_index as label_index_file,
+    metrics,
+    sinks,
+    sparql_to_es,
+    stream,
+)
+from elastic_wikidata.checkpoint import Checkpoint
 from elastic_wikidata.config import runtime_config
+from elastic_wikidata.entity_cache import EntityCache
+from elastic_wikidata.entity_filter import EntityFilter
 import os
+import hashlib
 import click
 from configparser import ConfigParser
+from contextlib import ExitStack
 
 
 @click.command()
@@ -31,15 +44,28 @@ from configparser import ConfigParser
 @click.option(
     "--index",
     "-i",
-    prompt="Elasticsearch index",
-    help="Name of Elasticsearch index to load into",
+    help="Name of Elasticsearch index to load into. Prompted for if not given.",
 )
 @click.option(
     "--limit", "-l", type=int, help="(optional) Limit the number of entities loaded in"
 )
 @click.option("--page_size", type=int, help="Page size for SPARQL query.", default=100)
 @click.option(
-    "--language", "-lang", type=str, help="Language (Wikimedia language code)"
+    "--slices",
+    type=int,
+    help="(query only) Split the SPARQL query into this many QID ranges, which are fetched at the same time. Only returns items (QIDs). Defaults to 1.",
+    default=1,
+)
+@click.option(
+    "--language",
+    "-lang",
+    type=str,
+    help="Language (Wikimedia language code), a whitespace-separated list of languages e.g. 'en fr de', or 'all'. With more than one language, labels, descriptions and aliases are indexed per language.",
+)
+@click.option(
+    "--language_fallback",
+    type=str,
+    help="(optional) With several languages, languages to take a label or description from when an entity doesn't have one in the language itself, e.g. 'en'.",
 )
 @click.option(
     "--properties",
@@ -47,6 +73,41 @@ from configparser import ConfigParser
     type=str,
     help="One or more Wikidata property e.g. 'p31' or 'p31 p21'. A path to a file containing newline-separated properties can also be passed. Not case-sensitive",
 )
+@click.option(
+    "--ranks",
+    type=click.Choice(["all", "non-deprecated", "best"]),
+    help="(optional) Statements to index for each property: all of them, all but deprecated ones, or the preferred ones if there are any and otherwise the normal ones (best). Defaults to all.",
+)
+@click.option(
+    "--qualifiers",
+    type=str,
+    help="(optional) Qualifiers to index with each statement, e.g. 'p580 p582'. A path to a file containing newline-separated properties can also be passed. Implies --rich_claims.",
+)
+@click.option(
+    "--references",
+    type=str,
+    help="(optional) Properties of references to index with each statement, e.g. 'p248 p854'. A path to a file can also be passed. Implies --rich_claims.",
+)
+@click.option(
+    "--rich_claims",
+    is_flag=True,
+    help="Index each statement as an object with its value and rank (and --qualifiers and --references), rather than only its value.",
+)
+@click.option(
+    "--enrich_labels",
+    type=click.Choice(["api", "dump"]),
+    help="(optional) Add the labels of the entities that claims refer to, e.g. 'human' for Q5. 'api' fetches them from Wikidata; 'dump' (dump only) reads them from the dump in a first pass, without any requests.",
+)
+@click.option(
+    "--label_index",
+    type=click.Path(dir_okay=False),
+    help="(optional) Path to a label index to look up the labels of the entities that claims refer to. If it doesn't exist, it's built from the dump first. Implies --enrich_labels dump. For the label_index task, the path to build the index at.",
+)
+@click.option(
+    "--label_cache_size",
+    type=int,
+    help="(with --enrich_labels) Number of labels to keep in memory. Defaults to 100,000.",
+)
 @click.option(
     "--timeout",
     "-t",
@@ -60,6 +121,215 @@ from configparser import ConfigParser
     help="Whether to disable Elasticsearch's (CPU-intensive) refresh during data load. Defaults to True. Recommended to leave this on for low-resource machines or large datasets.",
     default=True,
 )
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    help="(optional) Number of processes used to parse and simplify a JSON dump. Defaults to 1.",
+    default=1,
+)
+@click.option(
+    "--fetch_workers",
+    type=int,
+    help="(optional) Number of concurrent requests to the Wikidata API when loading from a SPARQL query. Defaults to 1.",
+    default=1,
+)
+@click.option(
+    "--page_limit",
+    type=int,
+    help="(optional) Maximum number of entities in each request to the Wikidata API. Defaults to 50, the limit for most accounts; bot accounts can request 500.",
+)
+@click.option(
+    "--page_target_kb",
+    type=float,
+    help="(optional) Size Wikidata API requests so that responses are about this many kilobytes, up to --page_limit entities.",
+)
+@click.option(
+    "--page_target_seconds",
+    type=float,
+    help="(optional) Size Wikidata API requests so that responses take about this many seconds, up to --page_limit entities.",
+)
+@click.option(
+    "--chunk_size",
+    type=int,
+    help="(optional) Maximum number of documents in each bulk request to Elasticsearch. Defaults to 1000.",
+)
+@click.option(
+    "--max_chunk_mb",
+    type=float,
+    help="(optional) Maximum size of each bulk request to Elasticsearch in MB. Defaults to 100.",
+)
+@click.option(
+    "--bulk_threads",
+    type=int,
+    help="(optional) Number of bulk requests to send to Elasticsearch at once. Defaults to 1.",
+)
+@click.option(
+    "--bulk_queue_size",
+    type=int,
+    help="(optional) Number of bulk requests to hold in memory waiting for a thread, when --bulk_threads is more than 1. Defaults to 8.",
+)
+@click.option(
+    "--build",
+    is_flag=True,
+    help="Load into a new timestamped index, then point --index at it as an alias once the load is complete. Old versions are deleted.",
+)
+@click.option(
+    "--forcemerge",
+    is_flag=True,
+    help="(with --build) Force merge the new index into a single segment before moving the alias.",
+)
+@click.option(
+    "--keep_versions",
+    type=int,
+    help="(with --build) Number of versions of the index to keep, including the new one. Defaults to 2.",
+)
+@click.option(
+    "--adaptive_bulk",
+    is_flag=True,
+    help="Adjust the size of bulk requests and the number sent at once to the load on the Elasticsearch cluster, up to --chunk_size x 10 documents and --bulk_threads requests.",
+)
+@click.option(
+    "--dead_letter",
+    type=click.Path(dir_okay=False),
+    help="(optional) File to write documents which fail to index to. Load it again with `ew replay -p <file>`.",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help="(dump and query only) File to save progress to, so that an interrupted load can be resumed with --resume.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="(with --checkpoint) Carry on from the progress saved in the checkpoint file rather than starting again.",
+)
+@click.option(
+    "--cache_dir",
+    type=click.Path(file_okay=False),
+    help="(optional) Directory in which to cache responses from the Wikidata API between runs.",
+)
+@click.option(
+    "--cache_ttl",
+    type=float,
+    help="(optional) Hours after which entities in the cache are fetched again. Defaults to never.",
+)
+@click.option(
+    "--cache_max_size",
+    type=float,
+    help="(optional) Maximum size of the cache in MB. The oldest entities are removed when it grows larger.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch all entities from the Wikidata API, ignoring the cache, and update the cache with the results.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only index entities which have changed since they were last indexed, and delete entities which no longer exist.",
+)
+@click.option(
+    "--window",
+    type=float,
+    help="(stream only) Seconds over which to collect changes before updating the index. Defaults to 10.",
+    default=10,
+)
+@click.option(
+    "--stream_url",
+    type=str,
+    help="(stream only) URL of the recentchange event stream. Defaults to Wikimedia EventStreams.",
+    default=stream.RECENTCHANGE_URL,
+)
+@click.option(
+    "--filter_qids",
+    type=str,
+    help="(optional) Only load these entities. A whitespace-separated list of IDs or a path to a file containing newline-separated IDs.",
+)
+@click.option(
+    "--filter_p31",
+    type=str,
+    help="(optional) Only load entities which are an instance of (P31) one of these QIDs. A whitespace-separated list or a path to a file.",
+)
+@click.option(
+    "--filter_p279",
+    type=str,
+    help="(optional) Only load entities which are a subclass of (P279) one of these QIDs. A whitespace-separated list or a path to a file. Combined with --filter_p31, entities matching either are loaded.",
+)
+@click.option(
+    "--filter_types",
+    type=str,
+    help="(optional) Only load entities of these types: one or more of 'item', 'property', 'lexeme'.",
+)
+@click.option(
+    "--out",
+    "-o",
+    type=click.Path(file_okay=False),
+    help="(split only) Directory to write a directory of shards to for each filter spec.",
+)
+@click.option(
+    "--specs",
+    type=click.Path(exists=True, dir_okay=False),
+    help='(split only) JSON file of named filter specs, e.g. {"humans": {"claim_values": {"P31": ["Q5"]}}}.',
+)
+@click.option(
+    "--simplify",
+    is_flag=True,
+    help="(split only) Write simplified documents, using --language, --properties etc., rather than raw entities. Simplified shards can't be loaded with `ew dump`.",
+)
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    help="(dump, files and query) Write the documents to this directory instead of loading them into Elasticsearch. No Elasticsearch credentials or index are needed.",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice(["ndjson", "parquet"]),
+    help="(with --output) Format of the documents written: ndjson, or a parquet dataset with a column for each field (needs pyarrow). Defaults to ndjson.",
+    default="ndjson",
+)
+@click.option(
+    "--compress",
+    type=click.Choice(["gzip", "bz2", "zstd"]),
+    help="(split and --output) Compress the shards.",
+)
+@click.option(
+    "--shard_size",
+    type=int,
+    help="(split and --output) Entities per shard. Defaults to 1,000,000, or 10,000,000 for parquet.",
+)
+@click.option(
+    "--row_group_size",
+    type=int,
+    help="(--output_format parquet) Entities per row group, held in memory until they're written. Defaults to 100,000.",
+)
+@click.option(
+    "--metrics_port",
+    type=int,
+    help="(optional) Serve metrics of each stage of the load for Prometheus at http://127.0.0.1:<port>/metrics.",
+)
+@click.option(
+    "--metrics_log",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="(optional) File to append a JSON snapshot of the metrics of each stage to every --metrics_interval seconds, or '-' for stdout.",
+)
+@click.option(
+    "--metrics_interval",
+    type=float,
+    help="(with --metrics_log) Seconds between snapshots. Defaults to 10.",
+    default=10,
+)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False),
+    help="(optional) Profile the run and write the results to this file.",
+)
+@click.option(
+    "--profile_mode",
+    type=click.Choice(["cprofile", "sample"]),
+    help="(with --profile) 'cprofile' writes cProfile statistics of the main thread; 'sample' samples the stacks of every thread and writes them in collapsed format for flame graphs. Defaults to cprofile.",
+    default="cprofile",
+)
 def main(
     source,
     path,
@@ -71,14 +341,67 @@ def main(
     index,
     limit,
     page_size,
+    slices,
     language,
+    language_fallback,
     properties,
+    ranks,
+    qualifiers,
+    references,
+    rich_claims,
+    enrich_labels,
+    label_index,
+    label_cache_size,
     timeout,
     disable_refresh,
+    workers,
+    fetch_workers,
+    page_limit,
+    page_target_kb,
+    page_target_seconds,
+    chunk_size,
+    max_chunk_mb,
+    bulk_threads,
+    bulk_queue_size,
+    build,
+    forcemerge,
+    keep_versions,
+    adaptive_bulk,
+    dead_letter,
+    checkpoint,
+    resume,
+    cache_dir,
+    cache_ttl,
+    cache_max_size,
+    refresh,
+    incremental,
+    window,
+    stream_url,
+    filter_qids,
+    filter_p31,
+    filter_p279,
+    filter_types,
+    out,
+    specs,
+    simplify,
+    output,
+    output_format,
+    compress,
+    shard_size,
+    row_group_size,
+    metrics_port,
+    metrics_log,
+    metrics_interval,
+    profile,
+    profile_mode,
 ):
 
-    # get elasticsearch credentials
-    if config:
+    # get elasticsearch credentials, which aren't needed to split a dump, build a label index or write
+    # documents to files
+    if source in ("split", "label_index") or output:
+        es_credentials = {}
+        runtime_config.add_item({"user_agent_contact": agent_contact})
+    elif config:
         # read .ini file
         parser = ConfigParser()
         parser.optionxform = str  # make option names case sensitive
@@ -109,6 +432,25 @@ def main(
         runtime_config.add_item({"user_agent_contact": agent_contact})
 
     runtime_config.add_item({"http_timeout": timeout})
+    runtime_config.add_item(
+        {
+            "page_limit": page_limit,
+            "page_target_bytes": int(page_target_kb * 1024) if page_target_kb else None,
+            "page_target_seconds": page_target_seconds,
+        }
+    )
+
+    if cache_dir:
+        runtime_config.add_item(
+            {
+                "entity_cache": EntityCache(
+                    cache_dir,
+                    ttl=cache_ttl * 3600 if cache_ttl else None,
+                    max_size_mb=cache_max_size,
+                    refresh=refresh,
+                )
+            }
+        )
 
     # global flag for all functions that the module is being run through the CLI
     runtime_config.add_item({"cli": True})
@@ -116,24 +458,139 @@ def main(
     # set kwargs
     kwargs = {}
     if language:
-        kwargs["lang"] = language
+        languages = language.split()
+        kwargs["lang"] = languages[0] if len(languages) == 1 else languages
+    if language_fallback:
+        kwargs["language_fallback"] = language_fallback.split()
     if properties:
-        if os.path.exists(properties):
-            with open(properties, "r") as f:
-                kwargs["properties"] = f.read().splitlines()
-        else:
-            kwargs["properties"] = properties.split()
+        kwargs["properties"] = read_list_option(properties)
+    if ranks:
+        kwargs["ranks"] = ranks
+    if qualifiers:
+        kwargs["qualifiers"] = read_list_option(qualifiers)
+    if references:
+        kwargs["references"] = read_list_option(references)
+    if rich_claims:
+        kwargs["rich_claims"] = rich_claims
+    if enrich_labels:
+        kwargs["enrich_labels"] = enrich_labels
+    if label_index:
+        kwargs["label_index"] = label_index
+    if label_cache_size:
+        kwargs["label_cache_size"] = label_cache_size
 
     if disable_refresh:
         kwargs["disable_refresh_on_index"] = disable_refresh
 
-    # run job
-    if source == "dump":
-        load_from_dump(path, es_credentials, index, limit, **kwargs)
-    elif source == "query":
-        load_from_sparql(path, es_credentials, index, limit, page_size, **kwargs)
-    else:
-        raise ValueError(f"Argument {source} must be either dump or sparql")
+    if workers:
+        kwargs["workers"] = workers
+    if fetch_workers:
+        kwargs["fetch_workers"] = fetch_workers
+    if incremental:
+        kwargs["incremental"] = incremental
+    if chunk_size:
+        kwargs["chunk_size"] = chunk_size
+    if max_chunk_mb:
+        kwargs["max_chunk_bytes"] = int(max_chunk_mb * 1024 * 1024)
+    if bulk_threads:
+        kwargs["bulk_threads"] = bulk_threads
+    if bulk_queue_size:
+        kwargs["queue_size"] = bulk_queue_size
+    if build:
+        kwargs["build_new_index"] = build
+    if forcemerge:
+        kwargs["forcemerge"] = forcemerge
+    if keep_versions:
+        kwargs["keep_versions"] = keep_versions
+    if adaptive_bulk:
+        kwargs["adaptive_bulk"] = adaptive_bulk
+    if dead_letter:
+        kwargs["dead_letter_path"] = dead_letter
+    if resume and not checkpoint:
+        raise ValueError("--resume needs the --checkpoint file to resume from")
+
+    claim_values = {}
+    if filter_p31:
+        claim_values["P31"] = read_list_option(filter_p31)
+    if filter_p279:
+        claim_values["P279"] = read_list_option(filter_p279)
+
+    entity_filter = EntityFilter(
+        qids=read_list_option(filter_qids) if filter_qids else None,
+        claim_values=claim_values,
+        entity_types=filter_types.split() if filter_types else None,
+    )
+    if entity_filter:
+        kwargs["entity_filter"] = entity_filter
+
+    if output:
+        if source not in ("dump", "files", "query"):
+            raise ValueError("--output can only be used with dump, files or query")
+        kwargs["sink"] = make_sink(
+            output,
+            output_format,
+            compression=compress,
+            shard_size=shard_size,
+            row_group_size=row_group_size,
+            simplifier=dump_to_es.make_simplifier(**kwargs),
+        )
+    elif source not in ("split", "label_index") and not index:
+        index = click.prompt("Elasticsearch index")
+
+    # run job, collecting metrics and profiling if asked to
+    with ExitStack() as stack:
+        if metrics_port is not None or metrics_log:
+            stack.enter_context(
+                metrics.collect(metrics_port, metrics_log, metrics_interval)
+            )
+        if profile:
+            stack.enter_context(metrics.profile(profile, profile_mode))
+
+        if source in ("dump", "files"):
+            if checkpoint:
+                kwargs["checkpoint"] = Checkpoint(
+                    checkpoint, "dump", os.path.abspath(path), resume=resume
+                )
+            load_from_dump(
+                path, es_credentials, index, limit, files=source == "files", **kwargs
+            )
+        elif source == "query":
+            if checkpoint:
+                kwargs["checkpoint"] = Checkpoint(
+                    checkpoint,
+                    "query",
+                    query_checkpoint_key(path, slices),
+                    resume=resume,
+                )
+            load_from_sparql(
+                path, es_credentials, index, limit, page_size, slices, **kwargs
+            )
+        elif source == "stream":
+            update_from_stream(es_credentials, index, stream_url, window, **kwargs)
+        elif source == "replay":
+            replay_dead_letters(path, es_credentials, index, **kwargs)
+        elif source == "split":
+            if not (path and out and specs):
+                raise ValueError("split needs a dump (--path), --out and --specs")
+            split_dump(
+                path,
+                out,
+                dump_split.read_filter_specs(specs),
+                simplifier=dump_to_es.make_simplifier(**kwargs) if simplify else None,
+                workers=workers,
+                compression=compress,
+                shard_size=shard_size or 1_000_000,
+            )
+        elif source == "label_index":
+            if not (path and label_index):
+                raise ValueError("label_index needs a dump (--path) and --label_index")
+            build_label_index(
+                path, label_index, language.split()[0] if language else "en"
+            )
+        else:
+            raise ValueError(
+                f"Argument {source} must be either dump, files, query, stream, replay, split or label_index"
+            )
 
 
 def load_from_dump(path, es_credentials, index, limit, **kwargs):
@@ -146,33 +603,126 @@ def load_from_dump(path, es_credentials, index, limit, **kwargs):
     d = dump_to_es.processDump(
         dump=path, es_credentials=es_credentials, index_name=index, **kwargs
     )
-    d.start_elasticsearch()
+    d.start()
     d.dump_to_es()
 
 
-def load_from_sparql(path, es_credentials, index, limit, page_size=100, **kwargs):
+def load_from_sparql(
+    path, es_credentials, index, limit, page_size=100, slices=1, **kwargs
+):
     if not kwargs:
         kwargs = {}
 
     with open(path, "r") as f:
         query = f.read()
 
-    # limit is used when getting list of entities
-    print("Getting entities from SPARQL query")
-    entity_list = sparql_to_es.get_entities_from_query(
-        query, page_size=100, limit=limit
+    # limit is used when getting list of entities. QIDs are fetched from Wikidata and indexed as each
+    # page of the query arrives, rather than after the whole query has been run
+    entities = sparql_to_es.iter_entities_from_query(
+        query,
+        page_size=page_size,
+        limit=limit,
+        slices=slices,
+        checkpoint=kwargs.get("checkpoint"),
     )
 
     print(
-        f"Retrieving information from wbgetentities API and pushing to ES index {index}"
+        f"Getting entities from SPARQL query, retrieving information from wbgetentities API and pushing to ES index {index}"
     )
     d = dump_to_es.processDump(
-        dump=entity_list, es_credentials=es_credentials, index_name=index, **kwargs
+        dump=entities, es_credentials=es_credentials, index_name=index, **kwargs
     )
-    d.start_elasticsearch()
+    d.start()
     d.dump_to_es()
 
 
+def query_checkpoint_key(path, slices) -> str:
+    """
+    Identifies a query for checkpoints. Positions are tracked per slice, so a checkpoint can only be
+    resumed with the same query and number of slices.
+    """
+
+    with open(path, "rb") as f:
+        return f"{hashlib.sha1(f.read()).hexdigest()}:{slices}"
+
+
+def update_from_stream(es_credentials, index, url, window, **kwargs):
+    updates = stream.streamUpdates(
+        es_credentials=es_credentials,
+        index_name=index,
+        url=url,
+        window=window,
+        **kwargs,
+    )
+    updates.start_elasticsearch()
+
+    print(f"Updating ES index {index} from {url}. Press Ctrl+C to stop.")
+    try:
+        updates.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def replay_dead_letters(path, es_credentials, index, **kwargs):
+    d = dump_to_es.processDump(
+        dump=[], es_credentials=es_credentials, index_name=index, **kwargs
+    )
+    d.start_elasticsearch()
+    d.replay_dead_letters(path)
+
+
+def split_dump(path, out, specs, **kwargs):
+    print(f"Splitting {path} into {', '.join(specs)} in {out}")
+    dump_split.split_dump(path, out, specs, **kwargs)
+
+
+def build_label_index(path, index_path, lang):
+    print(f"Building an index of {lang} labels in {path} at {index_path}")
+    label_index_file.build_label_index(path, index_path, lang)
+
+
+def make_sink(
+    output,
+    output_format="ndjson",
+    compression=None,
+    shard_size=None,
+    row_group_size=None,
+    simplifier=None,
+):
+    """
+    Creates the `sinks.Sink` that documents are written to with --output. Parquet datasets need the
+    `simplifier` making the documents, which sets their columns.
+    """
+
+    print(f"Writing {output_format} documents to {output}")
+
+    if output_format == "parquet":
+        return sinks.ParquetSink(
+            output,
+            simplifier,
+            compression=compression,
+            row_group_size=row_group_size or 100_000,
+            shard_size=shard_size or 10_000_000,
+        )
+
+    return sinks.NDJSONSink(
+        output, compression=compression, shard_size=shard_size or 1_000_000
+    )
+
+
+def read_list_option(value: str) -> list:
+    """
+    Reads an option which is either a whitespace-separated list, or a path to a file containing
+    newline-separated values.
+    """
+
+    if os.path.exists(value):
+        with open(value, "r") as f:
+            return f.read().splitlines()
+    else:
+        return value.split()
+
+
 def check_es_credentials(credentials: dict):
     credentials_present = set(credentials.keys())
     credentials_required = {
@@ -0,0 +1,475 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+from elasticsearch.exceptions import TransportError
+from elastic_wikidata import metrics, serialization
+
+# status of a bulk request or item which the cluster rejected because it's overloaded
+REJECTED_STATUS = 429
+
+# status of a bulk request which was too large for the cluster to accept
+TOO_LARGE_STATUS = 413
+
+# status of a delete for a document which isn't in the index
+NOT_FOUND_STATUS = 404
+
+# status recorded for the actions of a bulk request which couldn't be sent, e.g. because of a connection error
+UNAVAILABLE_STATUS = 503
+
+
+class AdaptiveController:
+    def __init__(
+        self,
+        chunk_size: int = 1000,
+        max_concurrency: int = 1,
+        adaptive: bool = True,
+        min_chunk_size: int = None,
+        max_chunk_size: int = None,
+        target_latency: float = 5.0,
+    ):
+        """
+        Sets the number of documents in each bulk request and the number of bulk requests in flight,
+        using additive increase/multiplicative decrease (AIMD). While requests succeed within `target_latency`
+        the chunk size grows by a tenth of its starting value, and concurrency grows by one once as many
+        requests have succeeded as are allowed in flight. Slow requests shrink the chunk size by a quarter,
+        and rejected requests halve both the chunk size and concurrency.
+
+        Args:
+            chunk_size (int, optional): starting number of documents per request. Defaults to 1000.
+            max_concurrency (int, optional): most requests in flight at once. Defaults to 1.
+            adaptive (bool, optional): if False, always use `chunk_size` and `max_concurrency`. Defaults to True.
+            min_chunk_size (int, optional): Defaults to a tenth of `chunk_size`.
+            max_chunk_size (int, optional): Defaults to ten times `chunk_size`.
+            target_latency (float, optional): seconds above which a bulk request is considered slow. Defaults to 5.
+        """
+
+        self.adaptive = adaptive
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size or max(1, chunk_size // 10)
+        self.max_chunk_size = max_chunk_size or chunk_size * 10
+        self.max_concurrency = max_concurrency
+        self.concurrency = 1 if adaptive else max_concurrency
+        self.target_latency = target_latency
+
+        self._step = max(1, chunk_size // 10)
+        self._successes = 0
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits until fewer than `self.concurrency` requests are in flight.
+        """
+
+        with self._condition:
+            while self._active >= self.concurrency:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def record(self, latency: float, rejected: bool):
+        """
+        Adjusts chunk size and concurrency after a bulk request.
+
+        Args:
+            latency (float): seconds the request took
+            rejected (bool): whether the request, or any item in it, was rejected
+        """
+
+        if not self.adaptive:
+            return
+
+        with self._condition:
+            if rejected:
+                self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                self._successes = 0
+            elif latency > self.target_latency:
+                self.chunk_size = max(self.min_chunk_size, self.chunk_size * 3 // 4)
+                self._successes = 0
+            else:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size + self._step)
+                self._successes += 1
+
+                if self._successes >= self.concurrency:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self._successes = 0
+
+            self._condition.notify_all()
+
+
+def backoff_delay(attempt: int, initial: float, maximum: float) -> float:
+    """
+    Exponential backoff with full jitter: a random delay of up to `initial` * 2^`attempt` seconds,
+    capped at `maximum`. The jitter stops clients which were rejected together from retrying together.
+    """
+
+    return random.uniform(0, min(maximum, initial * 2**attempt))
+
+
+class DeadLetterFile:
+    def __init__(self, path: str):
+        """
+        Newline-delimited JSON file of bulk actions which failed, with one {'action', 'source', 'error'}
+        object per line. The file is appended to, and only created when the first action fails.
+        Use `read_dead_letters` to send the actions again.
+        """
+
+        self.path = path
+        self.count = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, action_line: bytes, data_line: bytes, error):
+        # the action and source are already serialized, so they're written as they are
+        record = b"".join(
+            [
+                b'{"action":',
+                action_line,
+                b',"source":',
+                data_line if data_line is not None else b"null",
+                b',"error":',
+                serialization.dumps(error).encode("utf-8"),
+                b"}\n",
+            ]
+        )
+
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.write(record)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_dead_letters(path: str) -> Iterator[tuple]:
+    """
+    Yields the (action, source) lines of each action in a dead-letter file, ready to be passed to
+    `BulkIndexer.index` with `expand_action_callback=None`.
+    """
+
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            record = serialization.loads(line)
+            source = record["source"]
+
+            yield (
+                serialization.dumps(record["action"]),
+                serialization.dumps(source) if source is not None else None,
+            )
+
+
+class BulkIndexer:
+    def __init__(
+        self,
+        client,
+        index: str,
+        chunk_size: int = 1000,
+        max_chunk_bytes: int = 100 * 1024 * 1024,
+        concurrency: int = 1,
+        queue_size: int = 8,
+        adaptive: bool = False,
+        max_retries: int = 3,
+        initial_backoff: float = 2,
+        max_backoff: float = 600,
+        dead_letter_path: str = None,
+        **kwargs,
+    ):
+        """
+        Sends actions to an index in bulk requests. Requests or items rejected because the cluster is overloaded
+        (HTTP 429, es_rejected_execution_exception), server errors and connection errors are retried up to
+        `max_retries` times with exponential backoff and jitter, and requests too large for the cluster (HTTP 413)
+        are split. Actions which still fail are written to a dead-letter file if `dead_letter_path` is set, and
+        the load carries on.
+
+        With `adaptive`, chunk size and concurrency are tuned by an `AdaptiveController` from the latency and
+        rejections of each request, within the limits set by `chunk_size` (starting point), `max_chunk_bytes`
+        and `concurrency` (maximum).
+
+        Args:
+            client (Elasticsearch)
+            index (str)
+            chunk_size (int, optional): documents per request. Defaults to 1000.
+            max_chunk_bytes (int, optional): maximum size of each request. Defaults to 100MB.
+            concurrency (int, optional): requests in flight at once. Defaults to 1.
+            queue_size (int, optional): chunks held in memory waiting to be sent. Defaults to 8.
+            adaptive (bool, optional): tune chunk size and concurrency. Defaults to False.
+            max_retries (int, optional): Defaults to 3.
+            initial_backoff (float, optional): seconds. Defaults to 2.
+            max_backoff (float, optional): seconds. Defaults to 600.
+            dead_letter_path (str, optional): file to write failed actions to. Defaults to None.
+            **kwargs: passed to `AdaptiveController`, e.g. target_latency
+        """
+
+        self.client = client
+        self.index_name = index
+        self.max_chunk_bytes = max_chunk_bytes
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.controller = AdaptiveController(
+            chunk_size, max_concurrency=concurrency, adaptive=adaptive, **kwargs
+        )
+        self.dead_letters = (
+            DeadLetterFile(dead_letter_path) if dead_letter_path else None
+        )
+        self.stats = {"requests": 0, "retries": 0, "rejected": 0, "failed": 0}
+        self._stats_lock = threading.Lock()
+
+    def index(
+        self, actions: Iterable, expand_action_callback: Callable = None
+    ) -> Iterator[tuple]:
+        """
+        Sends `actions` to the index, yielding (ok, item) for each action as its bulk request finishes, where
+        item is the action's entry in the bulk response. Chunks are yielded in the order they were sent, so at
+        most `queue_size` finished chunks wait behind a slow one.
+
+        Args:
+            actions (Iterable): actions to send
+            expand_action_callback (Callable, optional): turns each action into its (action, source) lines in
+                a bulk request. Defaults to None, meaning actions are already (action, source) lines.
+        """
+
+        max_in_flight = self.controller.max_concurrency + self.queue_size
+
+        with ThreadPoolExecutor(
+            max_workers=self.controller.max_concurrency, thread_name_prefix="bulk"
+        ) as executor:
+            in_flight = deque()
+
+            try:
+                for chunk in self._chunks(actions, expand_action_callback):
+                    in_flight.append(executor.submit(self._send_chunk, chunk))
+
+                    while len(in_flight) >= max_in_flight:
+                        yield from in_flight.popleft().result()
+
+                    metrics.current().set(
+                        "queue_depth", len(in_flight), queue="bulk_chunks"
+                    )
+
+                while in_flight:
+                    yield from in_flight.popleft().result()
+            finally:
+                for future in in_flight:
+                    future.cancel()
+                if self.dead_letters is not None:
+                    self.dead_letters.close()
+
+    def _chunks(self, actions: Iterable, expand_action_callback: Callable):
+        """
+        Groups actions into lists of (action, source) lines encoded as bytes, starting a new list when the
+        controller's current chunk size or `self.max_chunk_bytes` is reached.
+        """
+
+        chunk, size = [], 0
+
+        for action in actions:
+            if expand_action_callback is not None:
+                action = expand_action_callback(action)
+
+            action_line, data_line = (
+                line.encode("utf-8") if isinstance(line, str) else line
+                for line in action
+            )
+            line_size = len(action_line) + 1
+            if data_line is not None:
+                line_size += len(data_line) + 1
+
+            if chunk and (
+                len(chunk) >= self.controller.chunk_size
+                or size + line_size > self.max_chunk_bytes
+            ):
+                yield chunk
+                chunk, size = [], 0
+
+            chunk.append((action_line, data_line))
+            size += line_size
+
+        if chunk:
+            yield chunk
+
+    def _send_chunk(self, chunk: list) -> list:
+        """
+        Sends a chunk (see `_send`), and records the actions which succeeded and failed. Returns (ok, item)
+        for each action.
+        """
+
+        results = self._send(chunk)
+
+        succeeded = sum(ok for ok, _ in results)
+        recorder = metrics.current()
+        recorder.inc("entities_total", succeeded, stage="index")
+        recorder.inc("failed_total", len(results) - succeeded, stage="index")
+
+        return results
+
+    def _send(self, chunk: list) -> list:
+        """
+        Sends a chunk. Requests and items rejected by an overloaded cluster (429), requests that fail with a
+        server error (5xx) and connection errors are retried with backoff. Requests too large for the cluster
+        (413) are split in half, and later chunks are kept below the size that was too large. Actions in
+        requests which still fail are failed items, written to the dead-letter file, rather than an error
+        which would stop the load. Returns (ok, item) for each action.
+        """
+
+        results = []
+        attempt = 0
+        recorder = metrics.current()
+
+        while chunk:
+            body = b"\n".join(
+                line for pair in chunk for line in pair if line is not None
+            )
+
+            self.controller.acquire()
+            start = time.monotonic()
+            try:
+                response = self.client.bulk(body=body + b"\n", index=self.index_name)
+                status = None
+            except TransportError as e:
+                response = None
+                # connection errors and timeouts have no HTTP status
+                status = e.status_code if isinstance(e.status_code, int) else None
+                error = {"status": e.status_code, "error": e.error}
+            finally:
+                self.controller.release()
+
+            latency = time.monotonic() - start
+            self._count("requests")
+            recorder.observe("stage_seconds", latency, stage="index")
+            recorder.inc("bytes_out_total", len(body) + 1, sink="elasticsearch")
+
+            if response is None and status == TOO_LARGE_STATUS and len(chunk) > 1:
+                self.controller.record(latency, rejected=True)
+                with self._stats_lock:
+                    self.max_chunk_bytes = max(
+                        1, min(self.max_chunk_bytes, len(body)) // 2
+                    )
+                self._count("retries")
+                recorder.inc(
+                    "retries_total", service="elasticsearch", reason=str(status)
+                )
+
+                half = len(chunk) // 2
+                return results + self._send(chunk[:half]) + self._send(chunk[half:])
+
+            if response is None:
+                items = [
+                    _failed_item(pair[0], status or UNAVAILABLE_STATUS, error)
+                    for pair in chunk
+                ]
+                if _retryable(status):
+                    retry = chunk
+                    reason = str(status) if status else "connection"
+                else:
+                    retry = []
+                    for pair, item in zip(chunk, items):
+                        results.append((self._ok(pair, item), item))
+            else:
+                retry, items = [], []
+                reason = str(REJECTED_STATUS)
+                for pair, item in zip(chunk, response["items"]):
+                    if _status(item) == REJECTED_STATUS:
+                        retry.append(pair)
+                        items.append(item)
+                    else:
+                        results.append((self._ok(pair, item), item))
+
+            self.controller.record(latency, rejected=bool(retry))
+
+            if not retry:
+                break
+
+            self._count("rejected", len(retry))
+
+            if attempt >= self.max_retries:
+                for pair, item in zip(retry, items):
+                    results.append((self._ok(pair, item), item))
+                break
+
+            time.sleep(backoff_delay(attempt, self.initial_backoff, self.max_backoff))
+            self._count("retries")
+            recorder.inc("retries_total", service="elasticsearch", reason=reason)
+            chunk = retry
+            attempt += 1
+
+        return results
+
+    def _ok(self, pair: tuple, item: dict) -> bool:
+        """
+        Returns whether an action succeeded, writing it to the dead-letter file if it didn't. Deleting a
+        document which isn't in the index succeeds, as incremental loads and streams delete entities which
+        may never have been indexed.
+        """
+
+        if 200 <= _status(item) < 300 or _not_found_delete(item):
+            return True
+
+        self._count("failed")
+        if self.dead_letters is not None:
+            self.dead_letters.write(pair[0], pair[1], item)
+
+        return False
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+
+def _failed_item(action_line: bytes, status: int, error: dict) -> dict:
+    """
+    Returns an item in the format of a bulk response for an action whose whole request failed.
+    """
+
+    op_type, meta = next(iter(serialization.loads(action_line).items()))
+
+    return {op_type: dict(meta, status=status, error=error)}
+
+
+def _retryable(status: int) -> bool:
+    """
+    Returns whether a bulk request which failed with `status` (None for connection errors) is worth
+    sending again.
+    """
+
+    return status is None or status == REJECTED_STATUS or status >= 500
+
+
+def _status(item: dict) -> int:
+    """
+    Returns the status of an item in a bulk response, which is keyed by its operation type.
+    """
+
+    return next(iter(item.values())).get("status", 500)
+
+
+def _not_found_delete(item: dict) -> bool:
+    """
+    Returns whether an item in a bulk response is a delete of a document which wasn't in the index, rather
+    than one whose request failed.
+    """
+
+    meta = item.get("delete")
+
+    return (
+        meta is not None
+        and meta.get("status") == NOT_FOUND_STATUS
+        and "error" not in meta
+    )
@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from elastic_wikidata import serialization
+
+
+class WatermarkTracker:
+    def __init__(self, watermarks: dict = None):
+        """
+        Tracks the position in the source (e.g. a byte offset in a dump) of each action sent to Elasticsearch,
+        keyed by document `_id`. The watermark of a lane is the position of the latest action for which it and
+        every earlier action in the same lane have been acknowledged, so everything up to the watermark can be
+        skipped when a load is resumed. Lanes are independent sources read in order, such as the slices of a
+        SPARQL query.
+
+        Args:
+            watermarks (dict, optional): {lane: position} to start from. Defaults to None.
+        """
+
+        self.watermarks = dict(watermarks or {})
+        self._pending = {}
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def add(self, _id: str, position, lane: str = "default"):
+        """
+        Records an action at `position` in `lane`. Actions must be added in the order of their positions
+        within each lane.
+        """
+
+        with self._lock:
+            pending = self._pending.setdefault(lane, OrderedDict())
+            # the same ID can be in several lanes, e.g. shards of overlapping `ew split` specs, and each
+            # action for it is acknowledged separately, in the order they were added
+            lanes = self._lanes.setdefault(_id, deque())
+            if pending.pop(_id, None) is not None:
+                lanes.remove(lane)
+            pending[_id] = [position, False]
+            lanes.append(lane)
+
+    def ack(self, _id: str):
+        """
+        Marks the action for `_id` as acknowledged, moving the watermark of its lane forward if all the
+        earlier actions have been acknowledged too. If `_id` is pending in several lanes, the earliest added
+        is acknowledged. Unknown IDs are ignored.
+        """
+
+        with self._lock:
+            lanes = self._lanes.get(_id)
+            if not lanes:
+                return
+
+            lane = lanes.popleft()
+            if not lanes:
+                del self._lanes[_id]
+
+            pending = self._pending[lane]
+            pending[_id][1] = True
+
+            while pending:
+                first = next(iter(pending))
+                position, acked = pending[first]
+                if not acked:
+                    break
+                self.watermarks[lane] = position
+                pending.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(lanes) for lanes in self._lanes.values())
+
+
+class Checkpoint:
+    def __init__(
+        self, path: str, source: str, key: str, resume: bool = False, interval=30
+    ):
+        """
+        State file for resuming a load. Positions are tracked by a `WatermarkTracker`, and only move forward
+        when Elasticsearch has acknowledged the actions up to them, so a resumed load doesn't miss anything
+        and only repeats the actions that were in flight.
+
+        Args:
+            path (str): path to the state file
+            source (str): type of source, e.g. 'dump' or 'query'
+            key (str): identifies the source, e.g. the path to a dump. Resuming from a checkpoint saved for a
+                different source raises a ValueError.
+            resume (bool, optional): start from the watermarks in the state file if it exists. Defaults to False.
+            interval (int, optional): seconds between saves. Defaults to 30.
+        """
+
+        self.path = path
+        self.source = source
+        self.key = key
+        self.interval = interval
+        self._last_saved = time.monotonic()
+
+        # the versioned index being built, when building a new index, so a resumed load carries on with it
+        self.index = None
+
+        watermarks = {}
+
+        if resume and os.path.exists(path):
+            with open(path, "rb") as f:
+                state = serialization.loads(f.read())
+
+            if state.get("source") != source or state.get("key") != key:
+                raise ValueError(
+                    f"Checkpoint {path} was saved for {state.get('source')} {state.get('key')}, not {source} {key}"
+                )
+            watermarks = state.get("watermarks", {})
+            self.index = state.get("index")
+
+        self.tracker = WatermarkTracker(watermarks)
+
+    @property
+    def watermarks(self) -> dict:
+        return self.tracker.watermarks
+
+    def add(self, _id: str, position, lane: str = "default"):
+        self.tracker.add(_id, position, lane)
+
+    def ack(self, _id: str):
+        """
+        Acknowledges the action for `_id`, saving the state file if it hasn't been saved for `self.interval`
+        seconds.
+        """
+
+        self.tracker.ack(_id)
+
+        if time.monotonic() - self._last_saved >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Writes the state file. It's written to a temporary file and then renamed, so a crash while saving
+        leaves the previous checkpoint in place.
+        """
+
+        state = {
+            "source": self.source,
+            "key": self.key,
+            "watermarks": dict(self.tracker.watermarks),
+            "index": self.index,
+            "saved_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(serialization.dumps(state))
+        os.replace(tmp_path, self.path)
+
+        self._last_saved = time.monotonic()
@@ -0,0 +1,270 @@
+import bz2
+import gzip
+import io
+import os
+import shutil
+import subprocess
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List
+from elastic_wikidata import serialization
+
+# magic bytes at the start of each supported compression format
+COMPRESSION_MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+# command line decompressors in order of preference. The parallel ones (pigz, lbzip2, pbzip2)
+# decode blocks on multiple cores and are much faster than the standard library on large dumps.
+EXTERNAL_DECOMPRESSORS = {
+    "gzip": [["pigz", "-dc"], ["gzip", "-dc"]],
+    "bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]],
+    "zstd": [["zstd", "-dcq"]],
+}
+
+
+def detect_compression(path: str) -> str:
+    """
+    Detects the compression format of a file from its first few bytes.
+
+    Returns:
+        str: one of 'gzip', 'bz2', 'zstd', or None if the file is not compressed
+    """
+
+    with open(path, "rb") as f:
+        head = f.read(4)
+
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+
+    return None
+
+
+def find_external_decompressor(compression: str) -> list:
+    """
+    Returns the command for the first available command line decompressor for `compression`,
+    or None if none are installed.
+    """
+
+    for command in EXTERNAL_DECOMPRESSORS.get(compression, []):
+        if shutil.which(command[0]):
+            return command
+
+    return None
+
+
+@contextmanager
+def open_dump(
+    path: str, use_external_decompressor: bool = True, offset: int = 0
+) -> BinaryIO:
+    """
+    Opens a (possibly compressed) Wikidata JSON dump for streaming in binary mode. gzip, bz2 and zstd
+    are supported and detected from the contents of the file rather than its extension.
+
+    Args:
+        path (str): path to the dump
+        use_external_decompressor (bool, optional): pipe the file through a command line decompressor
+            such as pigz or lbzip2 if one is installed. Defaults to True.
+        offset (int, optional): position in the decompressed dump to start reading from. Uncompressed dumps
+            are seeked to it directly; compressed dumps are decompressed up to it without being parsed.
+            Defaults to 0.
+
+    Yields:
+        BinaryIO: decompressed stream
+    """
+
+    compression = detect_compression(path)
+
+    if compression is None:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            yield f
+        return
+
+    with _open_compressed(path, compression, use_external_decompressor) as f:
+        _skip_bytes(f, offset)
+        yield f
+
+
+@contextmanager
+def _open_compressed(
+    path: str, compression: str, use_external_decompressor: bool
+) -> BinaryIO:
+    """
+    Opens a compressed dump, through a command line decompressor if one is installed and allowed.
+    """
+
+    command = (
+        find_external_decompressor(compression) if use_external_decompressor else None
+    )
+
+    if command is not None:
+        with _open_subprocess(command + [path]) as f:
+            yield f
+        return
+
+    if compression == "gzip":
+        with gzip.open(path, "rb") as f:
+            yield f
+    elif compression == "bz2":
+        # bz2.open handles the multi-stream files produced by parallel compressors
+        with bz2.open(path, "rb") as f:
+            yield f
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "Reading zstd dumps needs either the zstd command line tool or the zstandard package (pip install zstandard)"
+            )
+
+        with open(path, "rb") as fh:
+            reader = zstandard.ZstdDecompressor().stream_reader(fh)
+            with io.BufferedReader(reader, buffer_size=1 << 20) as f:
+                yield f
+
+
+@contextmanager
+def _open_subprocess(command: list) -> BinaryIO:
+    """
+    Runs `command` and yields its stdout. The process is stopped if the caller finishes before the
+    output has been read in full. If the output was read to the end, the process is waited for and an
+    error is raised if it failed, e.g. on a truncated or corrupt file.
+    """
+
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1 << 20
+    )
+    reached_eof = False
+
+    try:
+        yield process.stdout
+        # the caller may have finished without reading to the end
+        reached_eof = not process.stdout.peek(1)
+    finally:
+        if not reached_eof:
+            process.terminate()
+
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        process.wait()
+
+    if reached_eof and process.returncode != 0:
+        raise IOError(
+            f"{' '.join(command)} failed with exit code {process.returncode}: {stderr.decode(errors='replace')}"
+        )
+
+
+def _skip_bytes(f: BinaryIO, n: int):
+    """
+    Reads and discards the next `n` bytes of a stream.
+    """
+
+    while n > 0:
+        chunk = f.read(min(n, 1 << 20))
+        if not chunk:
+            raise IOError("The dump ended before the offset to resume from")
+        n -= len(chunk)
+
+
+def iter_dump_lines(f: BinaryIO) -> Iterator[bytes]:
+    """
+    Yields one raw line per entity from a dump stream. Works both for newline-delimited JSON and for
+    the official dumps, which wrap the entities in a JSON array: the '[' and ']' lines and any blank
+    lines are skipped. Trailing commas are left in place and dealt with by `loads_dump_line`.
+    """
+
+    for line in f:
+        if line[:1] == b"{" or line.strip() not in (b"", b"[", b"]"):
+            yield line
+
+
+def dump_files(path: str) -> List[str]:
+    """
+    Returns the files to read for a dump: the dump itself, or the shards in a directory of shards written by
+    `dump_split.split_dump`, in order. Hidden files and files starting with '_' are skipped.
+    """
+
+    if not os.path.isdir(path):
+        return [path]
+
+    return [
+        os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if name[:1] not in (".", "_") and os.path.isfile(os.path.join(path, name))
+    ]
+
+
+def is_entity_document(path: str) -> bool:
+    """
+    Returns whether a file is read as a single JSON document rather than line by line: files whose name
+    ends in .json, optionally followed by .gz, .bz2 or .zst. See `read_entity_document`.
+    """
+
+    name = os.path.basename(path).lower()
+    for suffix in (".gz", ".bz2", ".zst", ".zstd"):
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+
+    return name.endswith(".json")
+
+
+def read_entity_document(path: str, use_external_decompressor: bool = True) -> list:
+    """
+    Reads the entities in a (possibly compressed) JSON file: a saved wbgetentities response, a list of
+    entities or a single entity. Missing entities in a wbgetentities response are skipped.
+    """
+
+    with open_dump(path, use_external_decompressor) as f:
+        data = serialization.loads(f.read())
+
+    if isinstance(data, list):
+        return data
+
+    if "entities" in data:
+        return [
+            entity for entity in data["entities"].values() if "missing" not in entity
+        ]
+
+    return [data]
+
+
+def read_dump_lines(
+    path: str, use_external_decompressor: bool = True
+) -> Iterator[bytes]:
+    """
+    Yields one raw line per entity from a dump or a directory of shards (see `dump_files`).
+    """
+
+    for dump_file in dump_files(path):
+        with open_dump(dump_file, use_external_decompressor) as f:
+            yield from iter_dump_lines(f)
+
+
+def loads_dump_line(line: bytes) -> dict:
+    """
+    Parses a single line of a dump using the JSON backend selected in `elastic_wikidata.serialization`.
+    The trailing comma of array-wrapped dumps is ignored without copying the line.
+    """
+
+    return serialization.loads_line(line)
+
+
+def iter_dump_lines_with_offsets(f: BinaryIO, offset: int = 0) -> Iterator[tuple]:
+    """
+    As `iter_dump_lines`, but yields (line, end) where end is the position in the decompressed dump just
+    after the line. Reading can be resumed from there by passing it to `open_dump` as `offset`.
+
+    Args:
+        f (BinaryIO): dump stream
+        offset (int, optional): position of the stream in the dump. Defaults to 0.
+    """
+
+    for line in f:
+        offset += len(line)
+        if line[:1] == b"{" or line.strip() not in (b"", b"[", b"]"):
+            yield line, offset
@@ -0,0 +1,294 @@
+import bz2
+import gzip
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+from tqdm.auto import tqdm
+from elastic_wikidata import serialization
+from elastic_wikidata.dump_reader import read_dump_lines, loads_dump_line
+from elastic_wikidata.entity_filter import EntityFilter
+from elastic_wikidata.pipeline import batched
+from elastic_wikidata.wd_entities import EntitySimplifier
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# file suffix of the shards for each compression format
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "bz2": ".bz2", "zstd": ".zst"}
+
+# spec names are used as directory names. Names starting with '.' or '_' would be skipped when reading.
+_spec_name_regex = re.compile(r"[A-Za-z0-9][\w.-]*")
+
+
+def read_filter_specs(path: str) -> dict:
+    """
+    Reads named filter specs from a JSON file, e.g.
+
+        {
+            "humans": {"claim_values": {"P31": ["Q5"]}},
+            "located": {"properties": ["P625"], "entity_types": ["item"]},
+            "selected": {"qids": "qids.txt"}
+        }
+
+    Each spec takes the arguments of `entity_filter.EntityFilter`. `qids` can also be the path to a file of
+    newline-separated QIDs, relative to the specs file. An empty spec matches every entity.
+
+    Returns:
+        dict: {name: EntityFilter}
+    """
+
+    with open(path, "rb") as f:
+        specs = serialization.loads(f.read())
+
+    filters = {}
+
+    for name, spec in specs.items():
+        if not _spec_name_regex.fullmatch(name):
+            raise ValueError(
+                f"Invalid spec name {name!r}: use letters, numbers, '_', '-' and '.'"
+            )
+
+        spec = dict(spec)
+        if isinstance(spec.get("qids"), str):
+            qids_path = os.path.join(os.path.dirname(path), spec["qids"])
+            with open(qids_path, "r") as f:
+                spec["qids"] = f.read().split()
+
+        try:
+            filters[name] = EntityFilter(**spec)
+        except TypeError as e:
+            raise ValueError(f"Invalid spec {name!r}: {e}")
+
+    return filters
+
+
+class ShardWriter:
+    def __init__(
+        self, directory: str, compression: str = None, shard_size: int = 1_000_000
+    ):
+        """
+        Writes NDJSON lines to numbered shards in a directory (part-00000.ndjson.gz, ...), starting a new
+        shard every `shard_size` lines. The directory can be loaded with `processDump` like a dump.
+
+        Args:
+            directory (str): created if it doesn't exist. Must be empty if it does, so that shards from an
+                earlier run aren't mixed in.
+            compression (str, optional): None, 'gzip', 'bz2' or 'zstd'. zstd needs the zstandard package.
+                Defaults to None.
+            shard_size (int, optional): lines per shard. Defaults to 1,000,000.
+        """
+
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(
+                f"compression must be one of {', '.join(c for c in COMPRESSION_SUFFIXES if c)}"
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ImportError(
+                "Writing zstd shards needs the zstandard package (pip install zstandard)"
+            )
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise FileExistsError(f"{directory} already exists and isn't empty")
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.compression = compression
+        self.shard_size = shard_size
+        self.count = 0
+        self.shards = 0
+        self._file = None
+        self._lines_in_shard = 0
+
+    def write(self, line: bytes):
+        if self._file is None or self._lines_in_shard >= self.shard_size:
+            self._next_shard()
+
+        self._file.write(line)
+        self._lines_in_shard += 1
+        self.count += 1
+
+    def _next_shard(self):
+        self.close()
+
+        path = os.path.join(
+            self.directory,
+            f"part-{self.shards:05d}.ndjson{COMPRESSION_SUFFIXES[self.compression]}",
+        )
+
+        if self.compression == "gzip":
+            self._file = gzip.open(path, "wb", compresslevel=6)
+        elif self.compression == "bz2":
+            self._file = bz2.open(path, "wb")
+        elif self.compression == "zstd":
+            self._file = zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        else:
+            self._file = open(path, "wb", buffering=1 << 20)
+
+        self.shards += 1
+        self._lines_in_shard = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def split_line(line: bytes, specs: dict, simplifier: EntitySimplifier = None) -> tuple:
+    """
+    Checks a dump line against every spec, parsing it at most once, and only if a spec's prescan passes.
+
+    Returns:
+        tuple: (names of the specs the entity passes, NDJSON line to write), or None if it passes none.
+            The line is the raw entity, or the simplified document if `simplifier` is given.
+    """
+
+    doc = None
+    names = []
+
+    for name, entity_filter in specs.items():
+        if not entity_filter:
+            names.append(name)
+            continue
+
+        if not entity_filter.prescan(line):
+            continue
+
+        if doc is None:
+            doc = loads_dump_line(line)
+
+        if entity_filter.match(doc):
+            names.append(name)
+
+    if not names:
+        return None
+
+    if simplifier is None:
+        # without whitespace and the trailing comma of array-wrapped dumps
+        return names, line[: serialization._line_end(line)] + b"\n"
+
+    if doc is None:
+        doc = loads_dump_line(line)
+
+    return names, serialization.dumps(simplifier.simplify(doc)).encode("utf-8") + b"\n"
+
+
+def split_dump(
+    path: str,
+    out_dir: str,
+    specs: dict,
+    simplifier: EntitySimplifier = None,
+    workers: int = 1,
+    compression: str = None,
+    shard_size: int = 1_000_000,
+    batch_size: int = 1000,
+    use_external_decompressor: bool = True,
+) -> dict:
+    """
+    Splits a dump into pre-filtered NDJSON shards for several filter specs in one pass, so that the dump is
+    only decompressed and read once however many indices are derived from it. The shards of each spec are
+    written to `out_dir/<name>/`, in dump order.
+
+    Raw shards (the default) keep the entities as they are in the dump, and a spec's directory can be
+    loaded with `processDump` (`ew dump -p <out_dir>/<name>`) in place of the dump. With `simplifier` the
+    shards hold simplified documents instead, for use outside elastic-wikidata.
+
+    Args:
+        path (str): path to the dump, or to a directory of shards
+        out_dir (str): directory to write a directory of shards to for each spec
+        specs (dict): {name: EntityFilter}, e.g. from `read_filter_specs`
+        simplifier (EntitySimplifier, optional): write simplified documents. Defaults to None.
+        workers (int, optional): processes used to parse, filter and simplify lines. Defaults to 1.
+        compression (str, optional): None, 'gzip', 'bz2' or 'zstd'. Defaults to None.
+        shard_size (int, optional): entities per shard. Defaults to 1,000,000.
+        batch_size (int, optional): lines sent to a worker process at once. Defaults to 1000.
+        use_external_decompressor (bool, optional): see `dump_reader.open_dump`. Defaults to True.
+
+    Returns:
+        dict: {name: number of entities written}
+    """
+
+    writers = {
+        name: ShardWriter(os.path.join(out_dir, name), compression, shard_size)
+        for name in specs
+    }
+    lines = tqdm(
+        read_dump_lines(path, use_external_decompressor),
+        desc="Splitting dump",
+        unit=" entities",
+    )
+
+    try:
+        if workers > 1:
+            results = _split_parallel(lines, specs, simplifier, workers, batch_size)
+        else:
+            results = (split_line(line, specs, simplifier) for line in lines)
+
+        for result in results:
+            if result is None:
+                continue
+
+            names, data = result
+            for name in names:
+                writers[name].write(data)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for name, writer in writers.items():
+        print(f"{name}: {writer.count} entities in {writer.shards} shards")
+
+    return {name: writer.count for name, writer in writers.items()}
+
+
+def _split_parallel(
+    lines: Iterable[bytes],
+    specs: dict,
+    simplifier: EntitySimplifier,
+    workers: int,
+    batch_size: int,
+) -> Iterator[tuple]:
+    """
+    Runs `split_line` on batches of lines in a pool of processes, yielding the results in dump order. At
+    most two batches per worker are in flight at once.
+    """
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_split_worker,
+        initargs=(specs, simplifier),
+    ) as executor:
+        pending = deque()
+
+        for batch in batched(lines, batch_size):
+            pending.append(executor.submit(_split_lines, batch))
+
+            while len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+
+# options for worker processes, set once per process by `_init_split_worker`
+_worker_options = {}
+
+
+def _init_split_worker(specs: dict, simplifier: EntitySimplifier):
+    _worker_options.update({"specs": specs, "simplifier": simplifier})
+
+
+def _split_lines(lines: list) -> list:
+    specs = _worker_options["specs"]
+    simplifier = _worker_options["simplifier"]
+
+    return [split_line(line, specs, simplifier) for line in lines]
@@ -1,36 +1,72 @@
-import json
-from itertools import islice
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice, repeat
 from tqdm.auto import tqdm
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import streaming_bulk
-from typing import Union
+from elasticsearch.helpers import scan
+from typing import Iterable, Union
+from elastic_wikidata.dump_reader import (
+    open_dump,
+    dump_files,
+    is_entity_document,
+    iter_dump_lines_with_offsets,
+    loads_dump_line,
+    read_entity_document,
+)
+from elastic_wikidata.entity_filter import (
+    EntityFilter,
+    prescan_id,
+    prescan_lastrevid,
+)
+from elastic_wikidata import serialization
+from elastic_wikidata.bulk import BulkIndexer, read_dead_letters
+from elastic_wikidata import index_versions, metrics
+from elastic_wikidata.labels import APILabelSource, LabelEnricher, LabelTable
+from elastic_wikidata.label_index import LabelIndex, build_label_index
+from elastic_wikidata.pipeline import batched, prefetch
 from elastic_wikidata.wd_entities import (
     get_entities,
     wiki_property_check,
-    simplify_wbgetentities_result,
+    EntitySimplifier,
+    ALL_LANGUAGES,
 )
 
 
 class processDump:
     def __init__(
-        self, dump: Union[str, list], es_credentials: dict, index_name: str, **kwargs
+        self,
+        dump: Union[str, Iterable[str]],
+        es_credentials: dict,
+        index_name: str,
+        **kwargs,
     ):
         self.config = {
-            "chunk_size": 1000,
-            "queue_size": 8,
+            "chunk_size": kwargs.get("chunk_size") or 1000,
+            "max_chunk_bytes": kwargs.get("max_chunk_bytes") or 100 * 1024 * 1024,
+            "bulk_threads": kwargs.get("bulk_threads") or 1,
+            "queue_size": kwargs.get("queue_size") or 8,
+            "adaptive_bulk": kwargs.get("adaptive_bulk", False),
+            "max_retries": kwargs.get("max_retries", 3),
+            "initial_backoff": kwargs.get("initial_backoff", 2),
         }
 
+        # file that actions which fail to index are written to, so they can be replayed
+        self.dead_letter_path = kwargs.get("dead_letter_path")
+
         self.es_credentials = es_credentials
 
         if isinstance(dump, str):
             self.dump_path = dump
             self.entities = None
-        elif isinstance(dump, list):
+        elif isinstance(dump, Iterable):
+            # a list of QIDs, or an iterable such as a generator reading them from a SPARQL query
             self.entities = dump
             self.dump_path = None
         else:
             raise ValueError(
-                "dump must either be path to JSON dump or Python list of entities"
+                "dump must either be path to JSON dump or an iterable of entities"
             )
 
         self.index_name = index_name
@@ -43,6 +79,57 @@ class processDump:
         else:
             self.doc_limit = None
 
+        # number of processes used to parse and simplify lines of a JSON dump
+        self.workers = kwargs.get("workers") or 1
+        self.batch_size = kwargs.get("batch_size", 1000)
+        self.preserve_order = kwargs.get("preserve_order", True)
+        self.use_external_decompressor = kwargs.get("use_external_decompressor", True)
+        self.entity_filter = kwargs.get("entity_filter")
+
+        # `checkpoint.Checkpoint` recording how far through the source the index is up to date
+        self.checkpoint = kwargs.get("checkpoint")
+        if self.checkpoint is not None and self.workers > 1 and not self.preserve_order:
+            print(
+                "Documents are yielded in dump order so that progress can be checkpointed."
+            )
+            self.preserve_order = True
+
+        # number of concurrent requests to the wbgetentities API
+        self.fetch_workers = kwargs.get("fetch_workers") or 1
+
+        # number of QIDs read ahead from an iterable of entities while earlier ones are fetched and indexed
+        self.entity_queue_size = kwargs.get("entity_queue_size") or 10000
+
+        # only index entities whose lastrevid differs from the one in the index, and delete entities
+        # which no longer exist
+        self.incremental = kwargs.get("incremental", False)
+
+        # read `dump` as a directory of entity files, such as saved wbgetentities responses
+        self.files = kwargs.get("files", False)
+        if self.files and self.incremental:
+            raise ValueError("Incremental updates can't be made from entity files")
+
+        # `sinks.Sink` to write documents to instead of an Elasticsearch index
+        self.sink = kwargs.get("sink")
+
+        # load into a new versioned index, and point `index_name` at it as an alias once the load is complete
+        self.build_new_index = kwargs.get("build_new_index", False)
+        self.forcemerge = kwargs.get("forcemerge", False)
+        self.keep_versions = kwargs.get("keep_versions", 2)
+        self.alias = None
+
+        if self.build_new_index and self.incremental:
+            raise ValueError(
+                "Incremental updates are made to the existing index, so can't be used when building a new index"
+            )
+
+        if self.sink is not None and (
+            self.incremental or self.build_new_index or self.checkpoint is not None
+        ):
+            raise ValueError(
+                "Incremental updates, building a new index and checkpoints need an Elasticsearch index rather than a sink"
+            )
+
         self.wiki_options = {}
 
         if "lang" in kwargs:
@@ -55,26 +142,45 @@ class processDump:
         else:
             self.user_agent_contact = None
 
-        if "properties" in kwargs:
-            if isinstance(kwargs["properties"], str) and wiki_property_check(
-                kwargs["properties"]
-            ):
-                self.wiki_options["properties"] = [
-                    kwargs["properties"].upper()
-                ]  # [P31], not [p31]
-            elif isinstance(kwargs["properties"], list):
-                self.wiki_options["properties"] = [
-                    item.upper()
-                    for item in kwargs["properties"]
-                    if wiki_property_check(item)
-                ]
-        else:
-            self.wiki_options["properties"] = ["P31"]
+        # statements to keep by rank, and the qualifiers and references to keep with each statement
+        self.simplifier = make_simplifier(**kwargs)
+        self.wiki_options["properties"] = list(self.simplifier.properties)
+
+        # add the labels of entities that claims refer to: 'api' fetches them from Wikidata, 'dump' reads
+        # them from the dump first in a separate pass, or from a label index built from a dump
+        self.enrich_labels = kwargs.get("enrich_labels")
+        self.label_index = kwargs.get("label_index")
+        if self.label_index and not self.enrich_labels:
+            self.enrich_labels = "dump"
+        if self.enrich_labels not in (None, False, "api", "dump"):
+            raise ValueError("enrich_labels must be 'api' or 'dump'")
+        if (
+            self.enrich_labels == "dump"
+            and (self.dump_path is None or self.files)
+            and not (self.label_index and os.path.exists(self.label_index))
+        ):
+            raise ValueError(
+                "Labels can only be read from a dump when loading a dump, or from an existing label index"
+            )
+        self.label_window = kwargs.get("label_window") or 1000
+        self.label_cache_size = kwargs.get("label_cache_size") or 100_000
+
+    def start(self):
+        """
+        Connects to Elasticsearch and creates the index (see `start_elasticsearch`), unless documents are
+        being written to `self.sink`.
+        """
+
+        if self.sink is None:
+            self.start_elasticsearch()
 
     def start_elasticsearch(self):
         """
         Creates an Elasticsearch index. If SEARCH_CLUSTER, ELASTICSEARCH_USER & ELASTICSEARCH_PASSWORD
         are specified in config it uses those, otherwise uses a locally running Elasticsearch instance.
+
+        If `self.build_new_index` is set, a new versioned index is created with settings for fast indexing,
+        and `self.index_name` becomes the alias which is moved to it once the load is complete.
         """
 
         if "ELASTICSEARCH_CLUSTER" in self.es_credentials:
@@ -89,6 +195,7 @@ class processDump:
                 ),
                 max_retries=100,
                 retry_on_timeout=True,
+                serializer=serialization.ElasticsearchSerializer(),
             )
         else:
             # run on localhost
@@ -96,17 +203,51 @@ class processDump:
             self.es = Elasticsearch(
                 max_retries=100,
                 retry_on_timeout=True,
+                serializer=serialization.ElasticsearchSerializer(),
             )
 
-        mappings = {
-            "mappings": {
-                "properties": {
-                    "labels": {"type": "text", "copy_to": "labels_aliases"},
-                    "aliases": {"type": "text", "copy_to": "labels_aliases"},
-                    "labels_aliases": {"type": "text", "store": "true"},
-                }
-            }
-        }
+        mappings = {"mappings": self.simplifier.mappings()}
+
+        if self.build_new_index:
+            self.alias = self.index_name
+            resumed_index = self.checkpoint.index if self.checkpoint else None
+
+            if resumed_index:
+                # the watermarks only apply to the index that was being built
+                if not self.es.indices.exists(index=resumed_index):
+                    raise ValueError(
+                        f"Index {resumed_index} from the checkpoint no longer exists. Start the build again without resuming."
+                    )
+                self.index_name = resumed_index
+                print(
+                    f"Resuming the build of {self.index_name}. {self.alias} will point to it after load is complete."
+                )
+                return
+
+            if self.checkpoint is not None and self.checkpoint.watermarks:
+                # a new index would be missing everything loaded before the checkpoint
+                raise ValueError(
+                    "The checkpoint was saved by a load into an existing index, so can't be resumed with --build."
+                )
+
+            self.index_name = index_versions.versioned_index_name(self.alias)
+            print(
+                f"Building new index {self.index_name}. {self.alias} will point to it after load is complete."
+            )
+            self.es.indices.create(
+                index=self.index_name,
+                body=dict(mappings, settings=index_versions.BUILD_SETTINGS),
+            )
+
+            if self.checkpoint is not None:
+                self.checkpoint.index = self.index_name
+                self.checkpoint.save()
+            return
+
+        if self.checkpoint is not None and self.checkpoint.index:
+            raise ValueError(
+                f"The checkpoint was saved while building {self.checkpoint.index}, so can only be resumed with --build."
+            )
 
         self.es.indices.create(index=self.index_name, ignore=400, body=mappings)
 
@@ -114,78 +255,716 @@ class processDump:
             print(
                 "Temporary disabling refresh for the index. Will reset refresh interval to the default (1s) after load is complete."
             )
-            self.es.indices.put_settings({"index": {"refresh_interval": -1}})
+            self.es.indices.put_settings(
+                index=self.index_name, body={"index": {"refresh_interval": -1}}
+            )
 
     def dump_to_es(self):
+        """
+        Loads the documents into the index, or writes them to `self.sink` if it's set.
+
+        Returns:
+            tuple: (successes, failures)
+        """
+
+        if self.sink is not None:
+            return self._write_to_sink()
+
         print("Indexing documents...")
-        successes = 0
-        errors = []
 
+        action_generator = self._generate_actions()
+
+        try:
+            results = self._consume(self.bulk(action_generator))
+
+        finally:
+            if self.disable_refresh_on_index and not self.build_new_index:
+                # reset back to default
+                print("Refresh interval set back to default of 1s.")
+                self.es.indices.put_settings(
+                    index=self.index_name, body={"index": {"refresh_interval": "1s"}}
+                )
+
+        # if the load fails the alias is left pointing at the previous index
+        if self.build_new_index:
+            index_versions.finish_build(
+                self.es,
+                self.index_name,
+                self.alias,
+                forcemerge=self.forcemerge,
+                keep_versions=self.keep_versions,
+            )
+
+        return results
+
+    def _generate_actions(self):
         # if dump_path, use generator that passes
         if self.dump_path:
             action_generator = self.generate_actions_from_dump()
-        elif self.entities:
+        elif self.entities is not None:
             action_generator = self.generate_actions_from_entities()
 
+        if self.enrich_labels:
+            action_generator = self.label_enricher().enrich(action_generator)
+
+        return action_generator
+
+    def _write_to_sink(self) -> tuple:
+        print("Writing documents...")
+
+        actions = self._generate_actions()
+
         try:
-            for ok, action in tqdm(
-                streaming_bulk(
-                    client=self.es,
-                    index=self.index_name,
-                    actions=action_generator,
-                    chunk_size=self.config["chunk_size"],
-                    # queue_size=self.config["queue_size"],
-                    max_retries=3,
-                ),
-            ):
+            return self._consume(self.sink.write(actions))
+        finally:
+            self.sink.close()
+
+    def label_enricher(self) -> LabelEnricher:
+        """
+        Returns a `LabelEnricher` for `self.enrich_labels`. Labels are in the first language loaded, or in
+        English when loading all languages. With 'dump', the whole dump is read for labels first, unless
+        there's a label index at `self.label_index`. If there isn't, it's built there, for the next load to
+        reuse.
+        """
+
+        lang = self.wiki_options["lang"]
+        if not isinstance(lang, str):
+            lang = lang[0]
+        elif lang == ALL_LANGUAGES:
+            lang = "en"
+
+        if self.enrich_labels == "dump" and self.label_index:
+            if not os.path.exists(self.label_index):
+                build_label_index(
+                    self.dump_path,
+                    self.label_index,
+                    lang,
+                    self.use_external_decompressor,
+                )
+            source = LabelIndex(self.label_index)
+        elif self.enrich_labels == "dump":
+            source = LabelTable.from_dump(
+                self.dump_path, lang, self.use_external_decompressor
+            )
+        else:
+            source = APILabelSource(lang, workers=self.fetch_workers)
+
+        return LabelEnricher(
+            source, window=self.label_window, cache_size=self.label_cache_size
+        )
+
+    def _consume(self, results) -> tuple:
+        """
+        Runs the bulk load, counting the actions which succeeded and failed. Only the first few failures
+        are printed, and the rest are summarised at the end, so a failing load doesn't flood the output or
+        hold every error in memory. Each result moves `self.checkpoint` forward, and it's saved at the end
+        even if the load fails.
+
+        Returns:
+            tuple: (successes, failures)
+        """
+
+        successes = 0
+        failures = 0
+
+        try:
+            for ok, action in tqdm(results):
                 if not ok:
-                    print(action)
-                    errors.append(action)
+                    failures += 1
+                    if failures <= 10:
+                        print(action)
                 successes += ok
 
+                # failed actions count as done too: they're in the dead-letter file if there is one
+                if self.checkpoint is not None:
+                    self.checkpoint.ack(next(iter(action.values())).get("_id"))
         finally:
-            if self.disable_refresh_on_index:
-                # reset back to default
-                print("Refresh interval set back to default of 1s.")
-                self.es.indices.put_settings({"index": {"refresh_interval": "1s"}})
+            if self.checkpoint is not None:
+                self.checkpoint.save()
+
+        if failures:
+            message = f"{failures} of {successes + failures} actions failed."
+            if self.dead_letter_path:
+                message += f" Failed actions were written to {self.dead_letter_path}."
+            print(message)
+
+        return successes, failures
+
+    def bulk(self, actions, expand_action_callback=None):
+        """
+        Sends actions to the index in bulk requests of at most `chunk_size` documents and `max_chunk_bytes`
+        bytes, with up to `bulk_threads` requests in flight and `queue_size` chunks waiting to be sent.
+        Yields (ok, result) for each action.
+
+        Requests and documents rejected with a 429 are retried with exponential backoff, and failed actions
+        are written to `self.dead_letter_path` if it's set. With `adaptive_bulk`, chunk size and concurrency
+        are adjusted from the latency and rejections of each request. See `elastic_wikidata.bulk.BulkIndexer`.
+
+        Args:
+            actions (Iterable): documents or actions
+            expand_action_callback (Callable, optional): Defaults to `expand_action`.
+        """
+
+        indexer = BulkIndexer(
+            self.es,
+            self.index_name,
+            chunk_size=self.config["chunk_size"],
+            max_chunk_bytes=self.config["max_chunk_bytes"],
+            concurrency=self.config["bulk_threads"],
+            queue_size=self.config["queue_size"],
+            adaptive=self.config["adaptive_bulk"],
+            max_retries=self.config["max_retries"],
+            initial_backoff=self.config["initial_backoff"],
+            dead_letter_path=self.dead_letter_path,
+        )
+
+        return indexer.index(actions, expand_action_callback or expand_action)
+
+    def replay_dead_letters(self, path: str):
+        """
+        Sends the actions in a dead-letter file written by a previous load to the index again.
+        Actions which fail again are written to `self.dead_letter_path` if it's set.
+        """
+
+        print(f"Replaying failed actions from {path}...")
+
+        return self._consume(
+            self.bulk(read_dead_letters(path), expand_action_callback=lambda x: x)
+        )
 
     def process_doc(self, doc: dict) -> dict:
         """
         Processes a single document from the JSON dump, returning a filtered version of that document.
         """
 
-        lang = self.wiki_options["lang"]
-        properties = self.wiki_options["properties"]
-
-        return simplify_wbgetentities_result(doc, lang, properties)
+        return self.simplifier.simplify(doc)
 
     def generate_actions_from_dump(self):
         """
         Generator to yield a processed document from the Wikidata JSON dump.
-        Each line of the Wikidata JSON dump is a separate document.
+        Each line of the Wikidata JSON dump is a separate document. The dump can be newline-delimited
+        JSON or an official array-wrapped dump, and can be compressed with gzip, bz2 or zstd.
+        If `self.entity_filter` is set, only entities which pass the filter are yielded.
+
+        If `self.incremental` is set, only entities whose lastrevid differs from the indexed document are
+        yielded, followed by delete actions for documents in the index which weren't found in the dump.
+
+        If `self.checkpoint` is set, the position in the dump of each document is tracked, and reading starts
+        from the checkpoint's position.
+
+        The dump can also be a directory of shards written by `dump_split.split_dump`, which are read in turn.
+        With `self.files`, it's a directory of entity files instead (see `_file_tasks`).
+        """
+
+        watermarks = self.checkpoint.watermarks if self.checkpoint is not None else {}
+        resumed = any(watermarks.values())
+        if resumed:
+            positions = ", ".join(
+                f"byte {end} of {'the dump' if lane == 'dump' else lane}"
+                for lane, end in watermarks.items()
+            )
+            print(f"Resuming from {positions}")
+
+        if self.files:
+            tasks = self._file_tasks(watermarks)
+        else:
+            lines = self._dump_lines(watermarks)
+            if self.incremental:
+                indexed_revisions = self.get_indexed_revisions()
+                lines = self._changed_lines(lines, indexed_revisions)
+            tasks = self._line_tasks(lines)
+
+        if self.workers > 1:
+            docs = self._generate_actions_parallel(tasks)
+        else:
+            docs = self._generate_actions_serial(tasks)
+
+        # optionally limit number that are loaded
+        if self.doc_limit is not None:
+            docs = islice(docs, self.doc_limit)
+
+        lane, end = "dump", 0
+        for (lane, end), doc in docs:
+            if self.incremental:
+                indexed_revisions.pop(doc["id"], None)
+            if self.checkpoint is not None:
+                self.checkpoint.add(doc["id"], end, lane)
+            yield doc
+
+        if not self.incremental or self.doc_limit is not None:
+            return
+
+        if resumed:
+            print(
+                "WARNING: documents for entities missing from the dump aren't deleted when resuming, as the start of the dump wasn't read."
+            )
+            return
+
+        # entities left in the index which weren't in the dump have been deleted, or no longer pass the filter
+        for qid in indexed_revisions:
+            if self.checkpoint is not None:
+                self.checkpoint.add(qid, end, lane)
+            yield delete_action(qid)
+
+    def _dump_lines(self, watermarks: dict):
+        """
+        Yields (line, (lane, end)) for each entity in the dump, where end is the position in the lane just
+        after the line. A dump file is the lane 'dump'; each shard of a directory of shards is a lane named
+        after the shard, so that a resumed load carries on from the right place in every shard. Each lane is
+        read from its watermark.
+        """
+
+        if os.path.isdir(self.dump_path):
+            lanes = [
+                (path, os.path.basename(path)) for path in dump_files(self.dump_path)
+            ]
+        else:
+            lanes = [(self.dump_path, "dump")]
+
+        for path, lane in lanes:
+            yield from self._lane_lines(path, lane, watermarks.get(lane, 0))
+
+    def _lane_lines(self, path: str, lane: str, offset: int = 0):
+        """
+        Yields (line, (lane, end)) for each entity in a dump file, starting at `offset`.
+        """
+
+        # lines and bytes read are added to the metrics every thousand lines
+        count, size = 0, 0
+
+        try:
+            with open_dump(path, self.use_external_decompressor, offset) as f:
+                for line, end in iter_dump_lines_with_offsets(f, offset):
+                    count += 1
+                    size += len(line)
+                    if count >= 1000:
+                        _record_read(count, size)
+                        count, size = 0, 0
+
+                    yield line, (lane, end)
+        finally:
+            _record_read(count, size)
+
+    def _line_tasks(self, lines):
+        """
+        Groups (line, end) pairs into tasks of `self.batch_size` lines. A task is (kind, data, ends): for
+        'lines', data is a list of lines and ends their positions; for 'document', data is the path of an
+        entity file and ends the position of the end of the file, shared by all of its entities.
+        """
+
+        for batch in batched(lines, self.batch_size):
+            yield "lines", [line for line, _ in batch], [end for _, end in batch]
+
+    def _file_tasks(self, watermarks: dict):
+        """
+        Yields tasks (see `_line_tasks`) for a directory of entity files, read in name order. Files ending in
+        .json (optionally compressed) are read whole, as saved wbgetentities responses, lists of entities or
+        single entities (see `dump_reader.read_entity_document`), with one task per file. Other files are read
+        line by line like a dump, so NDJSON entities and shards can be mixed in. Each file is a lane named after
+        it; a whole file is done once its lane reaches the file's size, and is skipped when resuming.
         """
-        with open(self.dump_path, "r", encoding="utf-8") as f:
-            objects = (json.loads(line) for line in f)
 
-            # optionally limit number that are loaded
-            if self.doc_limit is not None:
-                objects = islice(objects, self.doc_limit)
+        for path in dump_files(self.dump_path):
+            lane = os.path.basename(path)
 
-            for item in objects:
-                doc = self.process_doc(item)
+            if not is_entity_document(path):
+                lines = self._lane_lines(path, lane, watermarks.get(lane, 0))
+                yield from self._line_tasks(lines)
+                continue
 
-                yield doc
+            size = os.path.getsize(path)
+            if watermarks.get(lane, 0) < size:
+                yield "document", path, (lane, size)
+
+    def _generate_actions_serial(self, tasks):
+        """
+        Runs tasks (see `_line_tasks`) in this process, yielding (end, doc) pairs like
+        `_generate_actions_parallel`.
+        """
+
+        for kind, data, ends in tasks:
+            result = _process_task(kind, data, self.simplifier, self.entity_filter)
+            yield from _task_results(kind, ends, result)
+
+    def _generate_actions_parallel(self, tasks):
+        """
+        Parses and simplifies tasks (see `_line_tasks`) in a pool of `self.workers` processes.
+        At most two tasks per worker are in flight at once so the dump is never read far ahead of
+        the bulk loader. Documents are yielded in dump order unless `self.preserve_order` is False,
+        in which case tasks are yielded as soon as they finish.
+
+        Yields (end, doc) pairs, where end is (lane, position after the line or file) (see `_dump_lines`).
+        """
+
+        max_in_flight = 2 * self.workers
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_dump_worker,
+            initargs=(self.simplifier, self.entity_filter),
+        ) as executor:
+            pending = deque()
+            ends = {}
+
+            for kind, data, task_ends in tasks:
+                future = executor.submit(_process_task_in_worker, kind, data)
+                ends[future] = (kind, task_ends)
+                pending.append(future)
+
+                while len(pending) >= max_in_flight:
+                    yield from self._next_completed(pending, ends)
+
+                metrics.current().set("queue_depth", len(pending), queue="dump_batches")
+
+            while pending:
+                yield from self._next_completed(pending, ends)
+
+    def get_indexed_revisions(self, qcodes: list = None) -> dict:
+        """
+        Gets the lastrevid of documents in the index.
+
+        Args:
+            qcodes (list, optional): only get these documents. Defaults to None (every document in the index).
+
+        Returns:
+            dict: {qid: lastrevid}. lastrevid is None for documents indexed without one.
+        """
+
+        if not self.es.indices.exists(index=self.index_name):
+            return {}
+
+        if qcodes is None:
+            hits = scan(
+                self.es,
+                index=self.index_name,
+                query={"_source": ["lastrevid"]},
+                size=5000,
+            )
+            return {hit["_id"]: hit["_source"].get("lastrevid") for hit in hits}
+
+        revisions = {}
+
+        for batch in batched(qcodes, 1000):
+            res = self.es.mget(
+                body={"ids": batch}, index=self.index_name, _source=["lastrevid"]
+            )
+            for doc in res["docs"]:
+                if doc.get("found"):
+                    revisions[doc["_id"]] = doc["_source"].get("lastrevid")
+
+        return revisions
+
+    def _changed_lines(self, lines, indexed_revisions: dict):
+        """
+        Yields the (line, end) pairs of a dump whose entities have a different lastrevid to the indexed documents.
+        Unchanged entities are recognised without parsing the line, and removed from `indexed_revisions`.
+        """
+
+        for line, end in lines:
+            qid = prescan_id(line)
+
+            if qid is not None and qid in indexed_revisions:
+                lastrevid = prescan_lastrevid(line)
+
+                if lastrevid is not None and indexed_revisions[qid] == lastrevid:
+                    del indexed_revisions[qid]
+                    continue
+
+            yield line, end
+
+    def _changed_entities(self, qcodes: list) -> tuple:
+        """
+        Compares the lastrevid of each entity on Wikidata, requested with `props=info`, to the indexed
+        documents. Redirected entities are compared using the lastrevid of their target.
+
+        Returns:
+            tuple: (changed, deleted) lists of QIDs. Changed includes QIDs which aren't in the index yet.
+        """
+
+        indexed_revisions = self.get_indexed_revisions(qcodes)
+        changed, deleted = [], []
+
+        for page in get_entities.result_generator(
+            qcodes,
+            lang=self.wiki_options["lang"],
+            workers=self.fetch_workers,
+            props=["info"],
+            refresh_cache=True,
+        ):
+            for info in page:
+                qid = info["redirects"]["from"] if "redirects" in info else info["id"]
+
+                if "missing" in info:
+                    if qid in indexed_revisions:
+                        deleted.append(qid)
+                elif qid not in indexed_revisions or indexed_revisions[qid] != info.get(
+                    "lastrevid"
+                ):
+                    changed.append(qid)
+
+        return changed, deleted
+
+    def _next_completed(self, pending: deque, ends: dict) -> list:
+        """
+        Removes a finished future from `pending` and returns (end, doc) for its documents. Waits for the
+        oldest future if order is preserved, otherwise for whichever finishes first.
+        """
+
+        if self.preserve_order:
+            future = pending.popleft()
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            future = done.pop()
+            pending.remove(future)
+
+        kind, task_ends = ends.pop(future)
+
+        return _task_results(kind, task_ends, future.result())
 
     def generate_actions_from_entities(self):
         """
         Generator to yield processed document from list of entities. Calls are made to
-        wbgetentities API with page size of 50 to retrieve documents.
+        wbgetentities API with page size of 50 to retrieve documents, with up to `self.fetch_workers`
+        requests in flight at once.
+
+        The entities can also be any iterable of QIDs, such as a generator reading them from a SPARQL query.
+        It's read in a background thread, up to `self.entity_queue_size` QIDs ahead, so QIDs are fetched and
+        indexed while later ones are still being read. Fetched pages are also passed on through a bounded queue,
+        so each stage runs at the same time as the others and waits for them when it gets too far ahead.
+
+        If `self.incremental` is set, the current lastrevid of each entity is requested first (which is cheap),
+        and only entities whose lastrevid differs from the indexed document are fetched in full. Documents
+        for entities which have been deleted from Wikidata are deleted from the index. This needs every QID
+        at once, so an iterable of entities is read into a list first.
+
+        If `self.checkpoint` is set, positions of QIDs are added to it by the code producing them (see
+        `sparql_to_es.iter_entities_from_query`), and QIDs for which no action is sent are acknowledged here.
         """
 
+        entities = self.entities
+
+        if not isinstance(entities, list):
+            entities = prefetch(entities, self.entity_queue_size, name="entities")
+
+        if self.incremental:
+            all_entities = list(entities)
+            entities, deleted = self._changed_entities(all_entities)
+            print(
+                f"{len(entities)} entities have changed and {len(deleted)} have been deleted since they were indexed"
+            )
+
+            if self.checkpoint is not None:
+                for qid in set(all_entities).difference(entities, deleted):
+                    self.checkpoint.ack(qid)
+
+            for qid in deleted:
+                yield delete_action(qid)
+
         json_generator = get_entities.result_generator(
-            self.entities, lang=self.wiki_options["lang"]
+            entities,
+            lang=self.wiki_options["lang"],
+            workers=self.fetch_workers,
+            refresh_cache=self.incremental,
+        )
+        json_generator = prefetch(
+            json_generator, maxsize=2 * self.fetch_workers, name="pages"
         )
 
         for page in json_generator:
-            for item in page:
-                yield self.process_doc(item)
+            if self.entity_filter:
+                page = self._filter_page(page)
+
+            start = time.perf_counter()
+            docs = self.simplifier.simplify_batch(page)
+            metrics.record_stage("simplify", len(docs), time.perf_counter() - start)
+
+            yield from docs
+
+    def _filter_page(self, page: list) -> list:
+        """
+        Returns the entities in a page of wbgetentities results which pass `self.entity_filter`.
+        """
+
+        matches = []
+
+        for item in page:
+            if self.entity_filter.match(item):
+                matches.append(item)
+            elif self.checkpoint is not None:
+                # nothing is sent for this entity, so it's done as far as the checkpoint is concerned
+                self.checkpoint.ack(
+                    item["redirects"]["from"] if "redirects" in item else item["id"]
+                )
+
+        return matches
+
+
+def make_simplifier(**kwargs) -> EntitySimplifier:
+    """
+    Creates the `EntitySimplifier` for the options of `processDump` (lang, properties, ranks, qualifiers,
+    references, rich_claims and language_fallback), so documents written elsewhere, such as the columns of a
+    Parquet sink, match those of a load.
+    """
+
+    def checked(properties) -> list:
+        if isinstance(properties, str):
+            properties = [properties]
+        return [p.upper() for p in properties or [] if wiki_property_check(p)]
+
+    return EntitySimplifier(
+        kwargs.get("lang", "en"),
+        checked(kwargs.get("properties", ["P31"])),
+        ranks=kwargs.get("ranks", "all"),
+        qualifiers=checked(kwargs.get("qualifiers")),
+        references=checked(kwargs.get("references")),
+        rich_claims=kwargs.get("rich_claims"),
+        fallback=kwargs.get("language_fallback"),
+    )
+
+
+def expand_action(doc: dict) -> tuple:
+    """
+    Returns the action and data lines for a document in a bulk request. Documents are indexed with their QID
+    as the document ID. The document is serialized here, once, with the fastest available JSON backend, and
+    the bulk indexer sends the resulting string without parsing it again.
+    """
+
+    op_type = doc.get("_op_type")
+
+    if op_type == "delete":
+        return serialization.dumps({"delete": {"_id": doc["_id"]}}), None
+
+    return serialization.dumps({"index": {"_id": doc["id"]}}), serialization.dumps(doc)
+
+
+def delete_action(qid: str) -> dict:
+    return {"_op_type": "delete", "_id": qid}
+
+
+# options for worker processes, set once per process by `_init_dump_worker`
+_worker_options = {}
+
+
+def _init_dump_worker(simplifier: EntitySimplifier, entity_filter: EntityFilter):
+    _worker_options.update({"simplifier": simplifier, "entity_filter": entity_filter})
+
+
+def _parse_dump_line(line: bytes, entity_filter: EntityFilter = None) -> dict:
+    """
+    Parses a single line from a JSON dump. Returns None if the entity doesn't pass `entity_filter`, which
+    is checked on the raw line before parsing wherever possible.
+    """
+
+    if entity_filter:
+        if not entity_filter.prescan(line):
+            return None
+
+        doc = loads_dump_line(line)
+
+        return doc if entity_filter.match(doc) else None
+
+    return loads_dump_line(line)
+
+
+def _process_dump_batch(
+    lines: list, simplifier: EntitySimplifier, entity_filter: EntityFilter = None
+) -> tuple:
+    """
+    Parses and simplifies a batch of lines from a JSON dump, timing each stage.
+
+    Returns:
+        tuple: (docs, timings). docs has one document per line, with None for lines whose entities don't pass
+            the filter. timings is {'parse': seconds, 'simplify': seconds}.
+    """
+
+    start = time.perf_counter()
+    docs = [_parse_dump_line(line, entity_filter) for line in lines]
+
+    return _simplify_parsed(docs, simplifier, start)
+
+
+def _process_entity_document(
+    path: str, simplifier: EntitySimplifier, entity_filter: EntityFilter = None
+) -> tuple:
+    """
+    Reads, filters and simplifies the entities in a JSON file (see `dump_reader.read_entity_document`).
+
+    Returns:
+        tuple: (docs, timings) as for `_process_dump_batch`, with one document per entity in the file
+    """
+
+    start = time.perf_counter()
+    docs = [
+        doc if not entity_filter or entity_filter.match(doc) else None
+        for doc in read_entity_document(path)
+    ]
+
+    return _simplify_parsed(docs, simplifier, start)
+
+
+def _simplify_parsed(docs: list, simplifier: EntitySimplifier, start: float) -> tuple:
+    parsed = time.perf_counter()
+
+    simplified = iter(simplifier.simplify_batch(doc for doc in docs if doc is not None))
+    docs = [None if doc is None else next(simplified) for doc in docs]
+
+    return docs, {"parse": parsed - start, "simplify": time.perf_counter() - parsed}
+
+
+def _process_task(
+    kind: str, data, simplifier: EntitySimplifier, entity_filter: EntityFilter = None
+) -> tuple:
+    """
+    Runs a task from `processDump._line_tasks` or `processDump._file_tasks`.
+    """
+
+    if kind == "document":
+        return _process_entity_document(data, simplifier, entity_filter)
+
+    return _process_dump_batch(data, simplifier, entity_filter)
+
+
+def _process_task_in_worker(kind: str, data) -> tuple:
+    """
+    Runs `_process_task` in a worker process, with the options it was started with. Defined at module
+    level so that it can be sent to worker processes. Timings are returned with the documents, as metrics
+    are collected in the main process.
+    """
+
+    return _process_task(
+        kind, data, _worker_options["simplifier"], _worker_options["entity_filter"]
+    )
+
+
+def _task_results(kind: str, ends, result: tuple) -> list:
+    """
+    Records the metrics of a finished task, and returns (end, doc) for each of its documents.
+    """
+
+    docs, timings = result
+
+    if kind == "document":
+        # the whole file has been read
+        _record_read(len(docs), ends[1])
+        ends = repeat(ends)
+
+    _record_batch(docs, timings)
+
+    return [(end, doc) for end, doc in zip(ends, docs) if doc is not None]
+
+
+def _record_read(lines: int, size: int):
+    if lines:
+        metrics.record_stage("read", lines)
+        metrics.current().inc("bytes_in_total", size, source="dump")
+
+
+def _record_batch(docs: list, timings: dict):
+    """
+    Records the parse and simplify timings of a batch of dump lines.
+    """
+
+    metrics.record_stage("parse", len(docs), timings["parse"])
+    metrics.record_stage(
+        "simplify", sum(doc is not None for doc in docs), timings["simplify"]
+    )
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterable, List
+from elastic_wikidata import serialization
+
+
+class EntityCache:
+    def __init__(
+        self,
+        cache_dir: str,
+        ttl: float = None,
+        max_size_mb: float = None,
+        refresh: bool = False,
+    ):
+        """
+        Persistent cache for responses from the wbgetentities API, stored in a SQLite database in
+        `cache_dir`. Entities are cached per QID, language and set of props, so requests with different
+        options don't share entries.
+
+        Args:
+            cache_dir (str): directory for the cache database. Created if it doesn't exist.
+            ttl (float, optional): seconds after which a cached entity is fetched again. Defaults to None (never).
+            max_size_mb (float, optional): when the compressed entities in the cache take up more than this,
+                the oldest ones are removed. Defaults to None (no limit).
+            refresh (bool, optional): ignore cached entities but still save newly fetched ones. Defaults to False.
+        """
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "wbgetentities.sqlite")
+        self.ttl = ttl
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb else None
+        self.refresh = refresh
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS entities (
+                qid TEXT NOT NULL,
+                lang TEXT NOT NULL,
+                props TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                body BLOB NOT NULL,
+                PRIMARY KEY (qid, lang, props)
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entities_fetched_at ON entities (fetched_at)"
+        )
+        self._conn.commit()
+
+        # total size of the entities in the cache, kept up to date as entities are added and removed so
+        # that adding a page doesn't need to scan the whole table
+        self._size = None
+        if self.max_size is not None:
+            (self._size,) = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entities"
+            ).fetchone()
+
+    def get_many(self, qcodes: Iterable[str], lang: str, props: str) -> dict:
+        """
+        Returns cached entities which haven't expired.
+
+        Args:
+            qcodes (Iterable[str]): QIDs to look up
+            lang (str): languages parameter of the request
+            props (str): props parameter of the request
+
+        Returns:
+            dict: {qid: entity} for each QID found in the cache
+        """
+
+        if self.refresh:
+            return {}
+
+        qcodes = list(qcodes)
+        min_fetched_at = time.time() - self.ttl if self.ttl else 0
+        results = {}
+
+        with self._lock:
+            # stay under SQLite's limit on the number of parameters in a query
+            for i in range(0, len(qcodes), 500):
+                chunk = qcodes[i : i + 500]
+                rows = self._conn.execute(
+                    f"""SELECT qid, body FROM entities
+                    WHERE lang = ? AND props = ? AND fetched_at >= ? AND qid IN ({','.join('?' * len(chunk))})""",
+                    [lang, props, min_fetched_at] + chunk,
+                )
+                for qid, body in rows:
+                    results[qid] = serialization.loads(zlib.decompress(body))
+
+        return results
+
+    def put_many(self, entities: List[dict], lang: str, props: str):
+        """
+        Adds entities from a wbgetentities response to the cache. Redirected entities are stored under
+        the QID that was requested. If a QID appears more than once, the last entity is kept.
+        """
+
+        now = time.time()
+        # keyed by QID, so the running size counts each entry once
+        rows = {}
+
+        for entity in entities:
+            qid = entity["redirects"]["from"] if "redirects" in entity else entity["id"]
+            body = zlib.compress(serialization.dumps(entity).encode("utf-8"), 1)
+            rows[qid] = (qid, lang, props, now, len(body), body)
+
+        rows = list(rows.values())
+
+        with self._lock:
+            if self.max_size is not None:
+                self._size += sum(row[4] for row in rows) - self._replaced_size(
+                    [row[0] for row in rows], lang, props
+                )
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+            if self.max_size is not None and self._size > self.max_size:
+                self._evict()
+
+    def _replaced_size(self, qcodes: List[str], lang: str, props: str) -> int:
+        """
+        Returns the total size of the entries which adding `qcodes`, which must be distinct, would replace.
+        """
+
+        size = 0
+
+        for i in range(0, len(qcodes), 500):
+            chunk = qcodes[i : i + 500]
+            (chunk_size,) = self._conn.execute(
+                f"""SELECT COALESCE(SUM(size), 0) FROM entities
+                WHERE lang = ? AND props = ? AND qid IN ({','.join('?' * len(chunk))})""",
+                [lang, props] + chunk,
+            ).fetchone()
+            size += chunk_size
+
+        return size
+
+    def _evict(self):
+        """
+        Removes expired entries, then the oldest entries until the cache is no bigger than `self.max_size`.
+        """
+
+        if self.ttl:
+            min_fetched_at = time.time() - self.ttl
+            (expired,) = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entities WHERE fetched_at < ?",
+                (min_fetched_at,),
+            ).fetchone()
+            self._conn.execute(
+                "DELETE FROM entities WHERE fetched_at < ?", (min_fetched_at,)
+            )
+            self._size -= expired
+
+        excess = self._size - self.max_size
+        removed = 0
+        to_remove = []
+
+        if excess > 0:
+            for rowid, entry_size in self._conn.execute(
+                "SELECT rowid, size FROM entities ORDER BY fetched_at"
+            ):
+                to_remove.append((rowid,))
+                removed += entry_size
+                if removed >= excess:
+                    break
+
+        self._conn.executemany("DELETE FROM entities WHERE rowid = ?", to_remove)
+        self._conn.commit()
+        self._size -= removed
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entities")
+            self._conn.commit()
+            if self._size is not None:
+                self._size = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,203 @@
+import re
+from typing import Iterable
+
+# top-level "type" and "id" fields of an entity, e.g. {"type":"item","id":"Q42",...
+_type_regex = re.compile(rb'"type"\s*:\s*"([a-z]+)"')
+_id_regex = re.compile(rb'"id"\s*:\s*"([A-Z]\d+)"')
+_lastrevid_regex = re.compile(rb'"lastrevid"\s*:\s*(\d+)')
+
+ENTITY_TYPES = {"item", "property", "lexeme"}
+_id_prefix_types = {"Q": "item", "P": "property", "L": "lexeme"}
+
+
+class EntityFilter:
+    def __init__(
+        self,
+        qids: Iterable[str] = None,
+        claim_values: dict = None,
+        entity_types: Iterable[str] = None,
+        properties: Iterable[str] = None,
+    ):
+        """
+        Filter for entities in a Wikidata JSON dump. Each line of the dump is first checked with a cheap
+        scan of its raw bytes (`prescan`), which rejects most non-matching lines without parsing them.
+        The lines that pass are parsed and checked exactly (`match`).
+
+        An entity passes the filter if it passes every criterion that is set.
+
+        Args:
+            qids (Iterable[str], optional): allow-list of entity IDs e.g. ['Q42', 'P31']
+            claim_values (dict, optional): property to values mapping, e.g. {'P31': ['Q5'], 'P279': ['Q5']}.
+                The entity passes if any of its values for any of these properties is in the list.
+            entity_types (Iterable[str], optional): any of 'item', 'property', 'lexeme'
+            properties (Iterable[str], optional): properties the entity must have statements for, e.g.
+                ['P625']. The entity passes if it has a statement for every one of them.
+        """
+
+        self.qids = {qid.upper() for qid in qids} if qids else None
+
+        if claim_values:
+            self.claim_values = {
+                p.upper(): {v.upper() for v in values}
+                for p, values in claim_values.items()
+            }
+            # quoted tokens that must appear in the raw line for the entity to have a matching claim
+            self._claim_tokens = [
+                (
+                    f'"{p}"'.encode("utf-8"),
+                    [f'"{v}"'.encode("utf-8") for v in values],
+                )
+                for p, values in self.claim_values.items()
+            ]
+        else:
+            self.claim_values = None
+
+        if entity_types:
+            self.entity_types = set(entity_types)
+            invalid_types = self.entity_types - ENTITY_TYPES
+            if invalid_types:
+                raise ValueError(
+                    f"Invalid entity types {invalid_types}. Must be in {ENTITY_TYPES}"
+                )
+        else:
+            self.entity_types = None
+
+        if properties:
+            self.properties = [p.upper() for p in properties]
+            self._property_tokens = [f'"{p}"'.encode("utf-8") for p in self.properties]
+        else:
+            self.properties = None
+
+    def __bool__(self) -> bool:
+        return any(
+            criterion is not None
+            for criterion in (
+                self.qids,
+                self.claim_values,
+                self.entity_types,
+                self.properties,
+            )
+        )
+
+    def prescan(self, line: bytes) -> bool:
+        """
+        Checks the raw bytes of a dump line without parsing it. Returns False only if the entity
+        certainly doesn't pass the filter; True means the line has to be parsed and checked with `match`.
+        """
+
+        if self.qids is not None or self.entity_types is not None:
+            head = _line_head(line)
+            entity_id = _search(_id_regex, head)
+
+            if (
+                self.qids is not None
+                and entity_id is not None
+                and entity_id not in self.qids
+            ):
+                return False
+
+            if self.entity_types is not None:
+                entity_type = _search(_type_regex, head)
+                if entity_type is None and entity_id is not None:
+                    entity_type = _id_prefix_types.get(entity_id[0])
+
+                if entity_type is not None and entity_type not in self.entity_types:
+                    return False
+
+        if self.claim_values is not None:
+            if not any(
+                p_token in line and any(v_token in line for v_token in v_tokens)
+                for p_token, v_tokens in self._claim_tokens
+            ):
+                return False
+
+        if self.properties is not None:
+            if not all(p_token in line for p_token in self._property_tokens):
+                return False
+
+        return True
+
+    def match(self, doc: dict) -> bool:
+        """
+        Checks a parsed entity from a dump or from the wbgetentities API against the filter.
+        """
+
+        if self.qids is not None and doc.get("id") not in self.qids:
+            return False
+
+        if self.entity_types is not None:
+            entity_type = doc.get("type") or _id_prefix_types.get(doc.get("id", " ")[0])
+            if entity_type not in self.entity_types:
+                return False
+
+        if self.claim_values is not None:
+            claims = doc.get("claims") or {}
+            if not any(
+                _claim_value_id(claim) in values
+                for p, values in self.claim_values.items()
+                for claim in claims.get(p, [])
+            ):
+                return False
+
+        if self.properties is not None:
+            claims = doc.get("claims") or {}
+            if not all(claims.get(p) for p in self.properties):
+                return False
+
+        return True
+
+
+def _claim_value_id(claim: dict) -> str:
+    """
+    Returns the ID of an entity-valued claim, or None if the claim has another type or no value.
+    """
+
+    value = claim.get("mainsnak", {}).get("datavalue", {}).get("value")
+
+    if isinstance(value, dict):
+        return value.get("id")
+
+    return None
+
+
+def prescan_id(line: bytes) -> str:
+    """
+    Returns the ID of the entity on a dump line without parsing it, or None if it isn't at the top
+    of the line.
+    """
+
+    return _search(_id_regex, _line_head(line))
+
+
+def prescan_lastrevid(line: bytes) -> int:
+    """
+    Returns the lastrevid of the entity on a dump line without parsing it, or None if it doesn't have
+    one. Quotes inside JSON strings are escaped and no nested object has a lastrevid, so any match is the
+    entity's own.
+    """
+
+    # lastrevid is usually at the end of the line in the dumps
+    start = line.rfind(b'"lastrevid"')
+    if start == -1:
+        return None
+
+    match = _lastrevid_regex.match(line, start)
+
+    return int(match.group(1)) if match else None
+
+
+def _line_head(line: bytes) -> bytes:
+    """
+    Returns the start of the line, up to the first nested object. Fields found in it belong to the
+    top level of the entity.
+    """
+
+    head_end = line.find(b"{", 1)
+
+    return line[:head_end] if head_end > 0 else line
+
+
+def _search(regex, head: bytes) -> str:
+    match = regex.search(head)
+
+    return match.group(1).decode("ascii") if match else None
@@ -1,9 +1,15 @@
 import requests
 import sys
+import threading
+import time
 from urllib.parse import quote
 from elastic_wikidata import __version__ as ew_version
+from elastic_wikidata import metrics, serialization
 from elastic_wikidata.config import runtime_config
 
+# statuses of responses which are retried: throttling, and server and gateway errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
 
 def generate_user_agent():
     """
@@ -61,3 +67,152 @@ def process_user_agent_username(username=None):
         if "%" in username:
             username = quote(username)
     return username
+
+
+class RateLimiter:
+    def __init__(self, max_requests_per_second: float = None):
+        """
+        Rate limiter shared between the threads making requests to Wikimedia APIs. When any thread is
+        told to back off (through a `Retry-After` header or a `maxlag` error), every thread waits until
+        the pause is over before sending its next request.
+
+        Args:
+            max_requests_per_second (float, optional): optional cap on the rate at which requests are sent
+        """
+
+        self.min_interval = (
+            1 / max_requests_per_second if max_requests_per_second else 0
+        )
+        self._lock = threading.Lock()
+        self._next_request_time = 0
+
+    def wait(self):
+        """
+        Blocks until a request can be sent.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            request_time = max(now, self._next_request_time)
+            self._next_request_time = request_time + self.min_interval
+
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def pause(self, seconds: float):
+        """
+        Stops all requests from being sent for `seconds`.
+        """
+
+        with self._lock:
+            self._next_request_time = max(
+                self._next_request_time, time.monotonic() + seconds
+            )
+
+
+def retry_after_seconds(headers: dict, default: float) -> float:
+    """
+    Returns the number of seconds to wait from a `Retry-After` header, or `default` if there isn't one
+    or it isn't a number of seconds.
+    """
+
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_with_backoff(
+    session: requests.Session,
+    url: str,
+    rate_limiter: RateLimiter,
+    max_retries: int = 5,
+    service: str = "wikidata",
+    **kwargs,
+) -> dict:
+    """
+    Makes a GET request to the MediaWiki API and returns the parsed JSON response, retrying as described
+    in `request_with_backoff`.
+
+    Returns:
+        dict: parsed JSON response
+    """
+
+    result, _ = request_with_backoff(
+        session, url, rate_limiter, max_retries, service, **kwargs
+    )
+
+    return result
+
+
+def request_with_backoff(
+    session: requests.Session,
+    url: str,
+    rate_limiter: RateLimiter,
+    max_retries: int = 5,
+    service: str = "wikidata",
+    data: dict = None,
+    **kwargs,
+) -> tuple:
+    """
+    Makes a request to the MediaWiki API and returns the parsed JSON response. Follows Wikimedia's
+    conventions for bulk requests: on HTTP 429 and 5xx responses (see `RETRY_STATUSES`) and `maxlag` errors
+    the request is retried after the time given by the `Retry-After` header, or with exponential backoff if
+    there isn't one, and all other requests through `rate_limiter` pause too. Connection errors and timeouts
+    are retried with exponential backoff. Other error statuses raise a `requests.HTTPError`.
+
+    Args:
+        session (requests.Session)
+        url (str)
+        rate_limiter (RateLimiter)
+        max_retries (int, optional): Defaults to 5.
+        service (str, optional): name of the service in the metrics of bytes read and retries. Defaults to 'wikidata'.
+        data (dict, optional): parameters to POST as a form, for requests too long for a URL. The request is
+            a GET if not given. Defaults to None.
+        **kwargs: passed to `session.get` or `session.post`
+
+    Returns:
+        tuple: (parsed JSON response, size of the response in bytes)
+    """
+
+    recorder = metrics.current()
+
+    for attempt in range(max_retries + 1):
+        backoff = min(60, 2**attempt)
+        rate_limiter.wait()
+
+        try:
+            if data is None:
+                response = session.get(url, **kwargs)
+            else:
+                response = session.post(url, data=data, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            recorder.inc("retries_total", service=service, reason="connection")
+            rate_limiter.pause(backoff)
+            continue
+
+        recorder.inc("bytes_in_total", len(response.content), source=service)
+
+        if response.status_code in RETRY_STATUSES:
+            if attempt == max_retries:
+                response.raise_for_status()
+            recorder.inc(
+                "retries_total", service=service, reason=str(response.status_code)
+            )
+            rate_limiter.pause(retry_after_seconds(response.headers, backoff))
+            continue
+
+        # error pages, e.g. from the Wikimedia edge, aren't JSON
+        response.raise_for_status()
+        result = serialization.loads(response.content)
+
+        if result.get("error", {}).get("code") == "maxlag":
+            if attempt == max_retries:
+                raise requests.exceptions.RetryError(result["error"].get("info"))
+            recorder.inc("retries_total", service=service, reason="maxlag")
+            rate_limiter.pause(retry_after_seconds(response.headers, backoff))
+            continue
+
+        return result, len(response.content)
@@ -0,0 +1,122 @@
+import re
+import time
+from elasticsearch import Elasticsearch
+
+# settings for an index while it's being built and nothing is searching it: no replicas to copy documents
+# to, no refreshes, and the translog is synced to disk in the background rather than on every request
+BUILD_SETTINGS = {
+    "index": {
+        "number_of_replicas": 0,
+        "refresh_interval": -1,
+        "translog": {"durability": "async"},
+    }
+}
+
+
+def versioned_index_name(alias: str) -> str:
+    """
+    Returns a new index name for `alias` with the current UTC time, e.g. 'wikidata-20200801-120000'.
+    """
+
+    return f"{alias}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}"
+
+
+def get_versions(es: Elasticsearch, alias: str) -> list:
+    """
+    Returns the names of the versioned indices for `alias`, oldest first.
+    """
+
+    pattern = re.compile(re.escape(alias) + r"-\d{8}-\d{6}")
+    indices = es.indices.get(index=f"{alias}-*", ignore_unavailable=True)
+
+    return sorted(name for name in indices if pattern.fullmatch(name))
+
+
+def get_aliased_indices(es: Elasticsearch, alias: str) -> list:
+    """
+    Returns the names of the indices `alias` currently points to.
+    """
+
+    if not es.indices.exists_alias(name=alias):
+        return []
+
+    return list(es.indices.get_alias(name=alias).keys())
+
+
+def finish_build(
+    es: Elasticsearch,
+    index: str,
+    alias: str,
+    forcemerge: bool = False,
+    keep_versions: int = 2,
+):
+    """
+    Makes an index built with `BUILD_SETTINGS` ready to search and points `alias` at it. Replicas are
+    restored to the number used by the index `alias` pointed to before (1 if there wasn't one), and refresh
+    interval and translog durability are reset to their defaults. The alias is then moved in a single request,
+    so searches go to either the old index or the new one and never to neither.
+
+    If `alias` is the name of an existing index rather than an alias, that index is deleted in the same request.
+
+    Args:
+        es (Elasticsearch)
+        index (str): the newly built index
+        alias (str)
+        forcemerge (bool, optional): merge the index into one segment before moving the alias. Defaults to False.
+        keep_versions (int, optional): number of versioned indices to keep, including the new one. Older ones
+            are deleted. Defaults to 2, so the previous version can be restored by moving the alias back.
+    """
+
+    previous = get_aliased_indices(es, alias)
+    replicas = 1
+
+    if previous:
+        settings = es.indices.get_settings(
+            index=previous[0], name="index.number_of_replicas"
+        )
+        replicas = int(
+            settings[previous[0]]["settings"]["index"].get("number_of_replicas", 1)
+        )
+
+    print(f"Restoring {replicas} replica(s) and refresh for {index}")
+    es.indices.put_settings(
+        index=index,
+        body={
+            "index": {
+                "number_of_replicas": replicas,
+                "refresh_interval": None,
+                "translog": {"durability": None},
+            }
+        },
+    )
+    es.indices.refresh(index=index)
+
+    if forcemerge:
+        print(f"Force merging {index}. This can take a long time for large indices.")
+        es.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+
+    actions = [{"remove": {"index": i, "alias": alias}} for i in previous]
+    if not previous and es.indices.exists(index=alias):
+        print(f"Replacing index {alias} with an alias to {index}")
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index, "alias": alias}})
+
+    es.indices.update_aliases(body={"actions": actions})
+    print(f"{alias} now points to {index}")
+
+    prune_versions(es, alias, keep_versions)
+
+
+def prune_versions(es: Elasticsearch, alias: str, keep_versions: int):
+    """
+    Deletes all but the newest `keep_versions` versioned indices for `alias`. Indices the alias points
+    to are never deleted.
+    """
+
+    aliased = set(get_aliased_indices(es, alias))
+    versions = get_versions(es, alias)
+
+    for index in versions[: max(0, len(versions) - keep_versions)]:
+        if index not in aliased:
+            print(f"Deleting old index {index}")
+            es.indices.delete(index=index)
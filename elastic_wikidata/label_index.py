@@ -0,0 +1,374 @@
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from itertools import islice
+from typing import Iterable, Iterator, List
+from tqdm.auto import tqdm
+from elastic_wikidata import serialization
+from elastic_wikidata.dump_reader import read_dump_lines
+from elastic_wikidata.labels import prescan_label, _label_regex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"EWLABEL1"
+
+# magic, number of entries, then the offsets in the file of the sorted keys, the label offsets, the
+# permutation of entries sorted by label, and the label blob
+_header = struct.Struct("<8s5Q")
+
+# keys are unsigned 32-bit integers: the number of an item, or of a property with this bit set
+_PROPERTY_BIT = 1 << 31
+
+
+def _key(qid: str) -> int:
+    """
+    Returns the key of an item or property ID, or None for other IDs.
+    """
+
+    prefix, number = qid[:1], qid[1:]
+    if not number.isdigit():
+        return None
+
+    if prefix == "Q":
+        return int(number)
+    if prefix == "P":
+        return int(number) | _PROPERTY_BIT
+
+    return None
+
+
+def _qid(key: int) -> str:
+    if key & _PROPERTY_BIT:
+        return f"P{key & ~_PROPERTY_BIT}"
+
+    return f"Q{key}"
+
+
+class LabelIndex:
+    def __init__(self, path: str):
+        """
+        Opens a label index written by `build_label_index`. The file is memory-mapped, so opening it is
+        instant and only the pages that lookups touch are read from disk. Lookups by ID are binary searches
+        over the sorted keys, O(log n); `get_labels` looks up many IDs at once. Labels can also be looked up
+        the other way with `find`.
+
+        The index has a `get_labels` method, so it can be used as the source of a `labels.LabelEnricher`,
+        or passed as `label_source` to `get_entities.get_labels` and `simplify_wbgetentities_result`.
+
+        Args:
+            path (str): path to the index
+        """
+
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n, keys_at, offsets_at, by_label_at, blob_at = _header.unpack_from(
+            self._mmap
+        )
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} isn't a label index")
+
+        view = memoryview(self._mmap)
+        self._n = n
+        self._keys = view[keys_at : keys_at + 4 * n].cast("I")
+        self._offsets = view[offsets_at : offsets_at + 8 * (n + 1)].cast("Q")
+        self._by_label = view[by_label_at : by_label_at + 4 * n].cast("I")
+        self._blob = view[blob_at:]
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __contains__(self, qid: str) -> bool:
+        return self._find_key(_key(qid)) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # reopened from the path when pickled, e.g. to send to dump worker processes
+    def __getstate__(self) -> dict:
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["path"])
+
+    def close(self):
+        for name in ("_keys", "_offsets", "_by_label", "_blob"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+
+        self._mmap.close()
+        self._file.close()
+
+    def get(self, qid: str) -> str:
+        """
+        Returns the label of an item or property, or None if it isn't in the index.
+        """
+
+        i = self._find_key(_key(qid))
+
+        return None if i is None else self._label_at(i)
+
+    def get_labels(self, qids: Iterable[str]) -> dict:
+        """
+        Returns {qid: label} for each of `qids` in the index. IDs are looked up in sorted order, each search
+        starting where the previous one ended, or all at once with numpy if it's installed.
+        """
+
+        keyed = sorted(
+            (key, qid) for qid in set(qids) for key in [_key(qid)] if key is not None
+        )
+        if not keyed:
+            return {}
+
+        if numpy is not None:
+            keys = numpy.frombuffer(self._keys, dtype=numpy.uint32)
+            wanted = numpy.array([key for key, _ in keyed], dtype=numpy.uint32)
+            positions = numpy.searchsorted(keys, wanted).tolist()
+        else:
+            positions, lo = [], 0
+            for key, _ in keyed:
+                lo = self._bisect(key, lo)
+                positions.append(lo)
+
+        labels = {}
+        for (key, qid), i in zip(keyed, positions):
+            if i < self._n and self._keys[i] == key:
+                labels[qid] = self._label_at(i)
+
+        return labels
+
+    def find(self, label: str) -> List[str]:
+        """
+        Returns the IDs of the entities with exactly this label, in ID order.
+        """
+
+        target = label.encode("utf-8")
+        lo, hi = 0, self._n
+
+        # leftmost position in the label order whose label isn't less than `target`
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._label_bytes(self._by_label[mid]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        qids = []
+        while lo < self._n and self._label_bytes(self._by_label[lo]) == target:
+            qids.append(_qid(self._keys[self._by_label[lo]]))
+            lo += 1
+
+        return qids
+
+    def items(self) -> Iterator[tuple]:
+        """
+        Yields (qid, label) in ID order.
+        """
+
+        for i in range(self._n):
+            yield _qid(self._keys[i]), self._label_at(i)
+
+    def _bisect(self, key: int, lo: int = 0) -> int:
+        hi = self._n
+        keys = self._keys
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys[mid] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _find_key(self, key: int) -> int:
+        if key is None:
+            return None
+
+        i = self._bisect(key)
+
+        return i if i < self._n and self._keys[i] == key else None
+
+    def _label_bytes(self, i: int) -> bytes:
+        return bytes(self._blob[self._offsets[i] : self._offsets[i + 1]])
+
+    def _label_at(self, i: int) -> str:
+        return self._label_bytes(i).decode("utf-8")
+
+
+def build_label_index(
+    dump_path: str,
+    index_path: str,
+    lang: str,
+    use_external_decompressor: bool = True,
+    chunk_size: int = 1_000_000,
+) -> int:
+    """
+    Builds a `LabelIndex` of the labels in `lang` of the items and properties in a dump. Labels are picked out
+    of the raw dump lines (see `labels.prescan_label`) and sorted on disk, `chunk_size` at a time, so memory
+    use doesn't depend on the size of the dump. If an ID appears more than once, only one of its labels is
+    kept.
+
+    The index holds the keys as a sorted array of 32-bit integers, an array of 64-bit offsets into a blob of
+    UTF-8 labels, and a permutation of the entries sorted by label for looking up IDs by label.
+
+    Args:
+        dump_path (str): path to the dump, or to a directory of shards
+        index_path (str): path to write the index to
+        lang (str): Wikimedia language code
+        use_external_decompressor (bool, optional): see `dump_reader.open_dump`. Defaults to True.
+        chunk_size (int, optional): number of labels sorted in memory at once. Defaults to 1,000,000.
+
+    Returns:
+        int: number of labels in the index
+    """
+
+    label_regex = _label_regex(lang)
+    tmp_dir = tempfile.mkdtemp(
+        prefix="label-index-", dir=os.path.dirname(os.path.abspath(index_path))
+    )
+
+    try:
+        lines = tqdm(
+            read_dump_lines(dump_path, use_external_decompressor),
+            desc="Reading labels",
+            unit=" entities",
+        )
+        labels = (
+            (_key(qid), label)
+            for qid, label in (prescan_label(line, lang, label_regex) for line in lines)
+            if qid is not None and label is not None and _key(qid) is not None
+        )
+        by_key = _external_sort(labels, tmp_dir, "key", chunk_size)
+
+        n = _write_index(by_key, index_path, tmp_dir, chunk_size)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print(f"Wrote {n} labels in {lang} to {index_path}")
+
+    return n
+
+
+def _external_sort(
+    items: Iterable[tuple], tmp_dir: str, name: str, chunk_size: int
+) -> Iterator[tuple]:
+    """
+    Sorts (key, value) pairs of JSON-serializable values by key, holding at most `chunk_size` in memory.
+    Sorted runs are written to `tmp_dir` and merged.
+    """
+
+    runs = []
+    iterator = iter(items)
+
+    while True:
+        chunk = sorted(islice(iterator, chunk_size))
+        if not chunk:
+            break
+
+        path = os.path.join(tmp_dir, f"{name}-{len(runs)}.ndjson")
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(serialization.dumps(pair) + "\n" for pair in chunk)
+        runs.append(path)
+
+    def read_run(path: str) -> Iterator[tuple]:
+        with open(path, "rb") as f:
+            for line in f:
+                yield tuple(serialization.loads_line(line))
+
+    return heapq.merge(*[read_run(path) for path in runs])
+
+
+def _write_index(
+    by_key: Iterator[tuple], index_path: str, tmp_dir: str, chunk_size: int
+) -> int:
+    """
+    Writes the sections of the index to temporary files from (key, label) pairs sorted by key, then joins
+    them into `index_path`.
+    """
+
+    paths = {
+        section: os.path.join(tmp_dir, section)
+        for section in ("keys", "offsets", "by_label", "blob")
+    }
+    n, blob_size, last_key = 0, 0, None
+
+    def entries_by_label() -> Iterator[tuple]:
+        nonlocal n, blob_size, last_key
+
+        keys, offsets = array("I"), array("Q", [0])
+
+        with open(paths["keys"], "wb") as keys_file, open(
+            paths["offsets"], "wb"
+        ) as offsets_file, open(paths["blob"], "wb") as blob_file:
+            for key, label in by_key:
+                if key == last_key:
+                    continue
+                last_key = key
+
+                encoded = label.encode("utf-8")
+                blob_file.write(encoded)
+                blob_size += len(encoded)
+                keys.append(key)
+                offsets.append(blob_size)
+
+                yield label, n
+                n += 1
+
+                if len(keys) >= chunk_size:
+                    keys.tofile(keys_file)
+                    offsets.tofile(offsets_file)
+                    keys, offsets = array("I"), array("Q")
+
+            keys.tofile(keys_file)
+            offsets.tofile(offsets_file)
+
+    # entries are sorted by the UTF-8 bytes of their labels, which is the order `LabelIndex.find` searches in
+    with open(paths["by_label"], "wb") as f:
+        buffer = array("I")
+        for _, i in _external_sort(
+            ((label.encode("utf-8").hex(), i) for label, i in entries_by_label()),
+            tmp_dir,
+            "label",
+            chunk_size,
+        ):
+            buffer.append(i)
+            if len(buffer) >= chunk_size:
+                buffer.tofile(f)
+                buffer = array("I")
+        buffer.tofile(f)
+
+    keys_at = _header.size
+    offsets_at = keys_at + 4 * n + (4 * n) % 8
+    by_label_at = offsets_at + 8 * (n + 1)
+    blob_at = by_label_at + 4 * n
+
+    tmp_index_path = f"{index_path}.tmp"
+    with open(tmp_index_path, "wb") as out:
+        out.write(_header.pack(MAGIC, n, keys_at, offsets_at, by_label_at, blob_at))
+        for section, start in (
+            ("keys", keys_at),
+            ("offsets", offsets_at),
+            ("by_label", by_label_at),
+            ("blob", blob_at),
+        ):
+            out.write(b"\0" * (start - out.tell()))
+            with open(paths[section], "rb") as f:
+                shutil.copyfileobj(f, out)
+
+    os.replace(tmp_index_path, index_path)
+
+    return n
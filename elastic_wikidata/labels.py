@@ -0,0 +1,273 @@
+import re
+from collections import OrderedDict
+from typing import Iterable, Iterator
+from tqdm.auto import tqdm
+from elastic_wikidata import serialization
+from elastic_wikidata.dump_reader import read_dump_lines
+from elastic_wikidata.entity_filter import prescan_id
+from elastic_wikidata.pipeline import batched
+from elastic_wikidata.wd_entities import (
+    get_entities,
+    add_claim_labels,
+    claim_entity_ids,
+)
+
+# returned by the cache for IDs it doesn't have, as None is cached for entities without a label
+_MISSING = object()
+
+# keys that can follow "labels" at the top level of an entity in the dumps
+_after_labels = (b'"descriptions"', b'"aliases"', b'"claims"', b'"sitelinks"')
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 100_000):
+        """
+        Dictionary holding at most `maxsize` items, dropping the least recently used item when full.
+
+        Args:
+            maxsize (int, optional): Defaults to 100,000.
+        """
+
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class LabelTable:
+    def __init__(self):
+        """
+        QID -> label table held in memory. Item IDs are stored as integers, which take much less memory
+        than strings when there are millions of them. Build one from a dump with `from_dump`.
+        """
+
+        self._items = {}
+        self._other = {}
+
+    def add(self, qid: str, label: str):
+        if qid[0] == "Q":
+            self._items[int(qid[1:])] = label
+        else:
+            self._other[qid] = label
+
+    def get(self, qid: str) -> str:
+        if qid[0] == "Q":
+            return self._items.get(int(qid[1:]))
+
+        return self._other.get(qid)
+
+    def get_labels(self, qids: Iterable[str]) -> dict:
+        """
+        Returns {qid: label} for each of `qids` with a label in the table.
+        """
+
+        labels = {}
+
+        for qid in qids:
+            label = self.get(qid)
+            if label is not None:
+                labels[qid] = label
+
+        return labels
+
+    def __len__(self) -> int:
+        return len(self._items) + len(self._other)
+
+    @classmethod
+    def from_dump(
+        cls, path: str, lang: str, use_external_decompressor: bool = True
+    ) -> "LabelTable":
+        """
+        Reads the label in `lang` of every entity in a dump. Labels are found in the raw lines where
+        possible, which is much faster than parsing them.
+
+        Args:
+            path (str): path to the dump, or to a directory of shards
+            lang (str): Wikimedia language code
+            use_external_decompressor (bool, optional): see `dump_reader.open_dump`. Defaults to True.
+        """
+
+        table = cls()
+        label_regex = _label_regex(lang)
+
+        for line in tqdm(
+            read_dump_lines(path, use_external_decompressor),
+            desc="Reading labels",
+            unit=" entities",
+        ):
+            qid, label = prescan_label(line, lang, label_regex)
+            if qid is not None and label is not None:
+                table.add(qid, label)
+
+        print(f"Read {len(table)} labels in {lang} from {path}")
+
+        return table
+
+
+def _label_regex(lang: str):
+    # {"en":{"language":"en","value":"..."}, with the quotes in the value escaped
+    code = re.escape(lang.encode("utf-8"))
+
+    return re.compile(
+        rb'"'
+        + code
+        + rb'"\s*:\s*\{\s*"language"\s*:\s*"'
+        + code
+        + rb'"\s*,\s*"value"\s*:\s*"((?:[^"\\]|\\.)*)"'
+    )
+
+
+def prescan_label(line: bytes, lang: str, label_regex=None) -> tuple:
+    """
+    Returns (id, label in `lang`) of the entity on a dump line, with a label of None if it doesn't have one.
+    The label is searched for between the "labels" key and the next top-level key, and the line is only
+    parsed if it isn't laid out like the dumps.
+    """
+
+    label_regex = label_regex or _label_regex(lang)
+    start = line.find(b'"labels"')
+    qid = prescan_id(line)
+
+    if start == -1 or qid is None:
+        doc = serialization.loads_line(line)
+        labels = doc.get("labels") or {}
+
+        return doc.get("id"), labels[lang]["value"] if lang in labels else None
+
+    ends = [line.find(key, start) for key in _after_labels]
+    end = min([e for e in ends if e != -1], default=len(line))
+    match = label_regex.search(line, start, end)
+
+    if match is None:
+        return qid, None
+
+    value = match.group(1)
+    if b"\\" in value:
+        return qid, serialization.loads(b'"' + value + b'"')
+
+    return qid, value.decode("utf-8")
+
+
+class APILabelSource:
+    def __init__(self, lang: str, page_limit: int = None, workers: int = 1):
+        """
+        Fetches labels from the wbgetentities API, requesting only the labels of each entity. Uses the
+        entity cache set in `runtime_config`, if any.
+
+        Args:
+            lang (str): Wikimedia language code
+            page_limit (int, optional): maximum IDs per request. Defaults to `get_entities.result_generator`'s.
+            workers (int, optional): concurrent requests. Defaults to 1.
+        """
+
+        self.lang = lang
+        self.page_limit = page_limit
+        self.workers = workers
+
+    def get_labels(self, qids: Iterable[str]) -> dict:
+        """
+        Returns {qid: label} for each of `qids` with a label in `self.lang`.
+        """
+
+        labels = {}
+        pages = get_entities.result_generator(
+            list(qids),
+            lang=self.lang,
+            page_limit=self.page_limit,
+            workers=self.workers,
+            props=["labels"],
+        )
+
+        for page in pages:
+            for doc in page:
+                label = (doc.get("labels") or {}).get(self.lang)
+                if label:
+                    qid = doc["redirects"]["from"] if "redirects" in doc else doc["id"]
+                    labels[qid] = label["value"]
+
+        return labels
+
+
+class LabelEnricher:
+    def __init__(self, source, window: int = 1000, cache_size: int = 100_000):
+        """
+        Adds the labels of the entities that claims refer to, so that e.g. P31 = Q5 can be found by
+        searching for 'human'. Documents are enriched in windows of `window`: the entity IDs in a window's
+        claims are collected, deduplicated and looked up in an LRU cache, and only the IDs not in the cache
+        are requested from `source`, in one batch. The same few targets (Q5, countries) are referred to
+        by millions of entities, so most lookups are cache hits.
+
+        Labels are added next to the IDs: in `claim_labels` ({property: [labels]}, in the same order as the
+        values in `claims`, with None for values without a label), or as `label` on each statement with rich
+        claims.
+
+        Args:
+            source: anything with a `get_labels(qids) -> {qid: label}` method, such as an `APILabelSource`,
+                a `LabelTable` or a `label_index.LabelIndex`
+            window (int, optional): number of documents to collect IDs from before looking them up.
+                Defaults to 1000.
+            cache_size (int, optional): number of labels to keep in the LRU cache. Defaults to 100,000.
+        """
+
+        self.source = source
+        self.window = window
+        self.cache = LRUCache(cache_size)
+
+    def enrich(self, docs: Iterable[dict]) -> Iterator[dict]:
+        """
+        Yields each of `docs` with labels added. Actions without claims, such as deletes, are passed through.
+        """
+
+        for batch in batched(docs, self.window):
+            labels = self._resolve(claim_entity_ids(batch))
+
+            for doc in batch:
+                if doc.get("claims"):
+                    add_claim_labels(doc, labels)
+                yield doc
+
+    def _resolve(self, qids: set) -> dict:
+        labels = {}
+        misses = []
+
+        for qid in qids:
+            label = self.cache.get(qid, _MISSING)
+            if label is _MISSING:
+                misses.append(qid)
+            else:
+                labels[qid] = label
+
+        if misses:
+            fetched = self.source.get_labels(misses)
+
+            # entities without a label are cached too, so they aren't requested again
+            for qid in misses:
+                labels[qid] = fetched.get(qid)
+                self.cache.put(qid, labels[qid])
+
+        return labels
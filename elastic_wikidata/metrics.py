@@ -0,0 +1,497 @@
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from elastic_wikidata.config import runtime_config
+
+# upper bounds, in seconds, of the buckets of latency histograms
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+# descriptions of the metrics recorded by elastic-wikidata, shown in the Prometheus exposition
+DESCRIPTIONS = {
+    "entities_total": "Entities handled by each stage",
+    "failed_total": "Entities which failed in each stage",
+    "stage_seconds": "Time taken by each batch or request of a stage",
+    "bytes_in_total": "Bytes read from each source",
+    "bytes_out_total": "Bytes sent to each sink",
+    "retries_total": "Requests retried, by service and reason",
+    "coalesced_total": "Entities taken from a request already in flight rather than requested again",
+    "queue_depth": "Items waiting in each queue between stages",
+}
+
+
+class Metrics:
+    def __init__(self, prefix: str = "ew", buckets: tuple = LATENCY_BUCKETS):
+        """
+        Thread-safe registry of counters, gauges and histograms, each identified by a name and labels,
+        e.g. `inc("entities_total", 1000, stage="parse")`. Stages record into the registry set in
+        `runtime_config` as 'metrics' (see `current` and `collect`), per batch, page or request rather than
+        per entity.
+
+        Args:
+            prefix (str, optional): prefix of metric names in the Prometheus exposition. Defaults to 'ew'.
+            buckets (tuple, optional): upper bounds of histogram buckets. Defaults to `LATENCY_BUCKETS`.
+        """
+
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.started = time.monotonic()
+
+        self._counters = {}
+        self._gauges = {}
+        # {key: [count in each bucket, then above the last bucket, sum, count]}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Adds `value` to a counter.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """
+        Sets a gauge.
+        """
+
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Adds an observation, e.g. a latency in seconds, to a histogram.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect_left(self.buckets, value)
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 3)
+
+            histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes the time taken by the body of a `with` block.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current values as {'counters', 'gauges', 'histograms'}, each {name: {labels: value}},
+        where labels are written as 'stage=parse' (or '' for none). Histograms are summarised by their count,
+        sum and estimated 50th, 95th and 99th percentiles.
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: list(h) for key, h in self._histograms.items()}
+
+        def grouped(values: dict) -> dict:
+            result = {}
+            for (name, labels), value in sorted(values.items()):
+                result.setdefault(name, {})[
+                    ",".join(f"{k}={v}" for k, v in labels)
+                ] = value
+            return result
+
+        return {
+            "counters": grouped(counters),
+            "gauges": grouped(gauges),
+            "histograms": grouped(
+                {
+                    key: {
+                        "count": h[-1],
+                        "sum": h[-2],
+                        "p50": self._quantile(h, 0.5),
+                        "p95": self._quantile(h, 0.95),
+                        "p99": self._quantile(h, 0.99),
+                    }
+                    for key, h in histograms.items()
+                }
+            ),
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+
+        with self._lock:
+            series = [
+                ("counter", self._counters),
+                ("gauge", self._gauges),
+                ("histogram", {k: list(h) for k, h in self._histograms.items()}),
+            ]
+
+        lines = []
+
+        for kind, values in series:
+            last_name = None
+
+            for (name, labels), value in sorted(values.items()):
+                full_name = f"{self.prefix}_{name}"
+
+                if name != last_name:
+                    if name in DESCRIPTIONS:
+                        lines.append(f"# HELP {full_name} {DESCRIPTIONS[name]}")
+                    lines.append(f"# TYPE {full_name} {kind}")
+                    last_name = name
+
+                if kind != "histogram":
+                    lines.append(f"{full_name}{_labels(labels)} {_number(value)}")
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), value[:-2]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _number(bound)
+                    lines.append(
+                        f"{full_name}_bucket{_labels(labels + (('le', le),))} {cumulative}"
+                    )
+                lines.append(f"{full_name}_sum{_labels(labels)} {_number(value[-2])}")
+                lines.append(f"{full_name}_count{_labels(labels)} {value[-1]}")
+
+        return "\n".join(lines) + "\n"
+
+    def _quantile(self, histogram: list, q: float) -> float:
+        """
+        Estimates a quantile from a histogram by interpolating within the bucket it falls in, as Prometheus'
+        histogram_quantile does. Returns None for an empty histogram.
+        """
+
+        total = histogram[-1]
+        if not total:
+            return None
+
+        rank = q * total
+        cumulative = 0
+
+        for i, count in enumerate(histogram[:-2]):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    # above the last bucket, which has no upper bound
+                    return self.buckets[-1]
+
+                lower = self.buckets[i - 1] if i > 0 else 0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+
+            cumulative += count
+
+        return self.buckets[-1]
+
+
+class _NoMetrics(Metrics):
+    """
+    Registry used when metrics aren't being collected, which doesn't record anything.
+    """
+
+    def inc(self, name: str, value: float = 1, **labels):
+        pass
+
+    def set(self, name: str, value: float, **labels):
+        pass
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+
+_no_metrics = _NoMetrics()
+
+
+def current() -> Metrics:
+    """
+    Returns the registry set in `runtime_config` as 'metrics', or one which doesn't record anything.
+    """
+
+    return runtime_config.get("metrics") or _no_metrics
+
+
+def record_stage(stage: str, entities: int, seconds: float = None):
+    """
+    Records a batch of `entities` handled by a stage in `seconds`.
+    """
+
+    metrics = current()
+    metrics.inc("entities_total", entities, stage=stage)
+
+    if seconds is not None:
+        metrics.observe("stage_seconds", seconds, stage=stage)
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def serve_prometheus(
+    metrics: Metrics, port: int, host: str = "127.0.0.1"
+) -> HTTPServer:
+    """
+    Serves the metrics for Prometheus to scrape at http://host:port/metrics from a background thread.
+    Call `shutdown` on the returned server to stop it.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+
+    return server
+
+
+class JSONLogger:
+    def __init__(self, metrics: Metrics, path: str, interval: float = 10):
+        """
+        Appends a snapshot of the metrics to a newline-delimited JSON file every `interval` seconds from a
+        background thread, and once more when stopped. Each record also has the rate per second of each
+        counter over the interval, e.g. the throughput of each stage.
+
+        Args:
+            metrics (Metrics)
+            path (str): file to append to, or '-' for stdout
+            interval (float, optional): seconds. Defaults to 10.
+        """
+
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+
+        self._last = ({}, time.monotonic())
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-logger", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def write(self):
+        snapshot = self.metrics.snapshot()
+        now = time.monotonic()
+        last_counters, last_time = self._last
+        seconds = max(now - last_time, 1e-9)
+
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "elapsed": round(now - self.metrics.started, 3),
+            **snapshot,
+            "rates": {
+                name: {
+                    labels: (value - last_counters.get(name, {}).get(labels, 0))
+                    / seconds
+                    for labels, value in values.items()
+                }
+                for name, values in snapshot["counters"].items()
+            },
+        }
+        self._last = (snapshot["counters"], now)
+
+        line = json.dumps(record) + "\n"
+        if self.path == "-":
+            sys.stdout.write(line)
+        else:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+
+@contextmanager
+def collect(port: int = None, log_path: str = None, interval: float = 10):
+    """
+    Collects metrics for the body of a `with` block, setting a new `Metrics` registry in `runtime_config`.
+    They're served for Prometheus if `port` is given, and logged to `log_path` every `interval` seconds if
+    it's given.
+
+    Yields:
+        Metrics
+    """
+
+    metrics = Metrics()
+    previous = runtime_config.get("metrics")
+    runtime_config.add_item({"metrics": metrics})
+
+    server = None
+    logger = None
+
+    try:
+        if port is not None:
+            server = serve_prometheus(metrics, port)
+            print(f"Serving metrics at http://127.0.0.1:{port}/metrics")
+        if log_path:
+            logger = JSONLogger(metrics, log_path, interval)
+            logger.start()
+
+        yield metrics
+    finally:
+        if logger is not None:
+            logger.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        runtime_config.add_item({"metrics": previous})
+
+
+class SamplingProfiler:
+    def __init__(self, path: str, interval: float = 0.005):
+        """
+        Statistical profiler which samples the stack of every thread each `interval` seconds, and writes
+        the number of times each stack was seen in the collapsed format read by flamegraph.pl, speedscope
+        and inferno (the same format as `py-spy record --format raw`). Unlike cProfile it sees every thread,
+        such as the bulk request and fetch threads, and adds little overhead, but not worker processes:
+        attach py-spy with --subprocesses for those.
+
+        Args:
+            path (str): file to write the stacks to
+            interval (float, optional): seconds between samples. Defaults to 0.005.
+        """
+
+        self.path = path
+        self.interval = interval
+        self.samples = Counter()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="sampling-profiler", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+        with open(self.path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def _run(self):
+        own_id = threading.get_ident()
+
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+
+@contextmanager
+def profile(path: str, mode: str = "cprofile", interval: float = 0.005):
+    """
+    Profiles the body of a `with` block. With 'cprofile' the statistics of the main thread are written to
+    `path` (open them with pstats or snakeviz) and the functions with the most cumulative time are printed.
+    With 'sample' stacks of every thread are sampled with a `SamplingProfiler`.
+    """
+
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(
+                20
+            )
+            print(summary.getvalue())
+            print(f"Profile written to {path}")
+    elif mode == "sample":
+        profiler = SamplingProfiler(path, interval)
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            print(
+                f"Sampled stacks written to {path} ({sum(profiler.samples.values())} samples)"
+            )
+    else:
+        raise ValueError("mode must be 'cprofile' or 'sample'")
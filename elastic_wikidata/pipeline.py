@@ -0,0 +1,85 @@
+import queue
+import threading
+from itertools import islice
+from typing import Iterable, Iterator
+from elastic_wikidata import metrics
+
+
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    """
+    Yields lists of length `n` from `iterable`. The last list may be shorter.
+    """
+
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(islice(iterator, n))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def prefetch(iterable: Iterable, maxsize: int, name: str = None) -> Iterator:
+    """
+    Iterates over `iterable` in a background thread, so that the stage producing items runs at the same
+    time as the stage consuming them. At most `maxsize` items are held in the queue between them: when it's
+    full the producer waits, so a slow consumer slows down the producer rather than using more memory.
+
+    Exceptions raised by the producer are raised by the consumer. If the consumer stops early, the producer
+    stops at the next item and `iterable` is closed.
+
+    If `name` is given, the number of items in the queue is recorded in the metrics as the depth of the
+    queue with that name, and the producer thread is named after it.
+    """
+
+    depth = metrics.current() if name else None
+
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(message: tuple) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+
+        try:
+            for item in iterator:
+                if not put(("item", item)):
+                    return
+            put(("end", None))
+        except BaseException as e:
+            put(("error", e))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    producer = threading.Thread(
+        target=produce, name=f"prefetch-{name}" if name else None, daemon=True
+    )
+    producer.start()
+
+    try:
+        while True:
+            kind, item = items.get()
+
+            if depth is not None:
+                depth.set("queue_depth", items.qsize(), queue=name)
+
+            if kind == "end":
+                return
+            if kind == "error":
+                raise item
+
+            yield item
+    finally:
+        stop.set()
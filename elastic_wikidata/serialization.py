@@ -0,0 +1,144 @@
+import json
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# whitespace and the trailing comma of array-wrapped dumps, as byte values
+_line_endings = frozenset(b" \t\r\n,")
+_decoder = json.JSONDecoder()
+
+
+def _json_loads(s):
+    return json.loads(s)
+
+
+def _json_dumps(obj, default=None) -> str:
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":"))
+
+
+def _json_loads_line(line: bytes) -> dict:
+    # decoding stops at the end of the JSON object, so the trailing comma is ignored without slicing
+    s = line.decode("utf-8")
+
+    if s[:1] != "{":
+        s = s.lstrip()
+
+    return _decoder.raw_decode(s)[0]
+
+
+def _orjson_dumps(obj, default=None) -> str:
+    return orjson.dumps(obj, default=default).decode("utf-8")
+
+
+def _orjson_loads_line(line: bytes) -> dict:
+    # orjson reads memoryviews, so the trailing comma is dropped without copying the line
+    return orjson.loads(memoryview(line)[: _line_end(line)])
+
+
+def _simdjson_loads_line(line: bytes) -> dict:
+    return simdjson.loads(line[: _line_end(line)])
+
+
+def _line_end(line: bytes) -> int:
+    end = len(line)
+
+    while end and line[end - 1] in _line_endings:
+        end -= 1
+
+    return end
+
+
+# name: (loads, dumps, loads_line)
+BACKENDS = {"json": (_json_loads, _json_dumps, _json_loads_line)}
+
+if simdjson is not None:
+    BACKENDS["simdjson"] = (simdjson.loads, _json_dumps, _simdjson_loads_line)
+
+if orjson is not None:
+    BACKENDS["orjson"] = (orjson.loads, _orjson_dumps, _orjson_loads_line)
+
+_backend = {}
+
+
+def set_backend(name: str):
+    """
+    Sets the JSON library used for parsing dumps and API responses and for serializing documents for
+    Elasticsearch. By default the fastest installed library is used: orjson, then simdjson, then the
+    standard library.
+
+    Args:
+        name (str): one of 'orjson', 'simdjson', 'json'
+    """
+
+    if name not in BACKENDS:
+        raise ValueError(
+            f"JSON backend {name} is not available. Available backends are {list(BACKENDS.keys())}"
+        )
+
+    loads, dumps, loads_line = BACKENDS[name]
+    _backend.update(
+        {"name": name, "loads": loads, "dumps": dumps, "loads_line": loads_line}
+    )
+
+
+def get_backend() -> str:
+    return _backend["name"]
+
+
+def loads(s):
+    """
+    Parses a JSON document from a str or bytes.
+    """
+
+    return _backend["loads"](s)
+
+
+def dumps(obj, default=None) -> str:
+    """
+    Serializes an object to compact JSON. Non-ASCII characters are not escaped.
+    """
+
+    return _backend["dumps"](obj, default)
+
+
+def loads_line(line: bytes) -> dict:
+    """
+    Parses a single entity line of a Wikidata JSON dump, ignoring surrounding whitespace and the
+    trailing comma of array-wrapped dumps.
+    """
+
+    return _backend["loads_line"](line)
+
+
+class ElasticsearchSerializer(JSONSerializer):
+    """
+    Serializer for the Elasticsearch client using the selected JSON backend. Strings and bytes are
+    passed through untouched, so documents that have already been serialized are not encoded again.
+    """
+
+    def loads(self, s):
+        try:
+            return loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+
+        try:
+            return dumps(data, default=self.default)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+set_backend(next(name for name in ("orjson", "simdjson", "json") if name in BACKENDS))
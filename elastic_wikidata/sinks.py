@@ -0,0 +1,346 @@
+import os
+import time
+from typing import Iterable, Iterator
+from elastic_wikidata import metrics, serialization
+from elastic_wikidata.dump_split import ShardWriter
+from elastic_wikidata.pipeline import batched
+from elastic_wikidata.wd_entities import EntitySimplifier, ALL_LANGUAGES
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Parquet compression codec for each of the compression options of `ShardWriter`
+PARQUET_COMPRESSION = {None: "snappy", "gzip": "gzip", "zstd": "zstd"}
+
+
+class Sink:
+    def __init__(self, batch_size: int = 1000):
+        """
+        Destination for the simplified documents of a load, written in place of an Elasticsearch index.
+        Pass one to `dump_to_es.processDump` as `sink`, and the same pipeline (reading, filtering, simplifying
+        and enriching) writes its documents here. Subclasses implement `write_batch`, and `close` if they
+        hold files open.
+
+        Args:
+            batch_size (int, optional): documents passed to `write_batch` at once. Defaults to 1000.
+        """
+
+        self.batch_size = batch_size
+        self.count = 0
+
+    def write(self, docs: Iterable[dict]) -> Iterator[tuple]:
+        """
+        Writes documents in batches, yielding (ok, item) for each like `bulk.BulkIndexer.index`, where item
+        is in the format of an item of a bulk response.
+        """
+
+        for batch in batched(docs, self.batch_size):
+            if any("_op_type" in doc for doc in batch):
+                raise ValueError(
+                    "Updates and deletes can only be written to Elasticsearch"
+                )
+
+            start = time.perf_counter()
+            self.write_batch(batch)
+            metrics.record_stage("write", len(batch), time.perf_counter() - start)
+            self.count += len(batch)
+
+            for doc in batch:
+                yield True, {"index": {"_id": doc["id"], "status": 201}}
+
+    def write_batch(self, docs: list):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NDJSONSink(Sink):
+    def __init__(
+        self,
+        directory: str,
+        compression: str = None,
+        shard_size: int = 1_000_000,
+        batch_size: int = 1000,
+    ):
+        """
+        Writes documents as newline-delimited JSON to numbered shards in a directory (see
+        `dump_split.ShardWriter`), ready to be bulk loaded elsewhere.
+
+        Args:
+            directory (str): created if it doesn't exist, and must be empty if it does
+            compression (str, optional): None, 'gzip', 'bz2' or 'zstd'. Defaults to None.
+            shard_size (int, optional): documents per shard. Defaults to 1,000,000.
+            batch_size (int, optional): Defaults to 1000.
+        """
+
+        super().__init__(batch_size)
+        self.writer = ShardWriter(directory, compression, shard_size)
+
+    def write_batch(self, docs: list):
+        recorder = metrics.current()
+        size = 0
+
+        for doc in docs:
+            line = serialization.dumps(doc).encode("utf-8") + b"\n"
+            self.writer.write(line)
+            size += len(line)
+
+        recorder.inc("bytes_out_total", size, sink="ndjson")
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetSink(Sink):
+    def __init__(
+        self,
+        directory: str,
+        simplifier: EntitySimplifier,
+        compression: str = None,
+        row_group_size: int = 100_000,
+        shard_size: int = 10_000_000,
+        batch_size: int = 1000,
+    ):
+        """
+        Writes documents to a columnar Parquet dataset: numbered files in a directory (part-00000.parquet, ...)
+        which can be read as one table by pyarrow, pandas, Spark or DuckDB. Needs the pyarrow package.
+
+        The columns follow the documents made by `simplifier`:
+
+        - `id`, `lastrevid` and `modified`
+        - `labels` and `descriptions`: strings with one language, a struct with a field per language with
+          several, or a map from language to string with `ALL_LANGUAGES`. `aliases` is a list of strings, or
+          a struct or map of lists.
+        - `claims`: a struct with a field per property, each a list of values. Values are dictionary-encoded,
+          as most of them are QIDs repeated across many entities, and values which aren't strings (such as
+          coordinates) are stored as JSON. With rich claims each statement is a struct of its `value`,
+          `rank`, `label`, and `qualifiers` and `references` as JSON.
+        - `claim_labels`: a struct with a field per property, each a list of labels, if labels are added
+
+        Documents are held in memory until there are `row_group_size` of them, then written as a row group, so
+        memory use depends on the row group size rather than the number of documents.
+
+        Args:
+            directory (str): created if it doesn't exist, and must be empty if it does
+            simplifier (EntitySimplifier): the simplifier making the documents, which sets the columns
+            compression (str, optional): None (snappy), 'gzip' or 'zstd'. Defaults to None.
+            row_group_size (int, optional): documents per row group. Defaults to 100,000.
+            shard_size (int, optional): documents per file. Defaults to 10,000,000.
+            batch_size (int, optional): Defaults to 1000.
+        """
+
+        if pyarrow is None:
+            raise ImportError(
+                "Writing Parquet needs the pyarrow package (pip install elastic_wikidata[parquet])"
+            )
+        if compression not in PARQUET_COMPRESSION:
+            raise ValueError(
+                f"compression must be one of {', '.join(c for c in PARQUET_COMPRESSION if c)}"
+            )
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise FileExistsError(f"{directory} already exists and isn't empty")
+
+        os.makedirs(directory, exist_ok=True)
+
+        super().__init__(batch_size)
+        self.directory = directory
+        self.simplifier = simplifier
+        self.compression = PARQUET_COMPRESSION[compression]
+        self.row_group_size = row_group_size
+        self.shard_size = shard_size
+        self.shards = 0
+
+        self._buffer = []
+        self._writer = None
+        self._path = None
+        self._rows_in_shard = 0
+
+    def write_batch(self, docs: list):
+        self._buffer.extend(docs)
+
+        while len(self._buffer) >= self.row_group_size:
+            self._write_row_group(self._buffer[: self.row_group_size])
+            del self._buffer[: self.row_group_size]
+
+    def close(self):
+        if self._buffer:
+            self._write_row_group(self._buffer)
+            self._buffer = []
+
+        self._close_shard()
+
+    def table(self, docs: list):
+        """
+        Returns a `pyarrow.Table` of documents.
+        """
+
+        simplifier = self.simplifier
+        columns = {
+            "id": _string_array([doc["id"] for doc in docs]),
+            "lastrevid": pyarrow.array(
+                [doc.get("lastrevid") for doc in docs], pyarrow.int64()
+            ),
+            "modified": _string_array([doc.get("modified") for doc in docs]),
+            "labels": self._language_column(docs, "labels"),
+            "descriptions": self._language_column(docs, "descriptions"),
+            "aliases": self._language_column(docs, "aliases", is_list=True),
+        }
+
+        if simplifier.properties:
+            claims = [doc.get("claims") or {} for doc in docs]
+            columns["claims"] = pyarrow.StructArray.from_arrays(
+                [
+                    self._claims_column([c.get(p) or [] for c in claims])
+                    for p in simplifier.properties
+                ],
+                names=list(simplifier.properties),
+            )
+
+            if not simplifier.rich_claims:
+                claim_labels = [doc.get("claim_labels") or {} for doc in docs]
+                columns["claim_labels"] = pyarrow.StructArray.from_arrays(
+                    [
+                        _list_array(
+                            [labels.get(p) or [] for labels in claim_labels],
+                            _string_array,
+                        )
+                        for p in simplifier.properties
+                    ],
+                    names=list(simplifier.properties),
+                )
+
+        return pyarrow.Table.from_arrays(
+            list(columns.values()), names=list(columns.keys())
+        )
+
+    def _language_column(self, docs: list, field: str, is_list: bool = False):
+        """
+        Returns the column for labels, descriptions or aliases, which depends on the simplifier's languages.
+        """
+
+        def values(items: list):
+            if is_list:
+                return _list_array(items, _string_array)
+            return _string_array(items)
+
+        languages = self.simplifier.languages
+        by_doc = [doc.get(field) for doc in docs]
+
+        if languages is None:
+            return values([v or [] if is_list else v for v in by_doc])
+
+        if languages == ALL_LANGUAGES:
+            offsets, keys, items = [0], [], []
+            for v in by_doc:
+                for lang, value in (v or {}).items():
+                    keys.append(lang)
+                    items.append(value)
+                offsets.append(len(keys))
+
+            return pyarrow.MapArray.from_arrays(
+                pyarrow.array(offsets, pyarrow.int32()),
+                _string_array(keys),
+                values(items),
+            )
+
+        return pyarrow.StructArray.from_arrays(
+            [
+                values([(v or {}).get(lang, [] if is_list else None) for v in by_doc])
+                for lang in languages
+            ],
+            names=list(languages),
+        )
+
+    def _claims_column(self, rows: list):
+        """
+        Returns a list column of the statements of one property, from a list of statements per document.
+        """
+
+        if not self.simplifier.rich_claims:
+            return _list_array(rows, _dictionary_array)
+
+        def statements(flat: list):
+            fields = {
+                "value": _dictionary_array([s.get("value") for s in flat]),
+                "rank": _dictionary_array([s.get("rank") for s in flat]),
+                "label": _string_array([s.get("label") for s in flat]),
+            }
+            for key in ("qualifiers", "references"):
+                if getattr(self.simplifier, key):
+                    fields[key] = _string_array(
+                        [serialization.dumps(s.get(key)) for s in flat]
+                    )
+
+            return pyarrow.StructArray.from_arrays(
+                list(fields.values()), names=list(fields.keys())
+            )
+
+        return _list_array(rows, statements)
+
+    def _write_row_group(self, docs: list):
+        if self._writer is not None and self._rows_in_shard >= self.shard_size:
+            self._close_shard()
+
+        table = self.table(docs)
+
+        if self._writer is None:
+            self._path = os.path.join(self.directory, f"part-{self.shards:05d}.parquet")
+            self._writer = pyarrow.parquet.ParquetWriter(
+                self._path, table.schema, compression=self.compression
+            )
+            self.shards += 1
+            self._rows_in_shard = 0
+
+        self._writer.write_table(table, row_group_size=len(docs))
+        self._rows_in_shard += len(docs)
+
+    def _close_shard(self):
+        if self._writer is None:
+            return
+
+        self._writer.close()
+        self._writer = None
+        metrics.current().inc(
+            "bytes_out_total", os.path.getsize(self._path), sink="parquet"
+        )
+
+
+def _list_array(rows: list, make_values):
+    """
+    Returns a list array from a list of lists, making the array of all their items with `make_values`.
+    """
+
+    offsets, flat = [0], []
+    for items in rows:
+        flat.extend(items)
+        offsets.append(len(flat))
+
+    return pyarrow.ListArray.from_arrays(
+        pyarrow.array(offsets, pyarrow.int32()), make_values(flat)
+    )
+
+
+def _string_array(values: list):
+    return pyarrow.array(values, pyarrow.string())
+
+
+def _dictionary_array(values: list):
+    """
+    Returns a dictionary-encoded array of strings. Values which aren't strings are stored as JSON.
+    """
+
+    strings = [
+        v if v is None or isinstance(v, str) else serialization.dumps(v) for v in values
+    ]
+
+    return _string_array(strings).dictionary_encode()
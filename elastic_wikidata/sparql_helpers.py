@@ -1,10 +1,20 @@
 from SPARQLWrapper import SPARQLWrapper, JSON
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator, List
+import re
 import urllib
 import time
+from elastic_wikidata import metrics, serialization
 from elastic_wikidata.http import generate_user_agent
 
+WIKIDATA_SPARQL_ENDPOINT = "https://query.wikidata.org/sparql"
 
-def run_query(query: str, endpoint_url="https://query.wikidata.org/sparql") -> dict:
+# upper bound of the first slices when splitting a query by QID. The last slice has no upper bound, so
+# newer entities are never missed.
+MAX_QID = 130_000_000
+
+
+def run_query(query: str, endpoint_url=WIKIDATA_SPARQL_ENDPOINT) -> dict:
     """
     Run a SPARQL query against the Wikidata endpoint. Obeys retry-after headers for sensible bulk querying.
 
@@ -23,10 +33,15 @@ def run_query(query: str, endpoint_url="https://query.wikidata.org/sparql") -> d
     sparql.setMethod("POST")
     sparql.setReturnFormat(JSON)
 
+    recorder = metrics.current()
+    start = time.perf_counter()
+
     try:
-        return sparql.query().convert()
+        # the response is read here rather than with `convert`, to count its bytes
+        body = sparql.query().response.read()
     except urllib.error.HTTPError as e:
         if e.code == 429:
+            recorder.inc("retries_total", service="sparql", reason="429")
             if isinstance(e.headers.get("retry-after", None), int):
                 time.sleep(e.headers["retry-after"])
             else:
@@ -34,10 +49,20 @@ def run_query(query: str, endpoint_url="https://query.wikidata.org/sparql") -> d
             return run_query(query, endpoint_url)
         raise
 
+    result = serialization.loads(body)
+    recorder.inc("bytes_in_total", len(body), source="sparql")
+    metrics.record_stage(
+        "query",
+        len(result.get("results", {}).get("bindings", [])),
+        time.perf_counter() - start,
+    )
+
+    return result
+
 
 def paginate_sparql_query(query: str, page_size: int):
     """
-    Paginates a SELECT query, returning a generator which yields paginated queries. 
+    Paginates a SELECT query, returning a generator which yields paginated queries.
     """
 
     # check query
@@ -57,3 +82,156 @@ def paginate_sparql_query(query: str, page_size: int):
         OFFSET {i*page_size}
         """
         i += 1
+
+
+def get_select_variable(query: str) -> str:
+    """
+    Returns the name of the first variable in the SELECT clause of a query, e.g. 'item' for
+    `SELECT ?item WHERE {...}`.
+    """
+
+    match = re.search(
+        r"\bselect\s+(?:distinct\s+|reduced\s+)?\?(\w+)", query, re.IGNORECASE
+    )
+
+    if match is None:
+        raise ValueError("Must be a SELECT query with a named variable")
+
+    return match.group(1)
+
+
+def keyset_query(query: str, page_size: int, after: str = None) -> str:
+    """
+    Returns a query for one page of results, ordered by the first selected variable and starting after
+    the value `after` of that variable. Each page is found with a filter rather than an OFFSET, so the
+    query service doesn't have to produce and skip every earlier result.
+
+    The filter is added before the final closing brace of the query, and any ORDER BY is replaced.
+
+    Args:
+        query (str): SELECT query, without LIMIT or OFFSET
+        page_size (int)
+        after (str, optional): value of the variable (e.g. an entity IRI) in the last result of the
+            previous page. Defaults to None (first page).
+
+    Returns:
+        str: query
+    """
+
+    variable = get_select_variable(query)
+    end = query.rfind("}")
+
+    if end == -1:
+        raise ValueError("Must be a SELECT query with a WHERE clause")
+
+    body, modifiers = query[:end], query[end + 1 :]
+
+    if re.search(r"\b(limit|offset)\b", modifiers, re.IGNORECASE):
+        raise ValueError("LIMIT and OFFSET are added when a query is paginated")
+
+    modifiers = re.sub(
+        r"\border\s+by\b.*$", "", modifiers, flags=re.IGNORECASE | re.DOTALL
+    )
+
+    if after is not None:
+        after = after.replace("\\", "\\\\").replace('"', '\\"')
+        body += f'  FILTER(STR(?{variable}) > "{after}")\n'
+
+    return f"""{body}}}{modifiers.rstrip()}
+ORDER BY STR(?{variable})
+LIMIT {page_size}
+"""
+
+
+def slice_query_by_qid(query: str, slices: int, max_qid: int = None) -> List[str]:
+    """
+    Splits a query into `slices` queries for disjoint ranges of QIDs of the first selected variable, which
+    can be run at the same time. Results which aren't Wikidata items (e.g. properties) are excluded.
+
+    Args:
+        query (str): SELECT query
+        slices (int): number of queries to return
+        max_qid (int, optional): ranges are spread evenly up to this QID, and the last one has no upper bound.
+            Defaults to MAX_QID.
+
+    Returns:
+        List[str]: queries
+    """
+
+    variable = get_select_variable(query)
+    end = query.rfind("}")
+    step = max(1, (max_qid or MAX_QID) // slices)
+    qid_number = f'xsd:integer(STRAFTER(STR(?{variable}), "/entity/Q"))'
+    queries = []
+
+    for i in range(slices):
+        conditions = [f"{qid_number} >= {i * step}"]
+        if i < slices - 1:
+            conditions.append(f"{qid_number} < {(i + 1) * step}")
+
+        queries.append(
+            f"{query[:end]}  FILTER({' && '.join(conditions)})\n{query[end:]}"
+        )
+
+    return queries
+
+
+def paginate_sparql_query_keyset(
+    query: str,
+    page_size: int,
+    slices: int = 1,
+    workers: int = None,
+    endpoint_url: str = WIKIDATA_SPARQL_ENDPOINT,
+    start_after: dict = None,
+) -> Iterator[tuple]:
+    """
+    Runs a SELECT query a page at a time using keyset pagination (see `keyset_query`), yielding the index
+    of the slice each page comes from and its bindings.
+
+    With `slices` > 1 the query is split into that many QID ranges (see `slice_query_by_qid`), which are paginated
+    independently with up to `workers` requests in flight at once. Pages are then yielded in the order they
+    arrive.
+
+    Args:
+        query (str): SELECT query
+        page_size (int)
+        slices (int, optional): Defaults to 1.
+        workers (int, optional): Defaults to `slices`.
+        endpoint_url (str, optional): Defaults to the Wikidata Query Service.
+        start_after (dict, optional): {slice index: value} to start each slice after, e.g. to resume from
+            a checkpoint. Defaults to None.
+
+    Yields:
+        tuple: (slice index, bindings)
+    """
+
+    variable = get_select_variable(query)
+    start_after = start_after or {}
+    queries = slice_query_by_qid(query, slices) if slices > 1 else [query]
+
+    def get_page(sliced_query: str, after: str) -> list:
+        res = run_query(keyset_query(sliced_query, page_size, after), endpoint_url)
+        return res["results"]["bindings"]
+
+    with ThreadPoolExecutor(
+        max_workers=workers or len(queries), thread_name_prefix="query"
+    ) as executor:
+        in_flight = {
+            executor.submit(get_page, q, start_after.get(i)): i
+            for i, q in enumerate(queries)
+        }
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                i = in_flight.pop(future)
+                bindings = future.result()
+
+                # a full page means there may be more results after the last one
+                if len(bindings) >= page_size:
+                    after = max(b[variable]["value"] for b in bindings if variable in b)
+                    in_flight[executor.submit(get_page, queries[i], after)] = i
+
+                if bindings:
+                    yield i, bindings
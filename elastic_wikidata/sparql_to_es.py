@@ -1,8 +1,15 @@
 import re
 from math import ceil
 from itertools import islice
+from typing import Iterator
 from tqdm.auto import tqdm
-from elastic_wikidata.sparql_helpers import run_query, paginate_sparql_query
+from elastic_wikidata.sparql_helpers import (
+    run_query,
+    paginate_sparql_query,
+    paginate_sparql_query_keyset,
+    get_select_variable,
+    WIKIDATA_SPARQL_ENDPOINT,
+)
 from elastic_wikidata.http import generate_user_agent
 
 
@@ -14,19 +21,115 @@ def url_to_qid(url: str) -> str:
     return re.findall(r"(Q\d+)", url)[0]
 
 
-def get_entities_from_query(query, page_size=None, limit=None) -> list:
+def get_entities_from_query(
+    query,
+    page_size=None,
+    limit=None,
+    pagination="keyset",
+    slices=1,
+    workers=None,
+    endpoint_url=WIKIDATA_SPARQL_ENDPOINT,
+) -> list:
     """
     Get a list of entities from a query. Optionally:
         paginate the query using page_size
         limit the total number of entities returned using limit
 
+    Pages are fetched with keyset pagination by default: results are ordered by entity and each page starts
+    after the last entity of the previous one, which stays fast deep into large result sets. With `slices` > 1
+    the query is also split into that many QID ranges, which are paginated at the same time by up to
+    `workers` threads. Pass `pagination="offset"` to use LIMIT/OFFSET pages instead.
+
     Returns list of entities in form (Qd+).
     """
 
-    if page_size:
-        pages = paginate_sparql_query(query, page_size=page_size)
-    else:
-        pages = [query]
+    if not page_size:
+        res = run_query(query, endpoint_url)
+        var = res["head"]["vars"][0]
+        entities = [url_to_qid(x[var]["value"]) for x in res["results"]["bindings"]]
+        return entities[:limit] if limit else entities
+
+    if pagination == "offset":
+        return _get_entities_offset(query, page_size, limit, endpoint_url)
+    if pagination != "keyset":
+        raise ValueError(f"pagination must be 'keyset' or 'offset', not {pagination}")
+
+    entities = iter_entities_from_query(
+        query,
+        page_size,
+        limit,
+        slices=slices,
+        workers=workers,
+        endpoint_url=endpoint_url,
+    )
+
+    return list(tqdm(entities, total=limit, unit="entities"))
+
+
+def iter_entities_from_query(
+    query,
+    page_size=100,
+    limit=None,
+    slices=1,
+    workers=None,
+    endpoint_url=WIKIDATA_SPARQL_ENDPOINT,
+    checkpoint=None,
+) -> Iterator[str]:
+    """
+    Yields the entities from a query as each page arrives, using keyset pagination (see `get_entities_from_query`).
+    Nothing is kept between pages, so this can feed wbgetentities requests and bulk loads while the query
+    is still being paginated, without holding the whole result set in memory.
+
+    Keyset pagination returns each entity in one page only, so an entity is repeated only when it's in several
+    consecutive results of the query, and those repeats are removed.
+
+    If a `checkpoint.Checkpoint` is passed, each QID is added to it with its position in its slice of the query,
+    and pagination starts after the watermark of each slice.
+
+    Yields:
+        str: entities in form (Qd+)
+    """
+
+    var = get_select_variable(query)
+    count = 0
+    start_after = None
+    if checkpoint is not None:
+        start_after = {int(lane): iri for lane, iri in checkpoint.watermarks.items()}
+
+    pages = paginate_sparql_query_keyset(
+        query,
+        page_size,
+        slices=slices,
+        workers=workers,
+        endpoint_url=endpoint_url,
+        start_after=start_after,
+    )
+
+    try:
+        for slice_index, bindings in pages:
+            iris = dict.fromkeys(x[var]["value"] for x in bindings if var in x)
+
+            for iri in sorted(iris):
+                qid = url_to_qid(iri)
+                if checkpoint is not None:
+                    checkpoint.add(qid, iri, str(slice_index))
+
+                yield qid
+                count += 1
+
+                if limit and count >= limit:
+                    return
+    finally:
+        pages.close()
+
+
+def _get_entities_offset(query, page_size, limit, endpoint_url) -> list:
+    """
+    Gets entities from a query paginated with LIMIT and OFFSET.
+    """
+
+    pages = paginate_sparql_query(query, page_size=page_size)
+    page_limit = None
 
     if limit:
         page_limit = ceil(limit / page_size)
@@ -34,8 +137,8 @@ def get_entities_from_query(query, page_size=None, limit=None) -> list:
 
     all_entities = []
 
-    for query in tqdm(pages, total=(page_limit or None)):
-        res = run_query(query)
+    for query in tqdm(pages, total=page_limit):
+        res = run_query(query, endpoint_url)
         var = res["head"]["vars"][0]
         entities = [url_to_qid(x[var]["value"]) for x in res["results"]["bindings"]]
         all_entities += entities
@@ -44,4 +147,4 @@ def get_entities_from_query(query, page_size=None, limit=None) -> list:
         if len(entities) < page_size:
             break
 
-    return all_entities
+    return all_entities[:limit] if limit else all_entities
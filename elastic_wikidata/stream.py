@@ -0,0 +1,272 @@
+import queue
+import threading
+import time
+import requests
+from typing import Iterator
+from elasticsearch.helpers import scan
+from elastic_wikidata import serialization
+from elastic_wikidata.dump_to_es import processDump, delete_action
+from elastic_wikidata.http import generate_user_agent
+from elastic_wikidata.wd_entities import get_entities
+
+RECENTCHANGE_URL = "https://stream.wikimedia.org/v2/stream/recentchange"
+
+# namespaces of items and properties on Wikidata
+ENTITY_NAMESPACES = {0: "", 120: "Property:"}
+
+
+def iter_sse_events(lines: Iterator[bytes]) -> Iterator[dict]:
+    """
+    Parses a stream of Server-Sent Events, yielding {'event', 'id', 'data'} for each event. Multi-line data
+    fields are joined with newlines, and comments and unknown fields are ignored.
+    """
+
+    event = {"event": "message", "id": None, "data": []}
+
+    for line in lines:
+        line = line.decode("utf-8") if isinstance(line, bytes) else line
+        line = line.rstrip("\r\n")
+
+        if not line:
+            if event["data"]:
+                yield dict(event, data="\n".join(event["data"]))
+            event = {"event": "message", "id": event["id"], "data": []}
+            continue
+
+        if line.startswith(":"):
+            continue
+
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+
+        if field == "data":
+            event["data"].append(value)
+        elif field in ("event", "id"):
+            event[field] = value
+
+
+def changed_entity(change: dict, wiki: str = "wikidatawiki") -> tuple:
+    """
+    Gets the entity changed by a recentchange event.
+
+    Returns:
+        tuple: (QID, deleted), or None if the change isn't to a Wikidata item or property
+    """
+
+    if change.get("wiki") != wiki or change.get("namespace") not in ENTITY_NAMESPACES:
+        return None
+
+    qid = change.get("title", "")[len(ENTITY_NAMESPACES[change["namespace"]]) :]
+
+    if change.get("type") in ("edit", "new"):
+        return qid, False
+    if change.get("type") == "log" and change.get("log_type") == "delete":
+        return qid, change.get("log_action") == "delete"
+
+    return None
+
+
+class streamUpdates:
+    def __init__(
+        self,
+        es_credentials: dict,
+        index_name: str,
+        url: str = RECENTCHANGE_URL,
+        window: float = 10,
+        max_batch_size: int = 5000,
+        queue_size: int = 10000,
+        reconnect: bool = True,
+        **kwargs,
+    ):
+        """
+        Keeps an index up to date with edits to Wikidata by consuming the recentchanges feed from
+        Wikimedia EventStreams. Changed QIDs which are in the index are collected and deduplicated over a time
+        window, fetched through the wbgetentities API, and indexed again as whole documents, so that statements,
+        labels and aliases removed on Wikidata are removed from the index too.
+
+        Args:
+            es_credentials (dict): as for `processDump`
+            index_name (str): index to keep up to date
+            url (str, optional): URL of the recentchange stream. Defaults to Wikimedia EventStreams.
+            window (float, optional): seconds over which to collect changes before updating the index. Defaults to 10.
+            max_batch_size (int, optional): update the index early when this many QIDs have changed. Defaults to 5000.
+            queue_size (int, optional): maximum number of changes held in memory. Reading from the stream pauses
+                when the queue is full. Defaults to 10000.
+            reconnect (bool, optional): reconnect when the stream closes, resuming from the last event. Defaults to True.
+            **kwargs: passed to `processDump`, e.g. lang, properties, fetch_workers. With `enrich_labels`, labels
+                are added to the updated documents from the API, or from an existing label index with
+                `label_index`, as there is no dump to read them from.
+        """
+
+        self.url = url
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.reconnect = reconnect
+        self.changes = queue.Queue(maxsize=queue_size)
+        self.last_event_id = None
+
+        if kwargs.get("enrich_labels") == "dump" and not kwargs.get("label_index"):
+            raise ValueError(
+                "Stream updates can only add labels from the API (enrich_labels='api') or from an existing label index"
+            )
+
+        # the index is live, so refresh is never disabled
+        kwargs["disable_refresh_on_index"] = False
+        self.loader = processDump(
+            dump=[], es_credentials=es_credentials, index_name=index_name, **kwargs
+        )
+        # created once, so labels are cached between updates
+        self.label_enricher = (
+            self.loader.label_enricher() if self.loader.enrich_labels else None
+        )
+        self._stop = threading.Event()
+
+    def start_elasticsearch(self):
+        self.loader.start_elasticsearch()
+        self.indexed_qids = self.get_indexed_qids()
+        print(f"Tracking changes to {len(self.indexed_qids)} entities")
+
+    def get_indexed_qids(self) -> set:
+        hits = scan(
+            self.loader.es,
+            index=self.loader.index_name,
+            query={"_source": False},
+            size=10000,
+        )
+
+        return {hit["_id"] for hit in hits}
+
+    def read_stream(self):
+        """
+        Reads the recentchange stream, putting (QID, deleted) on `self.changes` for changes to entities in
+        the index. Runs until `stop` is called, or the stream ends and `self.reconnect` is False.
+        """
+
+        headers = {"User-Agent": generate_user_agent(), "Accept": "text/event-stream"}
+
+        try:
+            while not self._stop.is_set():
+                if self.last_event_id is not None:
+                    headers["Last-Event-ID"] = self.last_event_id
+
+                try:
+                    with requests.get(
+                        self.url, headers=headers, stream=True, timeout=60
+                    ) as response:
+                        response.raise_for_status()
+
+                        for event in iter_sse_events(response.iter_lines()):
+                            if self._stop.is_set():
+                                return
+                            self.last_event_id = event["id"] or self.last_event_id
+                            self._handle_event(event)
+                except (requests.ConnectionError, requests.Timeout):
+                    if not self.reconnect:
+                        raise
+
+                if not self.reconnect:
+                    return
+                time.sleep(1)
+        finally:
+            self.changes.put(None)
+
+    def _handle_event(self, event: dict):
+        if event["event"] != "message":
+            return
+
+        try:
+            change = changed_entity(serialization.loads(event["data"]))
+        except ValueError:
+            return
+
+        if change is not None and change[0] in self.indexed_qids:
+            # blocks while the queue is full, which pauses reading from the stream
+            self.changes.put(change)
+
+    def batches(self) -> Iterator[dict]:
+        """
+        Yields {QID: deleted} for the changes made in each window, with each QID appearing once. The last
+        change to each QID decides whether it has been deleted.
+        """
+
+        stream_ended = False
+
+        while not stream_ended:
+            batch = {}
+            window_end = time.monotonic() + self.window
+
+            while len(batch) < self.max_batch_size:
+                try:
+                    change = self.changes.get(
+                        timeout=max(0, window_end - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+
+                if change is None:
+                    stream_ended = True
+                    break
+
+                qid, deleted = change
+                batch[qid] = deleted
+
+            if batch:
+                yield batch
+
+    def update(self, batch: dict) -> int:
+        """
+        Fetches the changed entities in `batch` and indexes their documents again, deleting documents
+        for entities which have been deleted.
+
+        Returns:
+            int: number of documents updated or deleted successfully
+        """
+
+        changed = [qid for qid, deleted in batch.items() if not deleted]
+        actions = [delete_action(qid) for qid, deleted in batch.items() if deleted]
+
+        for page in get_entities.result_generator(
+            changed,
+            lang=self.loader.wiki_options["lang"],
+            workers=self.loader.fetch_workers,
+            refresh_cache=True,
+        ):
+            for item in page:
+                if "missing" in item:
+                    continue
+                actions.append(self.loader.process_doc(item))
+
+        # documents are replaced, so they need the same labels as the rest of the index
+        if self.label_enricher is not None:
+            actions = list(self.label_enricher.enrich(actions))
+
+        successes = 0
+
+        for ok, info in self.loader.bulk(actions):
+            if not ok:
+                print(info)
+            successes += ok
+
+        for qid, deleted in batch.items():
+            if deleted:
+                self.indexed_qids.discard(qid)
+
+        return successes
+
+    def run(self):
+        """
+        Consumes the stream and updates the index until `stop` is called or the stream ends.
+        """
+
+        reader = threading.Thread(target=self.read_stream, daemon=True)
+        reader.start()
+
+        try:
+            for batch in self.batches():
+                successes = self.update(batch)
+                print(f"Updated {successes} of {len(batch)} changed entities")
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stop.set()
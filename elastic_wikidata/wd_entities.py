@@ -1,10 +1,172 @@
 import requests
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    FIRST_COMPLETED,
+    as_completed,
+    wait,
+)
 from tqdm.auto import tqdm
-from typing import List, Union
-from math import ceil
+from typing import Iterable, List, Union
+from functools import lru_cache
+from itertools import islice
+from urllib.parse import urlencode
 import re
-from elastic_wikidata.http import generate_user_agent
+import threading
+import time
+from elastic_wikidata import metrics
+from elastic_wikidata.http import (
+    generate_user_agent,
+    request_with_backoff,
+    RateLimiter,
+)
 from elastic_wikidata.config import runtime_config
+from elastic_wikidata.entity_cache import EntityCache
+from elastic_wikidata.pipeline import batched
+
+# seconds of replication lag above which the Wikidata API asks bots to back off
+MAXLAG = 5
+
+# pass as `lang` to get labels, descriptions and aliases in every language
+ALL_LANGUAGES = "all"
+
+# IDs per wbgetentities request: the API allows 50, or 500 for accounts with the apihighlimits right (bots)
+DEFAULT_PAGE_LIMIT = 50
+
+# requests with longer URLs are sent as POST, as long URLs are rejected by some servers and proxies
+MAX_GET_URL_LENGTH = 2000
+
+
+class PageSizer:
+    def __init__(
+        self,
+        max_size: int = DEFAULT_PAGE_LIMIT,
+        target_bytes: int = None,
+        target_seconds: float = None,
+        min_size: int = 1,
+        smoothing: float = 0.5,
+    ):
+        """
+        Chooses the number of IDs in each wbgetentities request. Without a target every request has
+        `max_size` IDs. With a target response size or latency, each response moves the page size towards
+        the number of IDs that would have met it, so that pages of large entities (with thousands of
+        statements) shrink and pages of small ones grow, at most doubling at a time. With both targets the
+        smaller page size wins. Shared by the threads fetching pages.
+
+        Args:
+            max_size (int, optional): Defaults to 50.
+            target_bytes (int, optional): response size to aim for. Defaults to None.
+            target_seconds (float, optional): response time to aim for. Defaults to None.
+            min_size (int, optional): Defaults to 1.
+            smoothing (float, optional): weight of each response in the page size, between 0 and 1.
+                Defaults to 0.5.
+        """
+
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+
+        self.adaptive = bool(target_bytes or target_seconds)
+        self._size = (
+            min(max_size, DEFAULT_PAGE_LIMIT) if self.adaptive else float(max_size)
+        )
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        """
+        Returns the number of IDs to put in the next request.
+        """
+
+        return max(self.min_size, min(self.max_size, round(self._size)))
+
+    def observe(self, ids: int, size: int, seconds: float):
+        """
+        Updates the page size from a response to a request for `ids` IDs, `size` bytes long, which took
+        `seconds`.
+        """
+
+        if not (self.adaptive and ids):
+            return
+
+        proposals = []
+        if self.target_bytes and size:
+            proposals.append(ids * self.target_bytes / size)
+        if self.target_seconds and seconds:
+            proposals.append(ids * self.target_seconds / seconds)
+        if not proposals:
+            return
+
+        proposed = min(min(proposals), 2 * ids)
+
+        with self._lock:
+            self._size = max(
+                self.min_size,
+                min(
+                    self.max_size,
+                    (1 - self.smoothing) * self._size + self.smoothing * proposed,
+                ),
+            )
+
+
+class InFlightRequests:
+    def __init__(self):
+        """
+        The wbgetentities requests in flight, so that concurrent callers (such as the fetch workers of a
+        load and label enrichment) share them rather than requesting the same entities twice. An ID which
+        is already being requested with the same languages, and at least the same props, waits for that
+        response instead of being requested again. `get_entities.result_generator` uses
+        `in_flight_requests`, shared by the whole process, by default.
+        """
+
+        self._lock = threading.Lock()
+        # {(endpoint, languages, qid): [(props, future of {qid: entity})]}
+        self._requests = {}
+
+    def claim(self, endpoint: str, languages: str, props: frozenset, qids: list):
+        """
+        Registers a request for `qids`, apart from those which are already in flight.
+
+        Returns:
+            tuple: (qids to request, {qid: future of the response of the request it's in}, future to set
+                to the response {qid: entity} of this request)
+        """
+
+        future = Future()
+        to_request, shared = [], {}
+
+        with self._lock:
+            for qid in dict.fromkeys(qids):
+                key = (endpoint, languages, qid)
+
+                for other_props, other in self._requests.get(key, ()):
+                    if props <= other_props:
+                        shared[qid] = other
+                        break
+                else:
+                    to_request.append(qid)
+                    self._requests.setdefault(key, []).append((props, future))
+
+        return to_request, shared, future
+
+    def release(self, endpoint: str, languages: str, qids: list, future: Future):
+        """
+        Removes a finished request. Its future should already have a result or exception.
+        """
+
+        with self._lock:
+            for qid in qids:
+                key = (endpoint, languages, qid)
+                others = [r for r in self._requests.get(key, ()) if r[1] is not future]
+
+                if others:
+                    self._requests[key] = others
+                else:
+                    self._requests.pop(key, None)
+
+
+in_flight_requests = InFlightRequests()
 
 
 class get_entities:
@@ -22,7 +184,7 @@ class get_entities:
             "http://www.wikidata.org/w/api.php?action=wbgetentities&format=json"
         )
 
-        self.properties = ["labels", "aliases", "claims", "descriptions"]
+        self.properties = ["info", "labels", "aliases", "claims", "descriptions"]
 
     @staticmethod
     def _param_join(params: List[str]) -> str:
@@ -40,7 +202,13 @@ class get_entities:
 
     @classmethod
     def get_all_results(
-        self, qcodes, lang="en", page_limit=50, timeout: int = None
+        self,
+        qcodes,
+        lang="en",
+        page_limit: int = None,
+        timeout: int = None,
+        workers: int = 1,
+        cache: EntityCache = None,
     ) -> list:
         """
         Get response through the `wbgetentities` API.
@@ -49,23 +217,60 @@ class get_entities:
             list: each item is a the response for an entity
         """
 
-        results = self().result_generator(qcodes, lang, page_limit, timeout)
+        results = self().result_generator(
+            qcodes, lang, page_limit, timeout, workers, cache=cache
+        )
 
         all_results = []
 
-        print(f"Getting {len(qcodes)} wikidata documents in pages of {page_limit}")
+        print(f"Getting {len(qcodes)} wikidata documents")
 
-        for res in tqdm(results, total=ceil(len(qcodes) / page_limit)):
-            all_results += res
+        with tqdm(total=len(qcodes)) as progress:
+            for res in results:
+                all_results += res
+                progress.update(len(res))
 
         return all_results
 
     @classmethod
     def result_generator(
-        self, qcodes, lang="en", page_limit=50, timeout: int = None
+        self,
+        qcodes,
+        lang="en",
+        page_limit: int = None,
+        timeout: int = None,
+        workers: int = 1,
+        rate_limiter: RateLimiter = None,
+        cache: EntityCache = None,
+        props: List[str] = None,
+        refresh_cache: bool = False,
+        page_sizer: PageSizer = None,
+        in_flight: InFlightRequests = None,
     ) -> list:
         """
-        Get response through the `wbgetentities` API. Yields `page_limit` entities at a time.
+        Get response through the `wbgetentities` API. Yields up to `page_limit` entities at a time.
+
+        `page_limit` defaults to 'page_limit' in `runtime_config`, or 50. The number of IDs in each request
+        is chosen by `page_sizer`, which defaults to a `PageSizer` of up to `page_limit` IDs aiming for
+        'page_target_bytes' and 'page_target_seconds' in `runtime_config`, if set. Requests whose URLs would
+        be longer than `MAX_GET_URL_LENGTH` are sent as POST.
+
+        Entities already being requested by another caller in the process are waited for rather than
+        requested again (see `InFlightRequests`).
+
+        With `workers` > 1, up to `workers` pages are requested at once and pages are yielded in the order
+        they arrive rather than the order of `qcodes`. All requests share `rate_limiter`, so they all back
+        off when Wikidata asks for it through a `Retry-After` header or a `maxlag` error.
+
+        If a cache is passed, or set in `runtime_config` as 'entity_cache', entities found in the cache are
+        yielded first and only the rest are requested, in full pages. Fetched entities are added to the cache.
+        With `refresh_cache` every entity is requested, and the cache is updated with the results.
+
+        `props` sets the parts of each entity to request, and defaults to `self().properties`. `lang` can be a
+        language code, a list of codes, or `ALL_LANGUAGES`.
+
+        `qcodes` can be any iterable, such as a generator reading QIDs from a SPARQL query. It's only read
+        as far as is needed for the pages in flight.
 
         Returns:
             list: each item is a the response for an entity
@@ -74,25 +279,192 @@ class get_entities:
         if isinstance(qcodes, str):
             qcodes = [qcodes]
 
-        qcodes_paginated = [
-            qcodes[i : i + page_limit] for i in range(0, len(qcodes), page_limit)
-        ]
-
         headers = {"User-Agent": generate_user_agent()}
 
         if timeout is None:
             timeout = runtime_config.get("http_timeout")
 
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+
+        if cache is None:
+            cache = runtime_config.get("entity_cache")
+
+        if page_sizer is None:
+            page_sizer = PageSizer(
+                page_limit or runtime_config.get("page_limit") or DEFAULT_PAGE_LIMIT,
+                target_bytes=runtime_config.get("page_target_bytes"),
+                target_seconds=runtime_config.get("page_target_seconds"),
+            )
+
+        if in_flight is None:
+            in_flight = in_flight_requests
+
+        endpoint = self().endpoint
+        props_list = props or self().properties
+        props = self._param_join(props_list)
+        props_set = frozenset(props_list)
+
+        # wbgetentities returns every language when none are requested
+        languages = languages_param(lang)
+        language_params = (
+            {}
+            if languages == ALL_LANGUAGES
+            else {"languages": languages, "languagefallback": 1}
+        )
+
         with requests.Session() as s:
-            for page in qcodes_paginated:
-                url = f"http://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids={self._param_join(page)}&props={self._param_join(self().properties)}&languages={lang}&languagefallback=1&formatversion=2"
-                response = s.get(url, headers=headers, timeout=timeout).json()
-                yield [v for _, v in response["entities"].items()]
+            if workers > 1:
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+
+            def request_page(qids: list) -> tuple:
+                params = {
+                    "ids": "|".join(qids),
+                    "props": "|".join(props_list),
+                    **language_params,
+                    "formatversion": 2,
+                    "maxlag": MAXLAG,
+                }
+                url = f"{endpoint}&{urlencode(params)}"
+                data = None
+                if len(url) > MAX_GET_URL_LENGTH:
+                    url, data = endpoint, params
+
+                start = time.perf_counter()
+                response, size = request_with_backoff(
+                    s, url, rate_limiter, data=data, headers=headers, timeout=timeout
+                )
+                seconds = time.perf_counter() - start
+                page_sizer.observe(len(qids), size, seconds)
 
-    def get_labels(self, qcodes, lang="en", page_limit=50, timeout: int = None) -> dict:
+                return response["entities"], seconds
+
+            def get_page(page: list) -> list:
+                qids, shared, future = in_flight.claim(
+                    endpoint, languages, props_set, page
+                )
+                seconds = 0
+
+                try:
+                    entities = {}
+                    if qids:
+                        entities, seconds = request_page(qids)
+                    future.set_result(_by_requested_id(entities))
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                finally:
+                    in_flight.release(endpoint, languages, qids, future)
+
+                page_entities = list(entities.values())
+                for qid, other in shared.items():
+                    entity = other.result().get(qid)
+                    if entity is not None:
+                        page_entities.append(entity)
+
+                if shared:
+                    metrics.current().inc(
+                        "coalesced_total", len(shared), service="wikidata"
+                    )
+                metrics.record_stage("fetch", len(page_entities), seconds)
+                return page_entities
+
+            def fetched(page: list) -> list:
+                if cache is not None:
+                    cache.put_many(page, languages, props)
+                return page
+
+            pages = self._paginate(
+                qcodes, page_sizer, languages, props, None if refresh_cache else cache
+            )
+
+            if workers == 1:
+                for is_cached, page in pages:
+                    if is_cached:
+                        metrics.record_stage("cache", len(page))
+                    yield page if is_cached else fetched(get_page(page))
+            else:
+                with ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="fetch"
+                ) as executor:
+                    pending = set()
+
+                    for is_cached, page in pages:
+                        if is_cached:
+                            metrics.record_stage("cache", len(page))
+                            yield page
+                            continue
+
+                        pending.add(executor.submit(get_page, page))
+
+                        if len(pending) >= workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                yield fetched(future.result())
+
+                    for future in as_completed(pending):
+                        yield fetched(future.result())
+
+    @staticmethod
+    def _paginate(
+        qcodes: Iterable[str],
+        page_sizer: PageSizer,
+        lang: str,
+        props: str,
+        cache: EntityCache = None,
+    ):
+        """
+        Splits `qcodes` into pages. Yields (True, entities) for pages of entities found in `cache`, and
+        (False, qcodes) for pages of QIDs to request, of the size chosen by `page_sizer` when each page is
+        made. All pages to request are full apart from the last one.
+        """
+
+        qcodes = iter(qcodes)
+
+        if cache is None:
+            while True:
+                page = list(islice(qcodes, page_sizer.size()))
+                if not page:
+                    return
+                yield False, page
+
+        misses = []
+        page_limit = page_sizer.max_size
+        block_size = max(page_limit, 500)
+
+        for block in batched(qcodes, block_size):
+            cached = list(cache.get_many(block, lang, props).items())
+
+            for j in range(0, len(cached), page_limit):
+                yield True, [entity for _, entity in cached[j : j + page_limit]]
+
+            cached_qcodes = {qid for qid, _ in cached}
+            misses += [qid for qid in block if qid not in cached_qcodes]
+
+            while len(misses) >= page_sizer.size():
+                size = page_sizer.size()
+                yield False, misses[:size]
+                misses = misses[size:]
+
+        if misses:
+            yield False, misses
+
+    def get_labels(
+        self,
+        qcodes,
+        lang="en",
+        page_limit: int = None,
+        timeout: int = None,
+        workers: int = 1,
+        cache: EntityCache = None,
+        label_source=None,
+    ) -> dict:
         """
         Get labels from Wikidata qcodes. If the item associated with a qcode has no label, its value
-        in the dictionary is an empty string.
+        in the dictionary is an empty string. With `label_source`, such as a `label_index.LabelIndex` in
+        `lang`, labels are looked up there without making any requests.
 
         Returns:
             dict: {qid1: label1, qid2: label2, ...}
@@ -101,7 +473,11 @@ class get_entities:
         qid_label_mapping = dict()
         qcodes = list(set(qcodes))
 
-        docs = self.get_all_results(qcodes, lang, page_limit, timeout)
+        if label_source is not None:
+            labels = label_source.get_labels(qcodes)
+            return {qid: labels.get(qid, "") for qid in qcodes}
+
+        docs = self.get_all_results(qcodes, lang, page_limit, timeout, workers, cache)
 
         for doc in docs:
             qid_label_mapping[doc["id"]] = doc["labels"].get(lang, {}).get("value", "")
@@ -109,88 +485,612 @@ class get_entities:
         return qid_label_mapping
 
 
+def _by_requested_id(entities: dict) -> dict:
+    """
+    Returns the entities of a wbgetentities response by the ID they were requested with, which is the
+    ID redirected from for redirected entities.
+    """
+
+    by_id = dict(entities)
+    for entity in entities.values():
+        if "id" in entity:
+            qid = entity["redirects"]["from"] if "redirects" in entity else entity["id"]
+            by_id[qid] = entity
+
+    return by_id
+
+
+# the field of the value to keep for each datavalue type. Values of other types are kept whole.
+WD_TYPE_MAPPING = {
+    "wikibase-entityid": "id",
+    "time": "time",
+    "monolingualtext": "text",
+    "quantity": "amount",
+}
+
+
+# which statements of a property are kept, by rank. 'best' keeps preferred statements if there are any and
+# normal statements otherwise, like the truthy statements in the Wikidata Query Service.
+RANK_FILTERS = ("all", "non-deprecated", "best")
+
+# returned by `_snak_value` for snaks without a value
+_NO_VALUE = object()
+
+# IDs of entities whose labels can be looked up, as found in simplified claims
+_entity_id_regex = re.compile(r"[QP]\d+")
+
+# built-in Elasticsearch language analyzers, by Wikimedia language code. Other languages use the standard
+# analyzer, as do variants without an entry of their own (e.g. 'de-ch' uses 'german').
+LANGUAGE_ANALYZERS = {
+    "ar": "arabic",
+    "hy": "armenian",
+    "eu": "basque",
+    "bn": "bengali",
+    "pt-br": "brazilian",
+    "bg": "bulgarian",
+    "ca": "catalan",
+    "zh": "cjk",
+    "ja": "cjk",
+    "ko": "cjk",
+    "cs": "czech",
+    "da": "danish",
+    "nl": "dutch",
+    "en": "english",
+    "et": "estonian",
+    "fi": "finnish",
+    "fr": "french",
+    "gl": "galician",
+    "de": "german",
+    "el": "greek",
+    "hi": "hindi",
+    "hu": "hungarian",
+    "id": "indonesian",
+    "ga": "irish",
+    "it": "italian",
+    "lv": "latvian",
+    "lt": "lithuanian",
+    "nb": "norwegian",
+    "nn": "norwegian",
+    "no": "norwegian",
+    "fa": "persian",
+    "pt": "portuguese",
+    "ro": "romanian",
+    "ru": "russian",
+    "ckb": "sorani",
+    "es": "spanish",
+    "sv": "swedish",
+    "tr": "turkish",
+    "th": "thai",
+}
+
+
+def get_analyzer(lang: str) -> str:
+    """
+    Returns the Elasticsearch analyzer for a language, falling back from a variant to its base language.
+    """
+
+    return LANGUAGE_ANALYZERS.get(
+        lang, LANGUAGE_ANALYZERS.get(lang.split("-")[0], "standard")
+    )
+
+
+def languages_param(lang: Union[str, Iterable[str]]) -> str:
+    """
+    Returns the languages parameter of a wbgetentities request for one language, a list of languages or
+    `ALL_LANGUAGES`, e.g. 'en|fr|de'.
+    """
+
+    return lang if isinstance(lang, str) else "|".join(lang)
+
+
+class EntitySimplifier:
+    def __init__(
+        self,
+        lang: Union[str, List[str]],
+        properties: list,
+        use_redirected_qid: bool = False,
+        ranks: str = "all",
+        qualifiers: list = None,
+        references: list = None,
+        rich_claims: bool = None,
+        fallback: list = None,
+        label_source=None,
+    ):
+        """
+        Simplifies entities from wbgetentities or the JSON dumps into documents for Elasticsearch. Everything
+        that doesn't depend on the entity is worked out once here, so that simplifying each entity is only
+        lookups on the entity itself. Instances can be pickled, to send to dump worker processes.
+
+        By default each property in `claims` is a list of the values of its statements. With `rich_claims`
+        each statement is instead a dict with its `value` and `rank`, plus `qualifiers` ({property: [values]})
+        and `references` ([{property: [values]}]) if those properties are given.
+
+        With a single language `labels` and `descriptions` are strings and `aliases` is a list. With a list
+        of languages, or `ALL_LANGUAGES`, they are keyed by language instead, e.g. {'en': 'label', 'fr': 'label'},
+        all from one pass over the entity. A language without a label or description takes it from the first
+        language in its fallback chain that has one: its base language for variants such as 'de-ch', then
+        `fallback`. Aliases don't fall back.
+
+        With `label_source`, the labels of the entities that claims refer to are added as well (see
+        `add_claim_labels`). `simplify_batch` looks them up once for the whole batch.
+
+        Args:
+            lang (Union[str, List[str]]): Wikimedia language code, list of codes, or `ALL_LANGUAGES`
+            properties (list): list of Wikidata properties
+            use_redirected_qid (bool, optional): whether to return the redirected QID value under the 'id' field
+                instead of the original QID if there is one. Defaults to False.
+            ranks (str, optional): statements to keep: 'all', 'non-deprecated' or 'best'. Defaults to 'all'.
+            qualifiers (list, optional): qualifier properties to keep, e.g. ['P580', 'P582']. Defaults to None.
+            references (list, optional): reference properties to keep, e.g. ['P248']. Defaults to None.
+            rich_claims (bool, optional): return statements as dicts. Defaults to True if qualifiers or
+                references are given, otherwise False.
+            fallback (list, optional): languages to fall back to with several languages, e.g. ['en'].
+                Defaults to None.
+            label_source (optional): anything with a `get_labels(qids) -> {qid: label}` method, such as a
+                `label_index.LabelIndex`. Defaults to None.
+        """
+
+        if ranks not in RANK_FILTERS:
+            raise ValueError(f"ranks must be one of {', '.join(RANK_FILTERS)}")
+
+        self.lang = lang if isinstance(lang, str) else tuple(lang)
+        # None for a single language, or languages (None for all) and the fallback chain of each language
+        self.languages = None
+        self.fallback = {}
+        if not isinstance(lang, str):
+            self.languages = tuple(dict.fromkeys(lang))
+        elif lang == ALL_LANGUAGES:
+            self.languages = ALL_LANGUAGES
+
+        if isinstance(self.languages, tuple):
+            for language in self.languages:
+                chain = [language.split("-")[0]] + list(fallback or [])
+                self.fallback[language] = tuple(
+                    dict.fromkeys(code for code in chain if code != language)
+                )
+
+        # properties are looked up in the order given, once each
+        self.properties = tuple(dict.fromkeys(properties))
+        self.use_redirected_qid = use_redirected_qid
+        self._redirect_key = "to" if use_redirected_qid else "from"
+
+        self.ranks = ranks
+        self.qualifiers = tuple(dict.fromkeys(qualifiers or []))
+        self.references = tuple(dict.fromkeys(references or []))
+        if rich_claims is None:
+            rich_claims = bool(self.qualifiers or self.references)
+        self.rich_claims = rich_claims
+
+        self.label_source = label_source
+
+    def mappings(self) -> dict:
+        """
+        Returns Elasticsearch mappings for the documents. Labels and aliases are copied to `labels_aliases`
+        for searching both at once. With several languages, each language's fields use its Elasticsearch
+        language analyzer (see `LANGUAGE_ANALYZERS`); with `ALL_LANGUAGES` this is done with dynamic templates
+        as the languages aren't known in advance.
+
+        Rich claims are mapped as nested objects, so that a query can match a value together with its rank
+        and qualifiers. Values are mapped dynamically as before, as one property can have values of
+        several types.
+        """
+
+        properties = {
+            "labels": {"type": "text", "copy_to": "labels_aliases"},
+            "aliases": {"type": "text", "copy_to": "labels_aliases"},
+            "labels_aliases": {"type": "text", "store": "true"},
+        }
+        mappings = {"properties": properties}
+
+        def text_field(lang: str, field: str) -> dict:
+            mapping = {"type": "text", "analyzer": get_analyzer(lang)}
+            if field != "descriptions":
+                mapping["copy_to"] = "labels_aliases"
+            return mapping
+
+        fields = ("labels", "descriptions", "aliases")
+
+        if self.languages == ALL_LANGUAGES:
+            templates = []
+            for field in fields:
+                properties[field] = {"type": "object"}
+                templates += [
+                    {
+                        f"{field}_{lang}": {
+                            "path_match": f"{field}.{lang}",
+                            "mapping": text_field(lang, field),
+                        }
+                    }
+                    for lang in LANGUAGE_ANALYZERS
+                ]
+                templates.append(
+                    {
+                        field: {
+                            "path_match": f"{field}.*",
+                            "mapping": text_field("", field),
+                        }
+                    }
+                )
+            mappings["dynamic_templates"] = templates
+        elif self.languages:
+            for field in fields:
+                properties[field] = {
+                    "properties": {
+                        lang: text_field(lang, field) for lang in self.languages
+                    }
+                }
+
+        if self.rich_claims:
+            statement = {"type": "nested", "properties": {"rank": {"type": "keyword"}}}
+            if self.qualifiers:
+                statement["properties"]["qualifiers"] = {"type": "object"}
+            if self.references:
+                statement["properties"]["references"] = {"type": "object"}
+
+            properties["claims"] = {
+                "properties": {p: statement for p in self.properties}
+            }
+
+        return mappings
+
+    def __call__(self, doc: dict) -> dict:
+        return self.simplify(doc)
+
+    def simplify(self, doc: dict) -> dict:
+        """
+        Returns the simplified version of a single entity.
+        """
+
+        newdoc = self._simplify(doc)
+
+        if self.label_source is not None:
+            self._add_claim_labels([newdoc])
+
+        return newdoc
+
+    def _simplify(self, doc: dict) -> dict:
+        lang = self.lang
+
+        if "redirects" in doc:
+            newdoc = {"id": doc["redirects"][self._redirect_key]}
+        else:
+            newdoc = {"id": doc["id"]}
+
+        # add revision information, used to find changed entities in incremental updates
+        if "lastrevid" in doc:
+            newdoc["lastrevid"] = doc["lastrevid"]
+        if "modified" in doc:
+            newdoc["modified"] = doc["modified"]
+
+        if self.languages is not None:
+            self._add_languages(doc, newdoc)
+            return self._add_claims(doc, newdoc)
+
+        # empty labels, descriptions, aliases and claims are lists rather than dicts in some dumps, so
+        # `in` is used rather than `get`
+        labels = doc.get("labels")
+        if labels and lang in labels:
+            newdoc["labels"] = labels[lang]["value"]
+
+        descriptions = doc.get("descriptions")
+        if descriptions and lang in descriptions:
+            newdoc["descriptions"] = descriptions[lang]["value"]
+
+        aliases = doc.get("aliases")
+        if aliases and lang in aliases:
+            newdoc["aliases"] = [alias["value"] for alias in aliases[lang]]
+        else:
+            newdoc["aliases"] = []
+
+        return self._add_claims(doc, newdoc)
+
+    def _add_claims(self, doc: dict, newdoc: dict) -> dict:
+        claims = doc.get("claims")
+        if not claims:
+            newdoc["claims"] = {}
+        elif self.rich_claims or self.ranks != "all":
+            newdoc["claims"] = self._ranked_claims(claims)
+        else:
+            newdoc["claims"] = self._claims(claims)
+
+        return newdoc
+
+    def _add_languages(self, doc: dict, newdoc: dict):
+        """
+        Adds labels, descriptions and aliases keyed by language.
+        """
+
+        labels = doc.get("labels") or {}
+        descriptions = doc.get("descriptions") or {}
+        aliases = doc.get("aliases") or {}
+
+        if self.languages == ALL_LANGUAGES:
+            newdoc["labels"] = {lang: v["value"] for lang, v in labels.items()}
+            newdoc["descriptions"] = {
+                lang: v["value"] for lang, v in descriptions.items()
+            }
+            newdoc["aliases"] = {
+                lang: [alias["value"] for alias in values]
+                for lang, values in aliases.items()
+            }
+            return
+
+        newdoc["labels"] = self._with_fallback(labels)
+        newdoc["descriptions"] = self._with_fallback(descriptions)
+        newdoc["aliases"] = {
+            lang: [alias["value"] for alias in aliases[lang]]
+            for lang in self.languages
+            if lang in aliases
+        }
+
+    def _with_fallback(self, values: dict) -> dict:
+        """
+        Returns {language: value} for each language with a value of its own or from its fallback chain.
+        """
+
+        result = {}
+
+        for lang in self.languages:
+            if lang in values:
+                result[lang] = values[lang]["value"]
+                continue
+
+            for fallback in self.fallback[lang]:
+                if fallback in values:
+                    result[lang] = values[fallback]["value"]
+                    break
+
+        return result
+
+    def simplify_batch(self, docs: Iterable[dict]) -> List[dict]:
+        """
+        Returns the simplified version of each of a list of entities.
+        """
+
+        simplify = self._simplify
+        newdocs = [simplify(doc) for doc in docs]
+
+        if self.label_source is not None:
+            self._add_claim_labels(newdocs)
+
+        return newdocs
+
+    def _add_claim_labels(self, newdocs: List[dict]):
+        labels = self.label_source.get_labels(claim_entity_ids(newdocs))
+
+        for newdoc in newdocs:
+            add_claim_labels(newdoc, labels)
+
+    def _claims(self, claims: dict) -> dict:
+        simplified = {}
+
+        for p in self.properties:
+            if p not in claims:
+                continue
+
+            values = []
+            for statement in claims[p]:
+                try:
+                    datavalue = statement["mainsnak"]["datavalue"]
+                except KeyError:
+                    # somevalue and novalue snaks have no datavalue, so there's nothing to add
+                    continue
+
+                value = datavalue["value"]
+                value_name = WD_TYPE_MAPPING.get(datavalue["type"])
+
+                if value_name is None:
+                    # Otherwise return the whole dictionary.
+                    values.append(value)
+                    continue
+
+                try:
+                    # Return specific value for certain types.
+                    values.append(value[value_name])
+                except KeyError:
+                    print(
+                        f"WARNING: property {p} with datatype {datavalue['type']} failed to process. Consider forking this code and implementing support for it."
+                    )
+
+            simplified[p] = values
+
+        return simplified
+
+    def _ranked_claims(self, claims: dict) -> dict:
+        """
+        As `_claims`, but filtering statements by rank and optionally keeping ranks, qualifiers and
+        references.
+        """
+
+        simplified = {}
+
+        for p in self.properties:
+            if p not in claims:
+                continue
+
+            statements = claims[p]
+            if self.ranks == "best":
+                keep = (
+                    "preferred"
+                    if any(s.get("rank") == "preferred" for s in statements)
+                    else "normal"
+                )
+                statements = [s for s in statements if s.get("rank", "normal") == keep]
+            elif self.ranks == "non-deprecated":
+                statements = [s for s in statements if s.get("rank") != "deprecated"]
+
+            values = []
+            for statement in statements:
+                value = _snak_value(statement.get("mainsnak", {}), p)
+                if value is _NO_VALUE:
+                    continue
+
+                if not self.rich_claims:
+                    values.append(value)
+                    continue
+
+                rich = {"value": value, "rank": statement.get("rank", "normal")}
+                if self.qualifiers:
+                    rich["qualifiers"] = self._snak_values(
+                        statement.get("qualifiers", {}), self.qualifiers
+                    )
+                if self.references:
+                    rich["references"] = [
+                        self._snak_values(reference.get("snaks", {}), self.references)
+                        for reference in statement.get("references", [])
+                    ]
+                values.append(rich)
+
+            simplified[p] = values
+
+        return simplified
+
+    @staticmethod
+    def _snak_values(snaks: dict, properties: tuple) -> dict:
+        """
+        Returns {property: [values]} for the snaks of a statement's qualifiers or of a reference, keeping
+        only `properties`.
+        """
+
+        values = {}
+
+        for p in properties:
+            if p in snaks:
+                snak_values = [_snak_value(snak, p) for snak in snaks[p]]
+                values[p] = [v for v in snak_values if v is not _NO_VALUE]
+
+        return values
+
+
+def _snak_value(snak: dict, p: str):
+    """
+    Returns the simplified value of a snak, or `_NO_VALUE` if it doesn't have one.
+    """
+
+    datavalue = snak.get("datavalue")
+    if datavalue is None:
+        # somevalue and novalue snaks have no datavalue, so there's nothing to add
+        return _NO_VALUE
+
+    value = datavalue["value"]
+    value_name = WD_TYPE_MAPPING.get(datavalue["type"])
+
+    if value_name is None:
+        # Otherwise return the whole dictionary.
+        return value
+
+    try:
+        # Return specific value for certain types.
+        return value[value_name]
+    except KeyError:
+        print(
+            f"WARNING: property {p} with datatype {datavalue['type']} failed to process. Consider forking this code and implementing support for it."
+        )
+        return _NO_VALUE
+
+
+def _claim_value(value):
+    """
+    Returns the entity ID a simplified claim value refers to, or None.
+    """
+
+    if isinstance(value, dict):
+        value = value.get("value")
+
+    if isinstance(value, str) and _entity_id_regex.fullmatch(value):
+        return value
+
+    return None
+
+
+def claim_entity_ids(docs: Iterable[dict]) -> set:
+    """
+    Returns the IDs of the entities that the claims of simplified documents refer to.
+    """
+
+    return {
+        value
+        for doc in docs
+        for values in (doc.get("claims") or {}).values()
+        for value in map(_claim_value, values)
+        if value is not None
+    }
+
+
+def add_claim_labels(doc: dict, labels: dict):
+    """
+    Adds the labels of the entities that a simplified document's claims refer to, from `labels`
+    ({qid: label}). They go in `claim_labels` ({property: [labels]}, in the same order as the values in
+    `claims`, with None for values without a label), or as `label` on each statement with rich claims.
+    """
+
+    claim_labels = {}
+
+    for p, values in (doc.get("claims") or {}).items():
+        if values and isinstance(values[0], dict):
+            for statement in values:
+                qid = _claim_value(statement)
+                if qid is not None and labels.get(qid) is not None:
+                    statement["label"] = labels[qid]
+            continue
+
+        qids = [_claim_value(value) for value in values]
+        if any(qid is not None for qid in qids):
+            claim_labels[p] = [labels.get(qid) if qid else None for qid in qids]
+
+    if claim_labels:
+        doc["claim_labels"] = claim_labels
+
+
+@lru_cache(maxsize=32)
+def _get_simplifier(
+    lang: Union[str, tuple],
+    properties: tuple,
+    use_redirected_qid: bool,
+    label_source=None,
+) -> EntitySimplifier:
+    return EntitySimplifier(
+        lang, properties, use_redirected_qid, label_source=label_source
+    )
+
+
 def simplify_wbgetentities_result(
     doc: Union[dict, List[dict]],
     lang: str,
     properties: list,
     use_redirected_qid: bool = False,
+    label_source=None,
 ) -> Union[dict, List[dict]]:
     """
     Processes a single document or set of documents from the JSON result of wbgetentities, returning a simplified version of that document.
+    Uses an `EntitySimplifier`, which is reused between calls with the same options. When simplifying many
+    entities, create one and call it directly.
 
     Args:
         doc (Union[dict, List[dict]]): JSON result from Wikidata wbgetentities API
-        lang (str): Wikimedia language code
+        lang (Union[str, List[str]]): Wikimedia language code, list of codes, or `ALL_LANGUAGES` (see `EntitySimplifier`)
         properties (list): list of Wikidata properties
         use_redirected_qid (bool, optional): whether to return the redirected QID value under the 'id' field instead of the original QID
             if there is one. Defaults to False.
+        label_source (optional): source of the labels of the entities that claims refer to, such as a
+            `label_index.LabelIndex` (see `EntitySimplifier`). Defaults to None.
 
     Returns:
         Union[dict, List[dict]]: dict if single record passed in; list if multiple records
     """
 
-    # if list of dicts, run this function for each dict
-    if isinstance(doc, list) and isinstance(doc[0], dict):
-        return [simplify_wbgetentities_result(item, lang, properties) for item in doc]
-
-    wd_type_mapping = {
-        "wikibase-entityid": "id",
-        "time": "time",
-        "monolingualtext": "text",
-        "quantity": "amount",
-    }
-
-    # check for redirected URL
-    if "redirects" in doc:
-        if use_redirected_qid:
-            newdoc = {"id": doc["redirects"]["to"]}
-        else:
-            newdoc = {"id": doc["redirects"]["from"]}
+    if not isinstance(lang, str):
+        lang = tuple(lang)
 
-    else:
-        newdoc = {"id": doc["id"]}
-
-    # add label(s)
-    if lang in doc.get("labels", {}):
-        newdoc["labels"] = doc["labels"][lang]["value"]
-
-    # add descriptions(s)
-    if lang in doc.get("descriptions", {}):
-        newdoc["descriptions"] = doc["descriptions"][lang]["value"]
-
-    # add aliases
-    if (len(doc.get("aliases", {})) > 0) and (lang in doc.get("aliases", {})):
-        newdoc["aliases"] = [i["value"] for i in doc["aliases"][lang]]
-    else:
-        newdoc["aliases"] = []
-
-    # add claims (property values)
-    newdoc["claims"] = {}
+    # if list of dicts, simplify each dict
+    if isinstance(doc, list) and isinstance(doc[0], dict):
+        return _get_simplifier(
+            lang, tuple(properties), False, label_source
+        ).simplify_batch(doc)
 
-    if "claims" in doc:
-        for p in properties:
-            if p in doc["claims"]:
-                claims = []
-                for i in doc["claims"][p]:
-                    try:
-                        value_type = i["mainsnak"]["datavalue"]["type"]
-                        if value_type in wd_type_mapping.keys():
-                            # Return specific value for certain types.
-                            value_name = wd_type_mapping[value_type]
-                            claims.append(
-                                i["mainsnak"]["datavalue"]["value"][value_name]
-                            )
-                        else:
-                            # Otherwise return the whole dictionary.
-                            claims.append(i["mainsnak"]["datavalue"]["value"])
-                    except KeyError:
-                        print(
-                            f"WARNING: property {p} with datatype {value_type} failed to process. Consider forking this code and implementing support for it."
-                        )
-
-                newdoc["claims"][p] = claims
-
-    return newdoc
+    return _get_simplifier(
+        lang, tuple(properties), use_redirected_qid, label_source
+    ).simplify(doc)
 
 
 def wiki_property_check(p):
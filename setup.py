@@ -25,6 +25,10 @@ setuptools.setup(
         "tqdm>=4.48.2",
         "requests==2.24.0",
     ],
+    extras_require={
+        "fast": ["orjson>=3.0"],
+        "parquet": ["pyarrow>=1.0"],
+    },
     py_modules=["cli", "elastic_wikidata"],
     packages=["elastic_wikidata"],
     entry_points="""
@@ -0,0 +1,595 @@
+"""
+Local HTTP stand-ins for the services elastic-wikidata talks to, so that tests can run offline.
+"""
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def make_entity(qid: str, p31: str = "Q5") -> dict:
+    """
+    An entity in the format returned by wbgetentities and found in the JSON dumps.
+    """
+
+    return {
+        "type": "item",
+        "id": qid,
+        "labels": {"en": {"language": "en", "value": f"label {qid}"}},
+        "descriptions": {"en": {"language": "en", "value": f"description {qid}"}},
+        "aliases": {"en": [{"language": "en", "value": f"alias {qid}"}]},
+        "claims": {
+            "P31": [
+                {
+                    "mainsnak": {
+                        "snaktype": "value",
+                        "property": "P31",
+                        "datavalue": {
+                            "value": {
+                                "entity-type": "item",
+                                "numeric-id": int(p31[1:]),
+                                "id": p31,
+                            },
+                            "type": "wikibase-entityid",
+                        },
+                    },
+                    "type": "statement",
+                    "rank": "normal",
+                }
+            ]
+        },
+    }
+
+
+class StandInServer:
+    """
+    Runs a `BaseHTTPRequestHandler` subclass in a background thread. Use as a context manager; the
+    server's URL is `self.url`.
+    """
+
+    def __init__(self, handler_class):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.server.stand_in = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    def send_json(self, body, status: int = 200, headers: dict = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_html(self, status: int, headers: dict = None):
+        data = f"<html><body><h1>Error {status}</h1></body></html>".encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class WbgetentitiesHandler(JSONHandler):
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        params = parse_qs(urlparse(self.path).query)
+        params.update(parse_qs(body.decode("utf-8")), method=["POST"])
+        self.answer(params)
+
+    def answer(self, params: dict):
+        stand_in = self.server.stand_in
+
+        with stand_in.lock:
+            stand_in.requests.append(params)
+            respond_with = stand_in.responses.pop(0) if stand_in.responses else None
+
+        if respond_with == 429:
+            return self.send_json({}, status=429, headers={"Retry-After": "0"})
+        if isinstance(respond_with, int):
+            return self.send_html(respond_with, headers={"Retry-After": "0"})
+        if respond_with == "maxlag":
+            return self.send_json(
+                {"error": {"code": "maxlag", "info": "Waiting for a database server"}},
+                headers={"Retry-After": "0"},
+            )
+
+        time.sleep(stand_in.delay)
+        ids = params["ids"][0].split("|")
+        self.send_json(
+            {"entities": {qid: stand_in.get_entity(qid) for qid in ids}, "success": 1}
+        )
+
+
+class WbgetentitiesStandIn(StandInServer):
+    """
+    Stand-in for the wbgetentities API. Every QID exists unless it's in `missing`. `responses` is a
+    queue of errors to send instead of results: 429, 'maxlag', or another status, sent with an HTML page. The parameters of each request are
+    recorded in `requests`, with `method` set to POST for POST requests. `delay` is the number of seconds
+    to wait before answering.
+    """
+
+    def __init__(self, missing: set = None):
+        super().__init__(WbgetentitiesHandler)
+        self.missing = missing or set()
+        self.requests = []
+        self.responses = []
+        self.delay = 0
+        self.lock = threading.Lock()
+        self.endpoint = f"{self.url}/w/api.php?action=wbgetentities&format=json"
+
+    def get_entity(self, qid: str) -> dict:
+        if qid in self.missing:
+            return {"id": qid, "missing": ""}
+
+        return dict(make_entity(qid), lastrevid=int(qid[1:]) + 1000)
+
+
+class SparqlHandler(JSONHandler):
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query)["query"][0])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.answer(parse_qs(body.decode("utf-8"))["query"][0])
+
+    def answer(self, query: str):
+        stand_in = self.server.stand_in
+
+        with stand_in.lock:
+            stand_in.queries.append(query)
+
+        var = re.search(r"select\s+(?:distinct\s+)?\?(\w+)", query, re.I).group(1)
+        iris = [f"http://www.wikidata.org/entity/{qid}" for qid in stand_in.qids]
+
+        lower = re.search(r"\)\) >= (\d+)", query)
+        upper = re.search(r"\)\) < (\d+)", query)
+        if lower:
+            iris = [iri for iri in iris if int(iri.split("/Q")[-1]) >= int(lower[1])]
+        if upper:
+            iris = [iri for iri in iris if int(iri.split("/Q")[-1]) < int(upper[1])]
+
+        after = re.search(r'FILTER\(STR\(\?\w+\) > "([^"]*)"\)', query)
+        if after:
+            iris = [iri for iri in iris if iri > after[1]]
+
+        if re.search(r"order by", query, re.I):
+            iris = sorted(iris)
+
+        offset = re.search(r"offset\s+(\d+)", query, re.I)
+        if offset:
+            iris = iris[int(offset[1]) :]
+        limit = re.search(r"limit\s+(\d+)", query, re.I)
+        if limit:
+            iris = iris[: int(limit[1])]
+
+        self.send_json(
+            {
+                "head": {"vars": [var]},
+                "results": {
+                    "bindings": [{var: {"type": "uri", "value": iri}} for iri in iris]
+                },
+            }
+        )
+
+
+class SparqlStandIn(StandInServer):
+    """
+    Stand-in for a SPARQL endpoint which answers any query with `qids`, applying only the filters, ordering,
+    LIMIT and OFFSET added by pagination. Queries are recorded in `queries`.
+    """
+
+    def __init__(self, qids: list):
+        super().__init__(SparqlHandler)
+        self.qids = qids
+        self.queries = []
+        self.lock = threading.Lock()
+        self.endpoint = f"{self.url}/sparql"
+
+
+class ElasticsearchHandler(JSONHandler):
+    """
+    Implements the parts of the Elasticsearch REST API used by elastic-wikidata.
+    """
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def route(self, method: str):
+        stand_in = self.server.stand_in
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.read_body()
+
+        with stand_in.lock:
+            stand_in.requests.append((method, url.path, params))
+            status, response = stand_in.handle(method, parts, params, body)
+
+        if method == "HEAD":
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_json(response, status=status)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_HEAD(self):
+        self.route("HEAD")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+
+class ElasticsearchStandIn(StandInServer):
+    """
+    In-memory stand-in for an Elasticsearch cluster. `indices` maps index names to {'docs', 'settings',
+    'mappings', 'aliases'}. Bulk requests can be rejected by adding to `bulk_responses`: a status such as 429
+    or 500 fails a whole request, and 'partial' rejects every other item in it with
+    es_rejected_execution_exception. Requests larger than `max_bulk_bytes` fail with 413. Documents with IDs
+    in `fail_ids` always fail with a mapper_parsing_exception.
+    """
+
+    def __init__(self):
+        super().__init__(ElasticsearchHandler)
+        self.indices = {}
+        self.requests = []
+        self.bulk_requests = []
+        self.bulk_responses = []
+        self.max_bulk_bytes = None
+        self.fail_ids = set()
+        self.lock = threading.Lock()
+        self._next_id = 0
+
+    def docs(self, index: str) -> dict:
+        return self.indices[self.resolve(index)[0]]["docs"]
+
+    def resolve(self, name: str) -> list:
+        """
+        Returns the names of the indices matching an index name, alias or wildcard pattern.
+        """
+
+        if name in self.indices:
+            return [name]
+
+        aliased = [i for i, index in self.indices.items() if name in index["aliases"]]
+        if aliased:
+            return aliased
+
+        if name.endswith("*"):
+            return [i for i in self.indices if i.startswith(name[:-1])]
+
+        return []
+
+    def create_index(self, name: str, body: dict = None):
+        body = body or {}
+        settings = {
+            "number_of_shards": "1",
+            "number_of_replicas": "1",
+            "refresh_interval": "1s",
+        }
+        settings.update(_flatten_settings(body.get("settings", {})))
+        self.indices[name] = {
+            "docs": {},
+            "settings": settings,
+            "mappings": body.get("mappings", {}),
+            "aliases": set(body.get("aliases", {}).keys()),
+        }
+
+    def handle(self, method: str, parts: list, params: dict, body: bytes) -> tuple:
+        if not parts:
+            return 200, {"version": {"number": "7.8.1"}}
+
+        if parts[-1] == "_bulk":
+            return self.bulk(parts[0] if len(parts) == 2 else None, body)
+
+        if parts[0] == "_search" and parts[-1] == "scroll":
+            if method == "DELETE":
+                return 200, {"succeeded": True}
+            return 200, {
+                "_scroll_id": "scroll",
+                "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                "hits": {"hits": []},
+            }
+
+        if parts[0] == "_aliases":
+            return self.update_aliases(json.loads(body))
+
+        if parts[0] == "_alias" or (len(parts) == 2 and parts[1] == "_alias"):
+            name = parts[-1]
+            indices = [
+                i for i, index in self.indices.items() if name in index["aliases"]
+            ]
+            if not indices:
+                return 404, {"error": f"alias [{name}] missing", "status": 404}
+            return 200, {i: {"aliases": {name: {}}} for i in indices}
+
+        if parts[0] == "_cat" and parts[1] == "indices":
+            return 200, [{"index": i} for i in self.resolve(parts[2])]
+
+        name = parts[0]
+        indices = self.resolve(name)
+
+        if len(parts) == 1:
+            if method == "HEAD":
+                return (200 if indices else 404), None
+            if method == "PUT":
+                if name in self.indices:
+                    return 400, {
+                        "error": {"type": "resource_already_exists_exception"},
+                        "status": 400,
+                    }
+                self.create_index(name, json.loads(body) if body else None)
+                return 200, {"acknowledged": True, "index": name}
+            if method == "DELETE":
+                if not indices:
+                    return 404, {"error": "index_not_found_exception", "status": 404}
+                for i in indices:
+                    del self.indices[i]
+                return 200, {"acknowledged": True}
+            if method == "GET":
+                return 200, {
+                    i: {
+                        "aliases": {a: {} for a in self.indices[i]["aliases"]},
+                        "settings": {"index": self.indices[i]["settings"]},
+                    }
+                    for i in indices
+                }
+
+        if not indices:
+            return 404, {"error": {"type": "index_not_found_exception"}, "status": 404}
+
+        action = parts[1]
+
+        if action == "_settings":
+            if method == "PUT":
+                settings = _flatten_settings(json.loads(body))
+                for i in indices:
+                    self.indices[i]["settings"].update(settings)
+                return 200, {"acknowledged": True}
+            return 200, {
+                i: {"settings": {"index": self.indices[i]["settings"]}} for i in indices
+            }
+
+        if action in ("_refresh", "_forcemerge", "_flush"):
+            return 200, {"_shards": {"failed": 0}}
+
+        if action == "_count":
+            return 200, {"count": sum(len(self.indices[i]["docs"]) for i in indices)}
+
+        if action == "_mget":
+            docs = self.indices[indices[0]]["docs"]
+            return 200, {
+                "docs": [
+                    (
+                        {"_id": _id, "found": True, "_source": docs[_id]}
+                        if _id in docs
+                        else {"_id": _id, "found": False}
+                    )
+                    for _id in json.loads(body)["ids"]
+                ]
+            }
+
+        if action == "_search":
+            hits = [
+                {"_index": i, "_id": _id, "_source": source}
+                for i in indices
+                for _id, source in self.indices[i]["docs"].items()
+            ]
+            return 200, {
+                "_scroll_id": "scroll",
+                "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                "hits": {"total": {"value": len(hits)}, "hits": hits},
+            }
+
+        if action == "_doc" and method == "GET":
+            docs = self.indices[indices[0]]["docs"]
+            if parts[2] not in docs:
+                return 404, {"found": False}
+            return 200, {"_id": parts[2], "found": True, "_source": docs[parts[2]]}
+
+        return 400, {"error": f"{method} {'/'.join(parts)} not supported"}
+
+    def bulk(self, default_index: str, body: bytes) -> tuple:
+        lines = body.decode("utf-8").splitlines()
+        self.bulk_requests.append(len(body))
+        respond_with = self.bulk_responses.pop(0) if self.bulk_responses else None
+
+        if self.max_bulk_bytes is not None and len(body) > self.max_bulk_bytes:
+            respond_with = 413
+
+        if respond_with == 429:
+            return 429, {
+                "error": {"type": "es_rejected_execution_exception"},
+                "status": 429,
+            }
+        if isinstance(respond_with, int):
+            return respond_with, {
+                "error": {"type": "exception"},
+                "status": respond_with,
+            }
+
+        items = []
+        i = 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            op_type, meta = next(iter(action.items()))
+            index = self.resolve(meta.get("_index", default_index))
+            index = index[0] if index else meta.get("_index", default_index)
+            if index not in self.indices:
+                self.create_index(index)
+            docs = self.indices[index]["docs"]
+
+            if op_type == "delete":
+                i += 1
+                source = None
+            else:
+                source = json.loads(lines[i + 1])
+                i += 2
+
+            _id = meta.get("_id")
+            if _id is None:
+                self._next_id += 1
+                _id = f"auto-{self._next_id}"
+
+            if respond_with == "partial" and len(items) % 2 == 0:
+                items.append(
+                    {
+                        op_type: {
+                            "_index": index,
+                            "_id": _id,
+                            "status": 429,
+                            "error": {"type": "es_rejected_execution_exception"},
+                        }
+                    }
+                )
+                continue
+
+            if _id in self.fail_ids:
+                items.append(
+                    {
+                        op_type: {
+                            "_index": index,
+                            "_id": _id,
+                            "status": 400,
+                            "error": {"type": "mapper_parsing_exception"},
+                        }
+                    }
+                )
+                continue
+
+            if op_type == "delete":
+                status = 200 if docs.pop(_id, None) is not None else 404
+            elif op_type == "update":
+                status = 200 if _id in docs else 404
+                if _id in docs:
+                    docs[_id] = dict(docs[_id], **source["doc"])
+            else:
+                status = 200 if _id in docs else 201
+                docs[_id] = source
+
+            items.append(
+                {op_type: {"_index": index, "_id": _id, "status": status, "result": ""}}
+            )
+
+        errors = any(
+            not 200 <= next(iter(item.values()))["status"] < 300 for item in items
+        )
+        return 200, {"took": 1, "errors": errors, "items": items}
+
+    def update_aliases(self, body: dict) -> tuple:
+        for action in body["actions"]:
+            op_type, params = next(iter(action.items()))
+            for i in self.resolve(params["index"]):
+                if op_type == "add":
+                    self.indices[i]["aliases"].add(params["alias"])
+                elif op_type == "remove":
+                    self.indices[i]["aliases"].discard(params["alias"])
+                elif op_type == "remove_index":
+                    del self.indices[i]
+        return 200, {"acknowledged": True}
+
+
+def _flatten_settings(settings: dict, prefix: str = "") -> dict:
+    """
+    {'index': {'refresh_interval': -1}} -> {'refresh_interval': '-1'}
+    """
+
+    flat = {}
+
+    for key, value in settings.items():
+        key = f"{prefix}{key}"
+        if key.startswith("index."):
+            key = key[len("index.") :]
+        if key == "index" and isinstance(value, dict):
+            flat.update(_flatten_settings(value))
+        elif isinstance(value, dict):
+            flat.update(_flatten_settings(value, prefix=f"{key}."))
+        else:
+            flat[key] = str(value) if value is not None else None
+
+    return flat
+
+
+class EventStreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        stand_in.requests.append(dict(self.headers))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        self.wfile.write(b":ok\n\n")
+
+        for i, event in enumerate(stand_in.events):
+            self.wfile.write(b"event: message\n")
+            self.wfile.write(f"id: {i}\n".encode("utf-8"))
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class EventStreamStandIn(StandInServer):
+    """
+    Stand-in for Wikimedia EventStreams. Sends `events` as Server-Sent Events then closes the connection.
+    """
+
+    def __init__(self, events: list):
+        super().__init__(EventStreamHandler)
+        self.events = events
+        self.requests = []
+
+
+def recentchange(title: str, change_type: str = "edit", **kwargs) -> dict:
+    """
+    An event from the recentchange stream.
+    """
+
+    namespace = 120 if title.startswith("Property:") else 0
+    return dict(
+        {
+            "type": change_type,
+            "namespace": namespace,
+            "title": title,
+            "wiki": "wikidatawiki",
+        },
+        **kwargs,
+    )
@@ -0,0 +1,221 @@
+from elastic_wikidata import bulk, dump_to_es
+from elasticsearch import Elasticsearch
+import json
+import os
+import pytest
+from stand_ins import ElasticsearchStandIn
+
+backoff_delay = bulk.backoff_delay
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(bulk, "backoff_delay", lambda *args: 0)
+
+
+def client(es) -> Elasticsearch:
+    return Elasticsearch([es.url], max_retries=0)
+
+
+def actions(n: int) -> list:
+    return [{"id": f"Q{i}", "labels": f"label Q{i}"} for i in range(1, n + 1)]
+
+
+def index(es, docs, **kwargs) -> tuple:
+    indexer = bulk.BulkIndexer(client(es), "test", **kwargs)
+    results = list(indexer.index(docs, dump_to_es.expand_action))
+
+    return indexer, results
+
+
+def test_controller_aimd():
+    controller = bulk.AdaptiveController(chunk_size=100, max_concurrency=4)
+    assert (controller.chunk_size, controller.concurrency) == (100, 1)
+
+    for _ in range(3):
+        controller.record(latency=0.1, rejected=False)
+    assert controller.chunk_size == 130
+    assert controller.concurrency == 3
+
+    controller.record(latency=10, rejected=False)
+    assert controller.chunk_size == 97
+    assert controller.concurrency == 3
+
+    controller.record(latency=0.1, rejected=True)
+    assert controller.chunk_size == 48
+    assert controller.concurrency == 1
+
+    for _ in range(10):
+        controller.record(latency=0.1, rejected=True)
+    assert controller.chunk_size == controller.min_chunk_size == 10
+
+    for _ in range(1000):
+        controller.record(latency=0.1, rejected=False)
+    assert controller.chunk_size == controller.max_chunk_size == 1000
+    assert controller.concurrency == 4
+
+
+def test_controller_fixed():
+    controller = bulk.AdaptiveController(
+        chunk_size=100, max_concurrency=4, adaptive=False
+    )
+    controller.record(latency=0.1, rejected=True)
+
+    assert (controller.chunk_size, controller.concurrency) == (100, 4)
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        delays = [backoff_delay(attempt, 2, 60) for _ in range(100)]
+        assert all(0 <= d <= min(60, 2 * 2**attempt) for d in delays)
+        # jittered, so clients rejected together don't retry together
+        assert len(set(delays)) > 1
+
+
+def test_retries_rejections(es):
+    es.bulk_responses = [429, "partial", "partial"]
+    indexer, results = index(es, actions(20), chunk_size=20)
+
+    assert all(ok for ok, _ in results)
+    assert len(results) == 20
+    assert len(es.docs("test")) == 20
+    # the whole request, then half of its items, then a quarter
+    assert len(es.bulk_requests) == 4
+    assert indexer.stats["retries"] == 3
+    assert indexer.stats["failed"] == 0
+
+
+def test_retries_server_errors(es):
+    es.bulk_responses = [500, 503]
+    indexer, results = index(es, actions(20), chunk_size=20)
+
+    assert all(ok for ok, _ in results)
+    assert len(es.docs("test")) == 20
+    assert indexer.stats["retries"] == 2
+
+
+def test_splits_requests_too_large(es):
+    es.max_bulk_bytes = 600
+    indexer, results = index(es, actions(40), chunk_size=20)
+
+    assert all(ok for ok, _ in results)
+    assert [item["index"]["_id"] for _, item in results] == [
+        f"Q{i}" for i in range(1, 41)
+    ]
+    assert len(es.docs("test")) == 40
+    # later chunks are kept below the size that was too large
+    assert indexer.max_chunk_bytes <= 600
+
+
+def test_failed_requests_are_dead_letters(es, tmp_path):
+    path = str(tmp_path / "dead_letters.ndjson")
+    es.bulk_responses = [400, None, 500, 500]
+    indexer, results = index(
+        es, actions(15), chunk_size=5, dead_letter_path=path, max_retries=1
+    )
+
+    # the first request is invalid and the third fails twice, but the load carries on
+    failed = [item["index"]["_id"] for ok, item in results if not ok]
+    assert failed == [f"Q{i}" for i in range(1, 6)] + [f"Q{i}" for i in range(11, 16)]
+    assert sorted(es.docs("test")) == sorted(f"Q{i}" for i in range(6, 11))
+
+    with open(path) as f:
+        assert len(f.readlines()) == 10
+
+
+def test_deleting_missing_documents_succeeds(es, tmp_path):
+    path = str(tmp_path / "dead_letters.ndjson")
+    docs = actions(2) + [dump_to_es.delete_action(qid) for qid in ("Q1", "Q3")]
+    indexer, results = index(es, docs, chunk_size=2, dead_letter_path=path)
+
+    # Q3 was never indexed
+    assert [bulk._status(item) for _, item in results] == [201, 201, 200, 404]
+    assert all(ok for ok, _ in results)
+    assert indexer.stats["failed"] == 0
+    assert es.docs("test") == {"Q2": {"id": "Q2", "labels": "label Q2"}}
+    assert not os.path.exists(path)
+
+
+def test_adaptive_backs_off(es, monkeypatch):
+    history = []
+    record = bulk.AdaptiveController.record
+
+    def record_history(self, latency, rejected):
+        record(self, latency, rejected)
+        history.append((self.chunk_size, self.concurrency))
+
+    monkeypatch.setattr(bulk.AdaptiveController, "record", record_history)
+    es.bulk_responses = [None, None, None, 429]
+    _, results = index(es, actions(200), chunk_size=10, concurrency=4, adaptive=True)
+
+    assert len(es.docs("test")) == 200
+    assert all(ok for ok, _ in results)
+    # chunk size and concurrency grow while requests succeed, and are halved by the rejection
+    assert history[0] == (11, 2)
+    assert max(concurrency for _, concurrency in history) > 2
+    halved = [
+        (before, after)
+        for before, after in zip(history, history[1:])
+        if after[0] == before[0] // 2
+    ]
+    assert len(halved) == 1
+    assert halved[0][1][1] == max(1, halved[0][0][1] // 2)
+    assert history[-1][0] > halved[0][1][0]
+
+
+def test_dead_letters(es, tmp_path):
+    path = str(tmp_path / "dead_letters.ndjson")
+    es.fail_ids = {"Q2", "Q4"}
+    es.bulk_responses = ["partial"] * 3
+
+    indexer, results = index(
+        es, actions(5), dead_letter_path=path, max_retries=1, queue_size=1
+    )
+
+    failed = sorted(item["index"]["_id"] for ok, item in results if not ok)
+    # Q1 and Q5 are rejected twice, Q2 and Q4 can't be indexed
+    assert failed == ["Q1", "Q2", "Q4", "Q5"]
+    assert indexer.stats["failed"] == 4
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(r["source"]["id"] for r in records) == failed
+    assert records[0]["action"] == {"index": {"_id": records[0]["source"]["id"]}}
+    assert "error" in next(iter(records[0]["error"].values()))
+
+    # replay once the cluster has recovered
+    es.fail_ids.clear()
+    replayed = list(
+        bulk.BulkIndexer(client(es), "test").index(bulk.read_dead_letters(path))
+    )
+    assert all(ok for ok, _ in replayed)
+    assert len(es.docs("test")) == 5
+
+
+def test_no_dead_letter_file_without_failures(es, tmp_path):
+    path = tmp_path / "dead_letters.ndjson"
+    index(es, actions(5), dead_letter_path=str(path))
+
+    assert not path.exists()
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_chunks_are_yielded_in_order(es, concurrency):
+    _, results = index(es, actions(100), chunk_size=7, concurrency=concurrency)
+
+    assert [item["index"]["_id"] for _, item in results] == [
+        f"Q{i}" for i in range(1, 101)
+    ]
+
+
+def test_max_chunk_bytes(es):
+    index(es, actions(100), max_chunk_bytes=512)
+
+    assert max(es.bulk_requests) <= 512
+    assert len(es.docs("test")) == 100
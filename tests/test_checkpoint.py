@@ -0,0 +1,327 @@
+from elastic_wikidata import (
+    bulk,
+    dump_split,
+    dump_to_es,
+    index_versions,
+    sparql_helpers,
+    sparql_to_es,
+    wd_entities,
+)
+from elastic_wikidata.checkpoint import Checkpoint, WatermarkTracker
+from elastic_wikidata.entity_filter import EntityFilter
+import gzip
+import json
+import pytest
+from stand_ins import (
+    make_entity,
+    ElasticsearchStandIn,
+    SparqlStandIn,
+    WbgetentitiesStandIn,
+)
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+@pytest.fixture
+def dump_path(tmp_path):
+    path = tmp_path / "dump.ndjson"
+
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(1, 101):
+            f.write(json.dumps(make_entity(f"Q{i}")) + "\n")
+
+    return str(path)
+
+
+@pytest.fixture
+def interrupt(monkeypatch):
+    """
+    Makes the bulk indexer stop after `interrupt.after` results, and records the IDs of the documents it's sent.
+    """
+
+    index = bulk.BulkIndexer.index
+    sent = []
+
+    def interrupted_index(self, actions, expand_action_callback=None):
+        for n, (ok, item) in enumerate(index(self, actions, expand_action_callback)):
+            if interrupted_index.after is not None and n == interrupted_index.after:
+                raise KeyboardInterrupt
+
+            sent.append(item["index"]["_id"])
+            yield ok, item
+
+    interrupted_index.after = None
+    interrupted_index.sent = sent
+    monkeypatch.setattr(bulk.BulkIndexer, "index", interrupted_index)
+
+    return interrupted_index
+
+
+def load(es, dump, checkpoint, **kwargs) -> dump_to_es.processDump:
+    d = dump_to_es.processDump(
+        dump=dump,
+        es_credentials={
+            "ELASTICSEARCH_CLUSTER": es.url,
+            "ELASTICSEARCH_USER": "user",
+            "ELASTICSEARCH_PASSWORD": "password",
+        },
+        index_name="test",
+        disable_refresh_on_index=False,
+        checkpoint=checkpoint,
+        **kwargs,
+    )
+    d.start_elasticsearch()
+    d.dump_to_es()
+
+    return d
+
+
+def test_watermark_tracker():
+    tracker = WatermarkTracker({"b": 5})
+
+    for i in range(1, 5):
+        tracker.add(f"Q{i}", i * 10, "a")
+    tracker.add("Q10", 6, "b")
+    assert len(tracker) == 5
+
+    # acknowledged out of order, so the watermark only moves past contiguous acknowledgements
+    tracker.ack("Q2")
+    assert "a" not in tracker.watermarks
+    tracker.ack("Q1")
+    assert tracker.watermarks["a"] == 20
+    tracker.ack("Q4")
+    assert tracker.watermarks["a"] == 20
+    tracker.ack("Q3")
+    assert tracker.watermarks["a"] == 40
+
+    # lanes are independent
+    assert tracker.watermarks["b"] == 5
+    tracker.ack("Q10")
+    assert tracker.watermarks == {"a": 40, "b": 6}
+
+    tracker.ack("Q100")
+    assert len(tracker) == 0
+
+
+def test_watermark_tracker_duplicate_ids():
+    tracker = WatermarkTracker()
+
+    # Q2 is in both lanes, as when shards of overlapping split specs are loaded
+    tracker.add("Q1", 10, "a")
+    tracker.add("Q2", 20, "a")
+    tracker.add("Q2", 5, "b")
+    tracker.add("Q3", 10, "b")
+    assert len(tracker) == 4
+
+    tracker.ack("Q1")
+    tracker.ack("Q2")
+    assert tracker.watermarks == {"a": 20}
+    tracker.ack("Q2")
+    tracker.ack("Q3")
+    assert tracker.watermarks == {"a": 20, "b": 10}
+    assert len(tracker) == 0
+
+    # an ID added again in the same lane only replaces its earlier action
+    tracker.add("Q4", 30, "a")
+    tracker.add("Q4", 40, "a")
+    assert len(tracker) == 1
+    tracker.ack("Q4")
+    assert tracker.watermarks["a"] == 40
+    assert len(tracker) == 0
+
+
+def test_checkpoint_file(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path, "dump", "dump.ndjson")
+    checkpoint.add("Q1", 100, "dump")
+    checkpoint.ack("Q1")
+    checkpoint.save()
+
+    assert Checkpoint(path, "dump", "dump.ndjson", resume=True).watermarks == {
+        "dump": 100
+    }
+    # without resume the load starts again
+    assert Checkpoint(path, "dump", "dump.ndjson").watermarks == {}
+
+    with pytest.raises(ValueError):
+        Checkpoint(path, "dump", "other.ndjson", resume=True)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_resume_dump(es, dump_path, tmp_path, interrupt, workers):
+    path = str(tmp_path / "checkpoint.json")
+    interrupt.after = 45
+
+    with pytest.raises(KeyboardInterrupt):
+        load(
+            es,
+            dump_path,
+            Checkpoint(path, "dump", dump_path),
+            chunk_size=10,
+            bulk_threads=2,
+            workers=workers,
+            batch_size=7,
+        )
+
+    checkpoint = Checkpoint(path, "dump", dump_path, resume=True)
+    with open(dump_path, "rb") as f:
+        lines = f.readlines()
+    assert checkpoint.watermarks["dump"] == sum(len(line) for line in lines[:45])
+
+    interrupt.after = None
+    interrupt.sent.clear()
+    load(es, dump_path, checkpoint, workers=workers, batch_size=7)
+
+    assert interrupt.sent == [f"Q{i}" for i in range(46, 101)]
+    assert len(es.docs("test")) == 100
+
+
+def test_resume_build(es, dump_path, tmp_path, interrupt, monkeypatch):
+    names = iter(["test-20200801-120000", "test-20200801-130000"])
+    monkeypatch.setattr(
+        index_versions, "versioned_index_name", lambda alias: next(names)
+    )
+    path = str(tmp_path / "checkpoint.json")
+    interrupt.after = 40
+
+    with pytest.raises(KeyboardInterrupt):
+        load(
+            es,
+            dump_path,
+            Checkpoint(path, "dump", dump_path),
+            chunk_size=10,
+            build_new_index=True,
+        )
+
+    checkpoint = Checkpoint(path, "dump", dump_path, resume=True)
+    assert checkpoint.index == "test-20200801-120000"
+
+    # the resumed load carries on with the index that was being built, and points the alias at it
+    interrupt.after = None
+    load(es, dump_path, checkpoint, build_new_index=True)
+
+    assert list(es.indices) == ["test-20200801-120000"]
+    assert es.resolve("test") == ["test-20200801-120000"]
+    assert len(es.docs("test")) == 100
+
+    # the watermarks are no use without the index they were saved for
+    es.indices.clear()
+    with pytest.raises(ValueError):
+        load(
+            es,
+            dump_path,
+            Checkpoint(path, "dump", dump_path, resume=True),
+            build_new_index=True,
+        )
+
+    # nor can they be used for a load into the alias without building
+    with pytest.raises(ValueError):
+        load(es, dump_path, Checkpoint(path, "dump", dump_path, resume=True))
+
+
+def test_resume_load_with_build(es, dump_path, tmp_path, interrupt):
+    path = str(tmp_path / "checkpoint.json")
+    interrupt.after = 40
+
+    with pytest.raises(KeyboardInterrupt):
+        load(es, dump_path, Checkpoint(path, "dump", dump_path), chunk_size=10)
+
+    # building a new index from the watermarks would leave out what was loaded before them
+    interrupt.after = None
+    with pytest.raises(ValueError):
+        load(
+            es,
+            dump_path,
+            Checkpoint(path, "dump", dump_path, resume=True),
+            build_new_index=True,
+        )
+
+    assert list(es.indices) == ["test"]
+
+
+def test_resume_gzip_dump(es, tmp_path, dump_path, interrupt):
+    gz_path = str(tmp_path / "dump.ndjson.gz")
+    with open(dump_path, "rb") as f, gzip.open(gz_path, "wb") as gz:
+        gz.write(f.read())
+
+    path = str(tmp_path / "checkpoint.json")
+    interrupt.after = 30
+
+    with pytest.raises(KeyboardInterrupt):
+        load(es, gz_path, Checkpoint(path, "dump", gz_path), chunk_size=10)
+
+    interrupt.after = None
+    interrupt.sent.clear()
+    load(es, gz_path, Checkpoint(path, "dump", gz_path, resume=True))
+
+    assert interrupt.sent == [f"Q{i}" for i in range(31, 101)]
+
+
+def test_resume_shards(es, tmp_path, dump_path, interrupt):
+    shards = tmp_path / "shards"
+    dump_split.split_dump(
+        dump_path, str(shards), {"all": EntityFilter()}, shard_size=30
+    )
+    shards = str(shards / "all")
+    path = str(tmp_path / "checkpoint.json")
+    interrupt.after = 45
+
+    with pytest.raises(KeyboardInterrupt):
+        load(es, shards, Checkpoint(path, "dump", shards), chunk_size=10)
+
+    # each shard is a lane, and the first is complete
+    checkpoint = Checkpoint(path, "dump", shards, resume=True)
+    assert sorted(checkpoint.watermarks) == ["part-00000.ndjson", "part-00001.ndjson"]
+
+    interrupt.after = None
+    interrupt.sent.clear()
+    load(es, shards, checkpoint)
+
+    assert interrupt.sent == [f"Q{i}" for i in range(46, 101)]
+    assert len(es.docs("test")) == 100
+
+
+def test_resume_query(es, tmp_path, interrupt, monkeypatch):
+    def local_init(self):
+        self.endpoint = wikidata.endpoint
+        self.properties = ["info", "labels", "aliases", "claims", "descriptions"]
+
+    def entities(checkpoint):
+        return sparql_to_es.iter_entities_from_query(
+            "SELECT ?item WHERE { ?item wdt:P31 wd:Q5 }",
+            page_size=20,
+            slices=2,
+            endpoint_url=sparql.endpoint,
+            checkpoint=checkpoint,
+        )
+
+    path = str(tmp_path / "checkpoint.json")
+    qids = [f"Q{i}" for i in range(1, 201)]
+
+    with SparqlStandIn(qids) as sparql, WbgetentitiesStandIn() as wikidata:
+        monkeypatch.setattr(wd_entities.get_entities, "__init__", local_init)
+        monkeypatch.setattr(sparql_helpers, "MAX_QID", 200)
+        wikidata.missing.add("Q3")
+        interrupt.after = 80
+
+        checkpoint = Checkpoint(path, "query", "query:2")
+        with pytest.raises(KeyboardInterrupt):
+            load(es, entities(checkpoint), checkpoint, chunk_size=10)
+
+        first_run = set(interrupt.sent)
+        interrupt.after = None
+        interrupt.sent.clear()
+        sparql.queries.clear()
+
+        checkpoint = Checkpoint(path, "query", "query:2", resume=True)
+        assert set(checkpoint.watermarks) == {"0", "1"}
+        load(es, entities(checkpoint), checkpoint)
+
+    # nothing is missed, and only the slices' remaining pages are queried again
+    assert first_run | set(interrupt.sent) == set(qids)
+    assert len(interrupt.sent) < len(qids)
+    assert all("FILTER(STR(?item) >" in q for q in sparql.queries)
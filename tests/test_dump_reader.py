@@ -0,0 +1,129 @@
+from elastic_wikidata import dump_reader
+import bz2
+import gzip
+import json
+import shutil
+import subprocess
+import pytest
+
+ENTITIES = [{"type": "item", "id": f"Q{i}", "labels": {}} for i in range(1, 6)]
+
+
+def array_dump() -> bytes:
+    """Entities in the format of the official dumps: a JSON array with one entity per line."""
+
+    lines = [json.dumps(entity) for entity in ENTITIES]
+
+    return ("[\n" + ",\n".join(lines) + "\n]\n").encode("utf-8")
+
+
+def ndjson_dump() -> bytes:
+    return "".join(json.dumps(entity) + "\n" for entity in ENTITIES).encode("utf-8")
+
+
+def read_dump(path, **kwargs) -> list:
+    with dump_reader.open_dump(str(path), **kwargs) as f:
+        return [
+            dump_reader.loads_dump_line(line) for line in dump_reader.iter_dump_lines(f)
+        ]
+
+
+def test_array_dump_is_valid_json():
+    assert json.loads(array_dump()) == ENTITIES
+
+
+@pytest.mark.parametrize("contents", [array_dump(), ndjson_dump()])
+@pytest.mark.parametrize("use_external_decompressor", [True, False])
+@pytest.mark.parametrize(
+    "suffix,compress",
+    [("json", None), ("json.gz", gzip.compress), ("json.bz2", bz2.compress)],
+)
+def test_read_dump(tmp_path, contents, use_external_decompressor, suffix, compress):
+    path = tmp_path / f"dump.{suffix}"
+    path.write_bytes(compress(contents) if compress else contents)
+
+    assert (
+        read_dump(path, use_external_decompressor=use_external_decompressor) == ENTITIES
+    )
+
+
+def test_read_multistream_bz2(tmp_path):
+    # parallel compressors such as pbzip2 write one bz2 stream per block
+    path = tmp_path / "dump.json.bz2"
+    contents = array_dump()
+    path.write_bytes(bz2.compress(contents[:40]) + bz2.compress(contents[40:]))
+
+    assert read_dump(path, use_external_decompressor=False) == ENTITIES
+
+
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="zstd is not installed")
+def test_read_zstd_dump(tmp_path):
+    path = tmp_path / "dump.json"
+    path.write_bytes(array_dump())
+    subprocess.run(["zstd", "-q", str(path)], check=True)
+
+    zstd_path = tmp_path / "dump.json.zst"
+    assert dump_reader.detect_compression(str(zstd_path)) == "zstd"
+    assert read_dump(zstd_path) == ENTITIES
+
+
+def test_stop_reading_early(tmp_path):
+    path = tmp_path / "dump.json.gz"
+    path.write_bytes(gzip.compress(array_dump() * 1000))
+
+    with dump_reader.open_dump(str(path)) as f:
+        line = next(dump_reader.iter_dump_lines(f))
+
+    assert dump_reader.loads_dump_line(line) == ENTITIES[0]
+
+
+@pytest.mark.skipif(
+    dump_reader.find_external_decompressor("gzip") is None,
+    reason="no gzip decompressor is installed",
+)
+def test_read_truncated_dump(tmp_path):
+    path = tmp_path / "dump.json.gz"
+    contents = gzip.compress(
+        b"".join(
+            json.dumps(dict(ENTITIES[0], id=f"Q{i}", labels={"en": "x" * 50})).encode()
+            + b"\n"
+            for i in range(100_000)
+        )
+    )
+    path.write_bytes(contents[: len(contents) // 2])
+
+    # the decompressor's exit code is only known once it's been waited for
+    for _ in range(5):
+        with pytest.raises(IOError):
+            with dump_reader.open_dump(str(path)) as f:
+                list(dump_reader.iter_dump_lines(f))
+
+
+def test_loads_dump_line():
+    assert dump_reader.loads_dump_line(b'{"id": "Q1"},\n') == {"id": "Q1"}
+    assert dump_reader.loads_dump_line(b'  {"id": "Q1"}\n') == {"id": "Q1"}
+
+
+def test_read_entity_document(tmp_path):
+    response = {
+        "entities": dict(
+            {entity["id"]: entity for entity in ENTITIES},
+            Q100={"id": "Q100", "missing": ""},
+        ),
+        "success": 1,
+    }
+    (tmp_path / "response.json").write_text(json.dumps(response, indent=2))
+    with gzip.open(tmp_path / "list.json.gz", "wt") as f:
+        json.dump(ENTITIES, f)
+    (tmp_path / "entity.json").write_text(json.dumps(ENTITIES[0]))
+
+    assert dump_reader.read_entity_document(str(tmp_path / "response.json")) == ENTITIES
+    assert dump_reader.read_entity_document(str(tmp_path / "list.json.gz")) == ENTITIES
+    assert dump_reader.read_entity_document(str(tmp_path / "entity.json")) == [
+        ENTITIES[0]
+    ]
+
+    assert dump_reader.is_entity_document("response.json")
+    assert dump_reader.is_entity_document("list.JSON.gz")
+    assert not dump_reader.is_entity_document("part-00000.ndjson.gz")
+    assert not dump_reader.is_entity_document("latest-all.jsonl")
@@ -0,0 +1,149 @@
+from elastic_wikidata import dump_split, dump_to_es
+from elastic_wikidata.dump_reader import dump_files, read_dump_lines
+from elastic_wikidata.entity_filter import EntityFilter
+from elastic_wikidata.wd_entities import EntitySimplifier
+import bz2
+import json
+import pytest
+from stand_ins import make_entity, ElasticsearchStandIn
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+@pytest.fixture
+def dump_path(tmp_path):
+    """
+    An array-wrapped dump of 60 entities, every third of which is a painting (P31 = Q3305213) and every fifth
+    of which has coordinates (P625).
+    """
+
+    docs = []
+    for i in range(1, 61):
+        doc = make_entity(f"Q{i}", "Q3305213" if i % 3 == 0 else "Q5")
+        if i % 5 == 0:
+            doc["claims"]["P625"] = [
+                {
+                    "mainsnak": {
+                        "snaktype": "value",
+                        "property": "P625",
+                        "datavalue": {
+                            "value": {"latitude": 51.5, "longitude": -0.17},
+                            "type": "globecoordinate",
+                        },
+                    }
+                }
+            ]
+        docs.append(doc)
+
+    path = tmp_path / "dump.json.bz2"
+    with bz2.open(path, "wt", encoding="utf-8") as f:
+        f.write("[\n" + ",\n".join(json.dumps(doc) for doc in docs) + "\n]\n")
+
+    return str(path)
+
+
+def qids(path) -> list:
+    return [json.loads(line)["id"] for line in read_dump_lines(path)]
+
+
+def test_read_filter_specs(tmp_path):
+    (tmp_path / "qids.txt").write_text("Q1\nQ2\n")
+    path = tmp_path / "specs.json"
+    path.write_text(
+        json.dumps(
+            {
+                "paintings": {"claim_values": {"P31": ["Q3305213"]}},
+                "selected": {"qids": "qids.txt"},
+                "all": {},
+            }
+        )
+    )
+
+    specs = dump_split.read_filter_specs(str(path))
+
+    assert list(specs) == ["paintings", "selected", "all"]
+    assert specs["selected"].qids == {"Q1", "Q2"}
+    assert not specs["all"]
+
+    for bad_specs in ({"../up": {}}, {"bad": {"colour": ["red"]}}):
+        path.write_text(json.dumps(bad_specs))
+        with pytest.raises(ValueError):
+            dump_split.read_filter_specs(str(path))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_split_dump(dump_path, tmp_path, workers):
+    out = tmp_path / "shards"
+    specs = {
+        "paintings": EntityFilter(claim_values={"P31": ["Q3305213"]}),
+        "located": EntityFilter(properties=["P625"]),
+        "selected": EntityFilter(qids=["Q2", "Q30", "Q61"]),
+    }
+
+    counts = dump_split.split_dump(
+        dump_path,
+        str(out),
+        specs,
+        workers=workers,
+        compression="gzip",
+        shard_size=7,
+        batch_size=4,
+    )
+
+    assert counts == {"paintings": 20, "located": 12, "selected": 2}
+    # shards are in dump order, with a new shard every 7 entities
+    assert qids(str(out / "paintings")) == [f"Q{i}" for i in range(3, 61, 3)]
+    assert len(dump_files(str(out / "paintings"))) == 3
+    assert dump_files(str(out / "paintings"))[0].endswith("part-00000.ndjson.gz")
+    assert qids(str(out / "selected")) == ["Q2", "Q30"]
+
+    # the output isn't written over
+    with pytest.raises(FileExistsError):
+        dump_split.split_dump(dump_path, str(out), specs)
+
+
+def test_split_dump_simplified(dump_path, tmp_path):
+    out = tmp_path / "shards"
+    dump_split.split_dump(
+        dump_path,
+        str(out),
+        {"located": EntityFilter(properties=["P625"])},
+        simplifier=EntitySimplifier("en", ["P31"]),
+    )
+
+    doc = json.loads(next(read_dump_lines(str(out / "located"))))
+
+    assert doc["id"] == "Q5"
+    assert doc["labels"] == "label Q5"
+    assert doc["claims"] == {"P31": ["Q5"]}
+
+
+def test_load_shards(es, dump_path, tmp_path):
+    out = tmp_path / "shards"
+    dump_split.split_dump(
+        dump_path,
+        str(out),
+        {"paintings": EntityFilter(claim_values={"P31": ["Q3305213"]})},
+        shard_size=6,
+    )
+
+    d = dump_to_es.processDump(
+        dump=str(out / "paintings"),
+        es_credentials={
+            "ELASTICSEARCH_CLUSTER": es.url,
+            "ELASTICSEARCH_USER": "user",
+            "ELASTICSEARCH_PASSWORD": "password",
+        },
+        index_name="test",
+        disable_refresh_on_index=False,
+    )
+    d.start_elasticsearch()
+    d.dump_to_es()
+
+    assert sorted(es.docs("test"), key=lambda qid: int(qid[1:])) == [
+        f"Q{i}" for i in range(3, 61, 3)
+    ]
@@ -0,0 +1,308 @@
+from elastic_wikidata import dump_to_es, sparql_to_es, wd_entities
+from elastic_wikidata.entity_filter import EntityFilter
+import gzip
+import json
+import pytest
+from stand_ins import (
+    make_entity,
+    ElasticsearchStandIn,
+    SparqlStandIn,
+    WbgetentitiesStandIn,
+)
+
+
+@pytest.fixture
+def dump_path(tmp_path):
+    path = tmp_path / "dump.ndjson"
+
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(1, 101):
+            f.write(json.dumps(make_entity(f"Q{i}")) + "\n")
+
+    return str(path)
+
+
+def get_docs(dump_path, **kwargs):
+    d = dump_to_es.processDump(
+        dump=dump_path,
+        es_credentials={},
+        index_name="test",
+        disable_refresh_on_index=False,
+        **kwargs,
+    )
+
+    return list(d.generate_actions_from_dump())
+
+
+def test_generate_actions_from_dump(dump_path):
+    docs = get_docs(dump_path)
+
+    assert len(docs) == 100
+    assert docs[0] == {
+        "id": "Q1",
+        "labels": "label Q1",
+        "descriptions": "description Q1",
+        "aliases": ["alias Q1"],
+        "claims": {"P31": ["Q5"]},
+    }
+
+
+def test_make_simplifier(dump_path):
+    options = {
+        "lang": ["en", "fr"],
+        "properties": ["p31", "P569", "not a property"],
+        "ranks": "best",
+        "qualifiers": ["p580"],
+        "language_fallback": ["en"],
+    }
+    d = dump_to_es.processDump(
+        dump=dump_path,
+        es_credentials={},
+        index_name="test",
+        disable_refresh_on_index=False,
+        **options,
+    )
+    simplifier = dump_to_es.make_simplifier(**options)
+
+    # documents made elsewhere, e.g. for a Parquet sink, match those of a load
+    assert simplifier.properties == d.simplifier.properties == ("P31", "P569")
+    assert simplifier.mappings() == d.simplifier.mappings()
+    entity = make_entity("Q1")
+    assert simplifier(entity) == d.simplifier(entity)
+
+    assert dump_to_es.make_simplifier(properties="p31").properties == ("P31",)
+    assert dump_to_es.make_simplifier().properties == ("P31",)
+
+
+def test_generate_actions_from_dump_parallel(dump_path):
+    docs = get_docs(dump_path)
+
+    assert get_docs(dump_path, workers=2, batch_size=7) == docs
+
+    unordered_docs = get_docs(dump_path, workers=2, batch_size=7, preserve_order=False)
+    assert sorted(doc["id"] for doc in unordered_docs) == sorted(
+        doc["id"] for doc in docs
+    )
+
+
+def test_generate_actions_from_dump_limit(dump_path):
+    assert len(get_docs(dump_path, doc_limit=10, workers=2, batch_size=3)) == 10
+
+
+def test_generate_actions_from_compressed_array_dump(dump_path, tmp_path):
+    with open(dump_path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+
+    gz_path = tmp_path / "latest-all.json.gz"
+    with gzip.open(gz_path, "wt", encoding="utf-8") as f:
+        f.write("[\n" + ",\n".join(lines) + "\n]\n")
+
+    assert get_docs(str(gz_path)) == get_docs(dump_path)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_generate_actions_from_dump_filter(tmp_path, workers):
+    path = tmp_path / "dump.ndjson"
+
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(1, 101):
+            f.write(json.dumps(make_entity(f"Q{i}", p31="Q5" if i % 10 else "Q6")))
+            f.write("\n")
+
+    entity_filter = EntityFilter(claim_values={"P31": ["Q6"]})
+    docs = get_docs(str(path), entity_filter=entity_filter, workers=workers)
+
+    assert [doc["id"] for doc in docs] == [f"Q{i}" for i in range(10, 101, 10)]
+
+    docs = get_docs(
+        str(path), entity_filter=entity_filter, workers=workers, doc_limit=3
+    )
+    assert [doc["id"] for doc in docs] == ["Q10", "Q20", "Q30"]
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as server:
+        yield server
+
+
+def es_credentials(es) -> dict:
+    return {
+        "ELASTICSEARCH_CLUSTER": es.url,
+        "ELASTICSEARCH_USER": "user",
+        "ELASTICSEARCH_PASSWORD": "password",
+    }
+
+
+def load(es, dump, **kwargs) -> dump_to_es.processDump:
+    d = dump_to_es.processDump(
+        dump=dump,
+        es_credentials=es_credentials(es),
+        index_name="test",
+        disable_refresh_on_index=False,
+        **kwargs,
+    )
+    d.start_elasticsearch()
+    d.dump_to_es()
+
+    return d
+
+
+def write_dump(path, entities):
+    with open(path, "w", encoding="utf-8") as f:
+        for entity in entities:
+            f.write(json.dumps(entity) + "\n")
+
+    return str(path)
+
+
+def test_dump_to_es(es, dump_path):
+    load(es, dump_path)
+
+    docs = es.docs("test")
+    assert len(docs) == 100
+    assert docs["Q1"]["labels"] == "label Q1"
+
+    # documents are indexed by QID, so loading again doesn't create duplicates
+    load(es, dump_path)
+    assert len(es.docs("test")) == 100
+
+
+def test_dump_to_es_incremental(es, tmp_path):
+    entities = [dict(make_entity(f"Q{i}"), lastrevid=i) for i in range(1, 11)]
+    load(es, write_dump(tmp_path / "dump1.ndjson", entities))
+    assert es.docs("test")["Q3"]["lastrevid"] == 3
+
+    # Q2 is edited, Q3 is deleted and Q11 is created
+    entities[1]["lastrevid"] = 100
+    entities[1]["labels"]["en"]["value"] = "new label"
+    del entities[2]
+    entities.append(dict(make_entity("Q11"), lastrevid=11))
+    es.bulk_requests.clear()
+
+    load(es, write_dump(tmp_path / "dump2.ndjson", entities), incremental=True)
+
+    docs = es.docs("test")
+    assert sorted(docs.keys()) == sorted(e["id"] for e in entities)
+    assert docs["Q2"]["labels"] == "new label"
+    assert docs["Q2"]["lastrevid"] == 100
+    assert len(es.bulk_requests) == 1
+
+
+def test_entities_incremental(es, monkeypatch):
+    with WbgetentitiesStandIn() as wikidata:
+        monkeypatch.setattr(
+            wd_entities.get_entities, "__init__", local_init(wikidata.endpoint)
+        )
+        qids = [f"Q{i}" for i in range(1, 11)]
+        load(es, qids)
+        assert len(es.docs("test")) == 10
+
+        # entities are unchanged, so only their info is requested
+        wikidata.requests.clear()
+        load(es, qids, incremental=True)
+        assert [params["props"] for params in wikidata.requests] == [["info"]]
+
+        # Q1 has changed and Q2 has been deleted
+        es.docs("test")["Q1"]["lastrevid"] = 0
+        wikidata.missing.add("Q2")
+        wikidata.requests.clear()
+        load(es, qids, incremental=True)
+
+        assert "Q2" not in es.docs("test")
+        assert (
+            es.docs("test")["Q1"]["lastrevid"] == wikidata.get_entity("Q1")["lastrevid"]
+        )
+        assert wikidata.requests[-1]["ids"] == ["Q1"]
+
+
+def local_init(endpoint):
+    def __init__(self):
+        self.endpoint = endpoint
+        self.properties = ["info", "labels", "aliases", "claims", "descriptions"]
+
+    return __init__
+
+
+def test_dump_to_es_chunking(es, dump_path):
+    load(es, dump_path, chunk_size=30)
+    assert len(es.bulk_requests) == 4
+
+    es.bulk_requests.clear()
+    load(es, dump_path, max_chunk_bytes=2048)
+    assert len(es.bulk_requests) > 4
+    assert max(es.bulk_requests) <= 2048
+    assert len(es.docs("test")) == 100
+
+
+def test_dump_to_es_parallel_bulk(es, dump_path):
+    load(es, dump_path, bulk_threads=4, chunk_size=10, queue_size=2)
+
+    assert len(es.bulk_requests) == 10
+    assert len(es.docs("test")) == 100
+
+
+def test_dump_to_es_dead_letters(es, dump_path, tmp_path, capsys):
+    dead_letter_path = str(tmp_path / "dead_letters.ndjson")
+    es.fail_ids = {f"Q{i}" for i in range(1, 21)}
+    d = load(es, dump_path, dead_letter_path=dead_letter_path)
+
+    assert len(es.docs("test")) == 80
+    # only the first few failures are printed
+    assert capsys.readouterr().out.count("mapper_parsing_exception") == 10
+
+    es.fail_ids.clear()
+    assert d.replay_dead_letters(dead_letter_path) == (20, 0)
+    assert len(es.docs("test")) == 100
+
+
+def test_sparql_pipeline(es, monkeypatch):
+    indexed_while_querying = []
+
+    def entities(endpoint):
+        qids = sparql_to_es.iter_entities_from_query(
+            "SELECT ?item WHERE { ?item wdt:P31 wd:Q5 }",
+            page_size=50,
+            endpoint_url=endpoint,
+        )
+        for i, qid in enumerate(qids):
+            if i == 600:
+                indexed_while_querying.append(len(es.docs("test")))
+            yield qid
+
+    with SparqlStandIn(
+        [f"Q{i}" for i in range(1, 1001)]
+    ) as sparql, WbgetentitiesStandIn() as wikidata:
+        monkeypatch.setattr(
+            wd_entities.get_entities, "__init__", local_init(wikidata.endpoint)
+        )
+        load(
+            es,
+            entities(sparql.endpoint),
+            entity_queue_size=100,
+            chunk_size=10,
+            queue_size=1,
+        )
+
+    assert len(es.docs("test")) == 1000
+    # documents are indexed while the query is still being paginated
+    assert indexed_while_querying[0] > 0
+
+
+def test_dump_to_es_rich_claims(es, dump_path):
+    load(es, dump_path, qualifiers=["p580"], ranks="best")
+
+    mappings = es.indices["test"]["mappings"]["properties"]
+    assert mappings["claims"]["properties"]["P31"]["type"] == "nested"
+    assert es.docs("test")["Q1"]["claims"] == {
+        "P31": [{"value": "Q5", "rank": "normal", "qualifiers": {}}]
+    }
+
+
+def test_dump_to_es_languages(es, dump_path):
+    load(es, dump_path, lang=["en", "fr"], language_fallback=["en"])
+
+    labels = es.indices["test"]["mappings"]["properties"]["labels"]["properties"]
+    assert labels["fr"]["analyzer"] == "french"
+    assert es.docs("test")["Q1"]["labels"] == {"en": "label Q1", "fr": "label Q1"}
+    assert es.docs("test")["Q1"]["aliases"] == {"en": ["alias Q1"]}
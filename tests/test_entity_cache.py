@@ -0,0 +1,103 @@
+from elastic_wikidata.entity_cache import EntityCache
+from stand_ins import make_entity
+import time
+import pytest
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = EntityCache(str(tmp_path))
+    yield cache
+    cache.close()
+
+
+def test_get_many(cache):
+    cache.put_many([make_entity("Q1"), make_entity("Q2")], "en", "labels")
+
+    assert cache.get_many(["Q1", "Q2", "Q3"], "en", "labels") == {
+        "Q1": make_entity("Q1"),
+        "Q2": make_entity("Q2"),
+    }
+    assert cache.get_many(["Q1"], "fr", "labels") == {}
+    assert cache.get_many(["Q1"], "en", "labels|claims") == {}
+
+
+def test_redirects_are_stored_under_requested_qid(cache):
+    entity = dict(make_entity("Q2"), redirects={"from": "Q1", "to": "Q2"})
+    cache.put_many([entity], "en", "labels")
+
+    assert cache.get_many(["Q1", "Q2"], "en", "labels") == {"Q1": entity}
+
+
+def test_ttl(tmp_path):
+    cache = EntityCache(str(tmp_path), ttl=0.1)
+    cache.put_many([make_entity("Q1")], "en", "labels")
+
+    assert "Q1" in cache.get_many(["Q1"], "en", "labels")
+    time.sleep(0.15)
+    assert cache.get_many(["Q1"], "en", "labels") == {}
+
+
+def test_refresh(tmp_path):
+    EntityCache(str(tmp_path)).put_many([make_entity("Q1")], "en", "labels")
+
+    assert (
+        EntityCache(str(tmp_path), refresh=True).get_many(["Q1"], "en", "labels") == {}
+    )
+    assert "Q1" in EntityCache(str(tmp_path)).get_many(["Q1"], "en", "labels")
+
+
+def test_eviction(tmp_path):
+    cache = EntityCache(str(tmp_path), max_size_mb=0.002)
+
+    for i in range(1, 21):
+        cache.put_many([make_entity(f"Q{i}")], "en", "labels")
+
+    assert 0 < len(cache) < 20
+    # the most recently fetched entity is kept
+    assert "Q20" in cache.get_many(["Q20"], "en", "labels")
+    assert cache.get_many(["Q1"], "en", "labels") == {}
+
+
+def test_size_is_kept_up_to_date(tmp_path):
+    cache = EntityCache(str(tmp_path), max_size_mb=1)
+
+    def table_size() -> int:
+        return cache._conn.execute("SELECT SUM(size) FROM entities").fetchone()[0]
+
+    cache.put_many([make_entity("Q1"), make_entity("Q2")], "en", "labels")
+    assert cache._size == table_size()
+    # replaced entries aren't counted twice
+    cache.put_many([make_entity("Q2", "Q515"), make_entity("Q3")], "en", "labels")
+    assert cache._size == table_size()
+    # nor are QIDs repeated in a page, of which the last is kept
+    cache.put_many(
+        [make_entity("Q4"), make_entity("Q3", "Q6256"), make_entity("Q4", "Q515")],
+        "en",
+        "labels",
+    )
+    assert cache._size == table_size()
+    assert cache.get_many(["Q4"], "en", "labels")["Q4"] == make_entity("Q4", "Q515")
+
+    assert EntityCache(str(tmp_path), max_size_mb=1)._size == table_size()
+
+
+def test_eviction_removes_expired_entries(tmp_path):
+    cache = EntityCache(str(tmp_path), ttl=0.1, max_size_mb=0.002)
+    cache.put_many(
+        [{"id": f"Q{i}", "missing": ""} for i in range(100, 120)], "en", "labels"
+    )
+    time.sleep(0.15)
+
+    for i in range(1, 21):
+        cache.put_many([make_entity(f"Q{i}")], "en", "labels")
+
+    # all the expired entries go, not just as many of the oldest as needed to make space
+    assert cache.get_many(["Q20"], "en", "labels")
+    assert len(cache) == len(
+        cache.get_many([f"Q{i}" for i in range(1, 21)], "en", "labels")
+    )
+    assert (
+        cache._size
+        == cache._conn.execute("SELECT SUM(size) FROM entities").fetchone()[0]
+    )
@@ -0,0 +1,113 @@
+from elastic_wikidata.entity_filter import EntityFilter, prescan_id, prescan_lastrevid
+import json
+import pytest
+
+
+def entity(qid, entity_type="item", p31=None):
+    doc = {"type": entity_type, "id": qid, "labels": {}, "claims": {}}
+
+    if p31:
+        doc["claims"]["P31"] = [
+            {
+                "mainsnak": {
+                    "snaktype": "value",
+                    "property": "P31",
+                    "datavalue": {
+                        "value": {"entity-type": "item", "id": p31},
+                        "type": "wikibase-entityid",
+                    },
+                }
+            }
+        ]
+
+    return doc
+
+
+def line(doc, **kwargs) -> bytes:
+    return (json.dumps(doc, **kwargs) + ",\n").encode("utf-8")
+
+
+@pytest.mark.parametrize("separators", [(",", ":"), (", ", ": ")])
+def test_prescan_qids(separators):
+    f = EntityFilter(qids=["Q1", "q2"])
+
+    assert f.prescan(line(entity("Q1"), separators=separators))
+    assert f.prescan(line(entity("Q2"), separators=separators))
+    assert not f.prescan(line(entity("Q12"), separators=separators))
+
+
+def test_prescan_entity_types():
+    f = EntityFilter(entity_types=["property"])
+
+    assert f.prescan(line(entity("P31", "property")))
+    assert not f.prescan(line(entity("Q1")))
+    assert not f.prescan(line(entity("L1", "lexeme")))
+
+    with pytest.raises(ValueError):
+        EntityFilter(entity_types=["article"])
+
+
+def test_prescan_claim_values():
+    f = EntityFilter(claim_values={"P31": ["Q5"]})
+
+    assert f.prescan(line(entity("Q1", p31="Q5")))
+    assert not f.prescan(line(entity("Q1", p31="Q55")))
+    assert not f.prescan(line(entity("Q1")))
+
+
+def test_properties():
+    f = EntityFilter(properties=["p31"])
+    no_statements = entity("Q2")
+    no_statements["claims"]["P31"] = []
+
+    assert f.prescan(line(entity("Q1", p31="Q5")))
+    assert f.match(entity("Q1", p31="Q5"))
+    assert not f.prescan(line(entity("Q2")))
+    assert not f.match(no_statements)
+
+
+def test_prescan_is_conservative():
+    # when the ID can't be found in the head of the line, it's left to `match`
+    f = EntityFilter(qids=["Q1"])
+    doc = {"labels": {"en": {"language": "en", "value": "x"}}, "id": "Q2"}
+
+    assert f.prescan(line(doc))
+    assert not f.match(doc)
+
+    # mentioning the value somewhere other than P31 passes the prescan but not the match
+    f = EntityFilter(claim_values={"P31": ["Q5"]})
+    doc = entity("Q1", p31="Q6")
+    doc["labels"]["en"] = {"language": "en", "value": "Q5"}
+
+    assert f.prescan(line(doc))
+    assert not f.match(doc)
+
+
+def test_match():
+    f = EntityFilter(
+        qids=["Q1", "Q2", "P31"],
+        claim_values={"P31": ["Q5"], "P279": ["Q5"]},
+        entity_types=["item"],
+    )
+
+    assert f.match(entity("Q1", p31="Q5"))
+    assert not f.match(entity("Q2", p31="Q6"))
+    assert not f.match(entity("Q3", p31="Q5"))
+    assert not f.match(entity("P31", "property", p31="Q5"))
+    # entities without claims have an empty list of them rather than an object
+    assert not f.match({"id": "Q1", "type": "item", "claims": []})
+    assert not EntityFilter(properties=["P31"]).match({"id": "Q1", "claims": []})
+
+
+def test_empty_filter():
+    assert not EntityFilter()
+    assert EntityFilter(qids=["Q1"])
+
+
+def test_prescan_id_and_lastrevid():
+    doc = dict(entity("Q42", p31="Q5"), lastrevid=123)
+
+    assert prescan_id(line(doc)) == "Q42"
+    assert prescan_lastrevid(line(doc)) == 123
+    assert prescan_lastrevid(line(doc, separators=(", ", ": "))) == 123
+    assert prescan_lastrevid(line(entity("Q42"))) is None
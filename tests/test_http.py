@@ -0,0 +1,28 @@
+from elastic_wikidata.http import RateLimiter, retry_after_seconds
+import time
+
+
+def test_rate_limiter_pause():
+    rate_limiter = RateLimiter()
+    rate_limiter.pause(0.2)
+
+    start = time.monotonic()
+    rate_limiter.wait()
+
+    assert time.monotonic() - start >= 0.15
+
+
+def test_rate_limiter_max_requests_per_second():
+    rate_limiter = RateLimiter(max_requests_per_second=20)
+
+    start = time.monotonic()
+    for _ in range(5):
+        rate_limiter.wait()
+
+    assert time.monotonic() - start >= 0.15
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({"retry-after": "5"}, 1) == 5
+    assert retry_after_seconds({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 1) == 1
+    assert retry_after_seconds({}, 2) == 2
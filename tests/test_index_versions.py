@@ -0,0 +1,147 @@
+from elastic_wikidata import dump_to_es, index_versions
+import json
+import pytest
+from stand_ins import make_entity, ElasticsearchStandIn
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+@pytest.fixture(autouse=True)
+def version_names(monkeypatch):
+    """
+    Gives each build a new version, as builds in a test run within the same second.
+    """
+
+    counter = iter(range(1, 100))
+    monkeypatch.setattr(
+        index_versions,
+        "versioned_index_name",
+        lambda alias: f"{alias}-20200801-{next(counter):06d}",
+    )
+
+
+def write_dump(path, qids) -> str:
+    with open(path, "w", encoding="utf-8") as f:
+        for qid in qids:
+            f.write(json.dumps(make_entity(qid)) + "\n")
+
+    return str(path)
+
+
+def build(es, dump, **kwargs) -> dump_to_es.processDump:
+    d = dump_to_es.processDump(
+        dump=dump,
+        es_credentials={
+            "ELASTICSEARCH_CLUSTER": es.url,
+            "ELASTICSEARCH_USER": "user",
+            "ELASTICSEARCH_PASSWORD": "password",
+        },
+        index_name="wikidata",
+        disable_refresh_on_index=True,
+        build_new_index=True,
+        **kwargs,
+    )
+    d.start_elasticsearch()
+
+    # the index is built with settings for fast indexing
+    settings = es.indices[d.index_name]["settings"]
+    assert settings["number_of_replicas"] == "0"
+    assert settings["refresh_interval"] == "-1"
+    assert settings["translog.durability"] == "async"
+
+    d.dump_to_es()
+
+    return d
+
+
+def test_build_new_index(es, tmp_path):
+    d = build(es, write_dump(tmp_path / "dump.ndjson", ["Q1", "Q2"]))
+
+    assert d.index_name == "wikidata-20200801-000001"
+    assert es.resolve("wikidata") == ["wikidata-20200801-000001"]
+    assert sorted(es.docs("wikidata").keys()) == ["Q1", "Q2"]
+
+    settings = es.indices[d.index_name]["settings"]
+    assert settings["number_of_replicas"] == "1"
+    assert settings["refresh_interval"] is None
+    assert settings["translog.durability"] is None
+
+
+def test_rebuild_swaps_alias_and_prunes(es, tmp_path):
+    es.create_index("unrelated")
+    dump = write_dump(tmp_path / "dump.ndjson", ["Q1"])
+
+    build(es, dump)
+    es.indices["wikidata-20200801-000001"]["settings"]["number_of_replicas"] = "2"
+    build(es, write_dump(tmp_path / "dump2.ndjson", ["Q3"]))
+
+    assert es.resolve("wikidata") == ["wikidata-20200801-000002"]
+    assert list(es.docs("wikidata").keys()) == ["Q3"]
+    # the replicas of the previous version are kept
+    assert (
+        es.indices["wikidata-20200801-000002"]["settings"]["number_of_replicas"] == "2"
+    )
+
+    build(es, dump, keep_versions=1)
+    assert sorted(es.indices.keys()) == ["unrelated", "wikidata-20200801-000003"]
+
+
+def test_failed_build_leaves_alias(es, tmp_path, monkeypatch):
+    build(es, write_dump(tmp_path / "dump.ndjson", ["Q1"]))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("load failed")
+
+    monkeypatch.setattr(dump_to_es.processDump, "_consume", fail)
+
+    with pytest.raises(RuntimeError):
+        build(es, write_dump(tmp_path / "dump2.ndjson", ["Q2"]))
+
+    assert es.resolve("wikidata") == ["wikidata-20200801-000001"]
+    assert "wikidata-20200801-000002" in es.indices
+
+
+def test_build_replaces_existing_index(es, tmp_path):
+    es.create_index("wikidata")
+    es.indices["wikidata"]["docs"]["Q100"] = {}
+
+    build(es, write_dump(tmp_path / "dump.ndjson", ["Q1"]))
+
+    assert "wikidata" not in es.indices
+    assert list(es.docs("wikidata").keys()) == ["Q1"]
+
+
+def test_refresh_settings_are_scoped_to_index(es, tmp_path):
+    es.create_index("other")
+    d = dump_to_es.processDump(
+        dump=write_dump(tmp_path / "dump.ndjson", ["Q1"]),
+        es_credentials={
+            "ELASTICSEARCH_CLUSTER": es.url,
+            "ELASTICSEARCH_USER": "user",
+            "ELASTICSEARCH_PASSWORD": "password",
+        },
+        index_name="test",
+        disable_refresh_on_index=True,
+    )
+    d.start_elasticsearch()
+    assert es.indices["test"]["settings"]["refresh_interval"] == "-1"
+
+    d.dump_to_es()
+    assert es.indices["test"]["settings"]["refresh_interval"] == "1s"
+    assert [r for r in es.requests if r[1] == "/_settings"] == []
+
+
+def test_build_can_not_be_incremental():
+    with pytest.raises(ValueError):
+        dump_to_es.processDump(
+            dump=[],
+            es_credentials={},
+            index_name="wikidata",
+            disable_refresh_on_index=True,
+            build_new_index=True,
+            incremental=True,
+        )
@@ -0,0 +1,142 @@
+from elastic_wikidata import dump_to_es, wd_entities
+from elastic_wikidata.label_index import LabelIndex, build_label_index
+import bz2
+import json
+import pickle
+import pytest
+from stand_ins import make_entity, ElasticsearchStandIn
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+def load(es, dump, **kwargs) -> dump_to_es.processDump:
+    d = dump_to_es.processDump(
+        dump=dump,
+        es_credentials={
+            "ELASTICSEARCH_CLUSTER": es.url,
+            "ELASTICSEARCH_USER": "user",
+            "ELASTICSEARCH_PASSWORD": "password",
+        },
+        index_name="test",
+        disable_refresh_on_index=False,
+        **kwargs,
+    )
+    d.start_elasticsearch()
+    d.dump_to_es()
+
+    return d
+
+
+def entity(qid: str, label: str = None, p31: str = "Q5") -> dict:
+    doc = make_entity(qid, p31)
+    if label is not None:
+        doc["labels"]["en"]["value"] = label
+
+    return doc
+
+
+def write_dump(path, docs: list):
+    with bz2.open(path, "wt", encoding="utf-8") as f:
+        f.write("[\n")
+        f.write(",\n".join(json.dumps(doc) for doc in docs))
+        f.write("\n]\n")
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    docs = [entity(f"Q{i}", "human" if i == 5 else None) for i in range(200, 0, -1)]
+    docs += [
+        entity("Q1000", 'the "quoted" café'),
+        entity("Q1001", "human"),
+        dict(entity("P31", "instance of"), type="property"),
+    ]
+    # an entity without an English label
+    docs[0]["labels"] = {"fr": {"language": "fr", "value": "bonjour"}}
+
+    dump_path = tmp_path / "dump.json.bz2"
+    write_dump(dump_path, docs)
+    path = str(tmp_path / "labels.idx")
+
+    # a small chunk size sorts in several runs
+    assert build_label_index(str(dump_path), path, "en", chunk_size=16) == 202
+
+    return path
+
+
+def test_label_index(index_path):
+    with LabelIndex(index_path) as index:
+        assert len(index) == 202
+        assert index.get("Q1") == "label Q1"
+        assert index.get("Q1000") == 'the "quoted" café'
+        assert index.get("P31") == "instance of"
+        # Q200 has no English label, and L1 isn't an item or property
+        assert index.get("Q200") is None
+        assert index.get("Q100000") is None
+        assert index.get("L1") is None
+        assert "Q199" in index and "Q200" not in index
+
+        assert index.get_labels(["Q5", "Q7", "P31", "Q200", "L1", "Q5"]) == {
+            "Q5": "human",
+            "Q7": "label Q7",
+            "P31": "instance of",
+        }
+        assert index.find("human") == ["Q5", "Q1001"]
+        assert index.find("instance of") == ["P31"]
+        assert index.find("nothing") == []
+
+        qids = [qid for qid, _ in index.items()]
+        assert qids[:3] == ["Q1", "Q2", "Q3"]
+        assert qids[-1] == "P31"
+
+
+def test_label_index_is_picklable(index_path):
+    index = pickle.loads(pickle.dumps(LabelIndex(index_path)))
+
+    assert index.get("Q42") == "label Q42"
+    index.close()
+
+
+def test_label_index_rejects_other_files(tmp_path):
+    path = tmp_path / "not-an-index"
+    path.write_bytes(b"\0" * 64)
+
+    with pytest.raises(ValueError):
+        LabelIndex(str(path))
+
+
+def test_label_source(index_path):
+    with LabelIndex(index_path) as index:
+        docs = wd_entities.simplify_wbgetentities_result(
+            [entity("Q1"), entity("Q2", p31="Q200")],
+            "en",
+            ["P31"],
+            label_source=index,
+        )
+        labels = wd_entities.get_entities().get_labels(
+            ["Q5", "Q200"], label_source=index
+        )
+
+    assert [doc["claim_labels"] for doc in docs] == [
+        {"P31": ["human"]},
+        {"P31": [None]},
+    ]
+    assert labels == {"Q5": "human", "Q200": ""}
+
+
+def test_enrich_labels_from_label_index(es, tmp_path):
+    dump_path = tmp_path / "dump.json.bz2"
+    write_dump(
+        dump_path, [entity("Q5", "human")] + [entity(f"Q{i}") for i in range(6, 20)]
+    )
+    path = tmp_path / "labels.idx"
+
+    # the index is built from the dump the first time, then reused
+    load(es, str(dump_path), label_index=str(path))
+    assert path.exists()
+    load(es, [], label_index=str(path))
+
+    assert es.docs("test")["Q10"]["claim_labels"] == {"P31": ["human"]}
@@ -0,0 +1,163 @@
+from elastic_wikidata import dump_to_es, labels, wd_entities
+from elastic_wikidata.labels import LabelEnricher, LabelTable, LRUCache
+import gzip
+import json
+import pytest
+from stand_ins import make_entity, ElasticsearchStandIn, WbgetentitiesStandIn
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+def load(es, dump, **kwargs) -> dump_to_es.processDump:
+    d = dump_to_es.processDump(
+        dump=dump,
+        es_credentials={
+            "ELASTICSEARCH_CLUSTER": es.url,
+            "ELASTICSEARCH_USER": "user",
+            "ELASTICSEARCH_PASSWORD": "password",
+        },
+        index_name="test",
+        disable_refresh_on_index=False,
+        **kwargs,
+    )
+    d.start_elasticsearch()
+    d.dump_to_es()
+
+    return d
+
+
+def entity(qid: str, label: str = None, p31: str = "Q5") -> dict:
+    doc = make_entity(qid, p31)
+    if label is not None:
+        doc["labels"]["en"]["value"] = label
+
+    return doc
+
+
+class CountingSource:
+    def __init__(self, table: dict):
+        self.table = table
+        self.requests = []
+
+    def get_labels(self, qids) -> dict:
+        qids = list(qids)
+        self.requests.append(sorted(qids))
+
+        return {qid: self.table[qid] for qid in qids if qid in self.table}
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put("Q1", "a")
+    cache.put("Q2", "b")
+    assert cache.get("Q1") == "a"
+
+    # Q2 is the least recently used
+    cache.put("Q3", "c")
+    assert "Q2" not in cache
+    assert sorted(cache._items) == ["Q1", "Q3"]
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+@pytest.mark.parametrize("separators", [(",", ":"), (", ", ": ")])
+def test_prescan_label(separators):
+    doc = entity("Q1", 'say "hello"')
+    doc["labels"]["fr"] = {"language": "fr", "value": "bonjour"}
+    doc["descriptions"]["de"] = {"language": "de", "value": "hallo"}
+    line = json.dumps(doc, separators=separators).encode("utf-8") + b",\n"
+
+    assert labels.prescan_label(line, "en") == ("Q1", 'say "hello"')
+    assert labels.prescan_label(line, "fr") == ("Q1", "bonjour")
+    # only labels are searched, not descriptions
+    assert labels.prescan_label(line, "de") == ("Q1", None)
+
+
+def test_label_table_from_dump(tmp_path):
+    path = tmp_path / "dump.json.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("[\n")
+        f.write(",\n".join(json.dumps(entity(f"Q{i}")) for i in range(1, 11)))
+        f.write(",\n" + json.dumps(dict(entity("P31"), type="property")))
+        f.write("\n]\n")
+
+    table = LabelTable.from_dump(str(path), "en")
+
+    assert len(table) == 11
+    assert table.get_labels(["Q1", "P31", "Q100"]) == {
+        "Q1": "label Q1",
+        "P31": "label P31",
+    }
+
+
+def test_label_enricher():
+    source = CountingSource({"Q5": "human", "Q6": "other"})
+    enricher = LabelEnricher(source, window=3, cache_size=10)
+    simplifier = wd_entities.EntitySimplifier("en", ["P31"])
+    docs = [simplifier(entity(f"Q{i}", p31="Q5" if i % 2 else "Q6")) for i in range(10)]
+    docs[0]["claims"]["P31"].append("+2000-01-01T00:00:00Z")
+    docs.append({"_op_type": "delete", "_id": "Q100"})
+
+    enriched = list(enricher.enrich(docs))
+
+    assert enriched[0]["claim_labels"] == {"P31": ["other", None]}
+    assert enriched[1]["claim_labels"] == {"P31": ["human"]}
+    assert enriched[-1] == {"_op_type": "delete", "_id": "Q100"}
+    # each target is only requested once, deduplicated within the window
+    assert source.requests == [["Q5", "Q6"]]
+    assert enricher.cache.hits > 0
+
+
+def test_label_enricher_rich_claims():
+    source = CountingSource({"Q5": "human"})
+    simplifier = wd_entities.EntitySimplifier("en", ["P31"], rich_claims=True)
+    doc = simplifier(entity("Q1"))
+
+    (enriched,) = LabelEnricher(source).enrich([doc])
+
+    assert enriched["claims"]["P31"] == [
+        {"value": "Q5", "rank": "normal", "label": "human"}
+    ]
+    assert "claim_labels" not in enriched
+
+
+def test_enrich_labels_from_dump(es, tmp_path):
+    path = tmp_path / "dump.ndjson"
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(entity("Q5", "human")) + "\n")
+        for i in range(6, 20):
+            f.write(json.dumps(entity(f"Q{i}")) + "\n")
+
+    load(es, str(path), enrich_labels="dump")
+
+    assert es.docs("test")["Q10"]["claim_labels"] == {"P31": ["human"]}
+
+
+def test_enrich_labels_from_api(es, monkeypatch):
+    with WbgetentitiesStandIn() as wikidata:
+
+        def local_init(self):
+            self.endpoint = wikidata.endpoint
+            self.properties = ["info", "labels", "aliases", "claims", "descriptions"]
+
+        monkeypatch.setattr(wd_entities.get_entities, "__init__", local_init)
+        load(es, [f"Q{i}" for i in range(1, 21)], enrich_labels="api")
+
+        label_requests = [r for r in wikidata.requests if r["props"] == ["labels"]]
+
+    assert es.docs("test")["Q10"]["claim_labels"] == {"P31": ["label Q5"]}
+    assert [r["ids"] for r in label_requests] == [["Q5"]]
+
+
+def test_enrich_labels_from_dump_needs_dump():
+    with pytest.raises(ValueError):
+        dump_to_es.processDump(
+            dump=["Q1"],
+            es_credentials={},
+            index_name="test",
+            disable_refresh_on_index=False,
+            enrich_labels="dump",
+        )
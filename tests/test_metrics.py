@@ -0,0 +1,169 @@
+from elastic_wikidata import dump_to_es, metrics, sparql_to_es, wd_entities
+from elastic_wikidata.config import runtime_config
+import json
+import os
+import pstats
+import pytest
+import urllib.request
+from stand_ins import (
+    make_entity,
+    ElasticsearchStandIn,
+    SparqlStandIn,
+    WbgetentitiesStandIn,
+)
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+@pytest.fixture
+def dump_path(tmp_path):
+    path = tmp_path / "dump.ndjson"
+
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(1, 101):
+            f.write(json.dumps(make_entity(f"Q{i}")) + "\n")
+
+    return str(path)
+
+
+def load(es, dump, **kwargs) -> dump_to_es.processDump:
+    d = dump_to_es.processDump(
+        dump=dump,
+        es_credentials={
+            "ELASTICSEARCH_CLUSTER": es.url,
+            "ELASTICSEARCH_USER": "user",
+            "ELASTICSEARCH_PASSWORD": "password",
+        },
+        index_name="test",
+        disable_refresh_on_index=False,
+        **kwargs,
+    )
+    d.start_elasticsearch()
+    d.dump_to_es()
+
+    return d
+
+
+def test_metrics():
+    m = metrics.Metrics()
+    m.inc("entities_total", 10, stage="parse")
+    m.inc("entities_total", 5, stage="parse")
+    m.set("queue_depth", 3, queue="pages")
+    for latency in [0.02] * 90 + [3] * 10:
+        m.observe("stage_seconds", latency, stage="index")
+
+    snapshot = m.snapshot()
+    assert snapshot["counters"]["entities_total"] == {"stage=parse": 15}
+    assert snapshot["gauges"]["queue_depth"] == {"queue=pages": 3}
+
+    latency = snapshot["histograms"]["stage_seconds"]["stage=index"]
+    assert latency["count"] == 100
+    assert latency["sum"] == pytest.approx(31.8)
+    assert 0.01 < latency["p50"] <= 0.025
+    assert 2.5 < latency["p99"] <= 5
+
+    exposition = m.to_prometheus()
+    assert "# TYPE ew_entities_total counter" in exposition
+    assert 'ew_entities_total{stage="parse"} 15\n' in exposition
+    assert 'ew_stage_seconds_bucket{stage="index",le="0.025"} 90\n' in exposition
+    assert 'ew_stage_seconds_bucket{stage="index",le="+Inf"} 100\n' in exposition
+    assert 'ew_stage_seconds_count{stage="index"} 100\n' in exposition
+
+
+def test_no_metrics():
+    # without a registry, recording does nothing
+    assert runtime_config.get("metrics") is None
+    metrics.record_stage("parse", 10, 0.1)
+    assert metrics.current().snapshot()["counters"] == {}
+
+
+def test_serve_prometheus():
+    m = metrics.Metrics()
+    m.inc("entities_total", 7, stage="fetch")
+    server = metrics.serve_prometheus(m, 0)
+
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert 'ew_entities_total{stage="fetch"} 7' in body
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_dump_metrics(es, dump_path, tmp_path, workers):
+    log_path = str(tmp_path / "metrics.ndjson")
+
+    with metrics.collect(log_path=log_path, interval=60) as m:
+        load(es, dump_path, workers=workers, batch_size=30, chunk_size=40)
+
+    assert runtime_config.get("metrics") is None
+
+    counters = m.snapshot()["counters"]
+    assert counters["entities_total"] == {
+        "stage=index": 100,
+        "stage=parse": 100,
+        "stage=read": 100,
+        "stage=simplify": 100,
+    }
+    assert counters["bytes_in_total"]["source=dump"] == os.path.getsize(dump_path)
+    assert counters["bytes_out_total"]["sink=elasticsearch"] == sum(es.bulk_requests)
+
+    # the last snapshot is logged when collection stops
+    with open(log_path) as f:
+        record = json.loads(f.readlines()[-1])
+    assert record["histograms"]["stage_seconds"]["stage=index"]["count"] == 3
+    assert record["rates"]["entities_total"]["stage=index"] > 0
+
+
+def test_query_metrics(es, monkeypatch):
+    def local_init(self):
+        self.endpoint = wikidata.endpoint
+        self.properties = ["info", "labels", "aliases", "claims", "descriptions"]
+
+    qids = [f"Q{i}" for i in range(1, 121)]
+
+    with SparqlStandIn(qids) as sparql, WbgetentitiesStandIn() as wikidata:
+        monkeypatch.setattr(wd_entities.get_entities, "__init__", local_init)
+        wikidata.responses.append(429)
+
+        entities = sparql_to_es.iter_entities_from_query(
+            "SELECT ?item WHERE { ?item wdt:P31 wd:Q5 }",
+            page_size=50,
+            endpoint_url=sparql.endpoint,
+        )
+        with metrics.collect() as m:
+            load(es, entities, fetch_workers=2)
+
+    snapshot = m.snapshot()
+    counters = snapshot["counters"]
+    assert counters["entities_total"]["stage=query"] == 120
+    assert counters["entities_total"]["stage=fetch"] == 120
+    assert counters["entities_total"]["stage=index"] == 120
+    assert counters["retries_total"] == {"reason=429,service=wikidata": 1}
+    assert counters["bytes_in_total"]["source=sparql"] > 0
+    assert snapshot["histograms"]["stage_seconds"]["stage=fetch"]["count"] == 3
+    assert "queue=pages" in snapshot["gauges"]["queue_depth"]
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sample"])
+def test_profile(es, dump_path, tmp_path, mode):
+    path = str(tmp_path / "profile.out")
+
+    with metrics.profile(path, mode=mode, interval=0.001):
+        load(es, dump_path)
+
+    if mode == "cprofile":
+        assert pstats.Stats(path).total_calls > 0
+    else:
+        with open(path) as f:
+            stacks = f.read().splitlines()
+        assert stacks
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in stacks)
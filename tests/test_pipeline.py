@@ -0,0 +1,61 @@
+from elastic_wikidata.pipeline import batched, prefetch
+import pytest
+import time
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
+
+
+def test_prefetch():
+    assert list(prefetch(iter(range(1000)), maxsize=10)) == list(range(1000))
+
+
+def test_prefetch_is_bounded():
+    produced = []
+
+    def produce():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    items = prefetch(produce(), maxsize=5)
+    assert next(items) == 0
+    time.sleep(0.1)
+
+    # 5 items in the queue, one taken and one waiting to be put
+    assert len(produced) <= 7
+
+
+def test_prefetch_raises_producer_errors():
+    def produce():
+        yield 1
+        raise KeyError("failed")
+
+    items = prefetch(produce(), maxsize=5)
+    assert next(items) == 1
+
+    with pytest.raises(KeyError):
+        next(items)
+
+
+def test_prefetch_stops_producer():
+    closed = []
+
+    def produce():
+        try:
+            for i in range(1000):
+                yield i
+        finally:
+            closed.append(True)
+
+    items = prefetch(produce(), maxsize=2)
+    assert next(items) == 0
+    items.close()
+
+    for _ in range(20):
+        if closed:
+            break
+        time.sleep(0.05)
+    assert closed
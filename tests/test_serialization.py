@@ -0,0 +1,48 @@
+from elastic_wikidata import serialization
+import pytest
+
+
+@pytest.fixture(params=list(serialization.BACKENDS.keys()))
+def backend(request):
+    default = serialization.get_backend()
+    serialization.set_backend(request.param)
+    yield request.param
+    serialization.set_backend(default)
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        b'{"id":"Q1","labels":{"fr":{"value":"\xc3\xa9"}}}\n',
+        b'{"id":"Q1","labels":{"fr":{"value":"\xc3\xa9"}}},\n',
+        b'{"id":"Q1","labels":{"fr":{"value":"\xc3\xa9"}}},\r\n',
+    ],
+)
+def test_loads_line(backend, line):
+    assert serialization.loads_line(line) == {
+        "id": "Q1",
+        "labels": {"fr": {"value": "é"}},
+    }
+
+
+def test_loads(backend):
+    assert serialization.loads(b'{"entities": {"Q1": {}}}') == {"entities": {"Q1": {}}}
+    assert serialization.loads('{"a": [1, 2]}') == {"a": [1, 2]}
+
+
+def test_dumps(backend):
+    assert serialization.dumps(
+        {"id": "Q1", "labels": "é", "claims": {"P31": ["Q5"]}}
+    ) == ('{"id":"Q1","labels":"é","claims":{"P31":["Q5"]}}')
+
+
+def test_elasticsearch_serializer(backend):
+    serializer = serialization.ElasticsearchSerializer()
+
+    assert serializer.dumps('{"id":"Q1"}') == '{"id":"Q1"}'
+    assert serializer.loads(serializer.dumps({"id": "Q1"})) == {"id": "Q1"}
+
+
+def test_set_backend():
+    with pytest.raises(ValueError):
+        serialization.set_backend("not_a_json_library")
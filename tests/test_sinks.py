@@ -0,0 +1,228 @@
+from elastic_wikidata import dump_to_es, sinks, sparql_to_es, wd_entities
+from elastic_wikidata.checkpoint import Checkpoint
+from elastic_wikidata.dump_reader import read_dump_lines
+from elastic_wikidata.entity_filter import EntityFilter
+from elastic_wikidata.wd_entities import EntitySimplifier
+import gzip
+import json
+import pytest
+from stand_ins import (
+    make_entity,
+    ElasticsearchStandIn,
+    SparqlStandIn,
+    WbgetentitiesStandIn,
+)
+
+
+@pytest.fixture
+def es():
+    with ElasticsearchStandIn() as es:
+        yield es
+
+
+@pytest.fixture
+def files_path(tmp_path):
+    """
+    A directory of entity files: saved wbgetentities responses for Q1-Q20 and Q21-Q40 (one of them
+    pretty-printed, and one with a missing entity), a gzipped list of entities Q41-Q50, and NDJSON
+    entities Q51-Q60. Every third entity is a painting.
+    """
+
+    def entity(i: int) -> dict:
+        return make_entity(f"Q{i}", "Q3305213" if i % 3 == 0 else "Q5")
+
+    path = tmp_path / "files"
+    path.mkdir()
+
+    response = {"entities": {f"Q{i}": entity(i) for i in range(1, 21)}}
+    (path / "a-response.json").write_text(json.dumps(response, indent=2))
+
+    response = {"entities": {f"Q{i}": entity(i) for i in range(21, 41)}}
+    response["entities"]["Q999"] = {"id": "Q999", "missing": ""}
+    (path / "b-response.json").write_text(json.dumps(response))
+
+    with gzip.open(path / "c-list.json.gz", "wt") as f:
+        json.dump([entity(i) for i in range(41, 51)], f)
+
+    (path / "d-entities.ndjson").write_text(
+        "".join(json.dumps(entity(i)) + "\n" for i in range(51, 61))
+    )
+
+    return str(path)
+
+
+def load(dump, es=None, **kwargs) -> dump_to_es.processDump:
+    d = dump_to_es.processDump(
+        dump=dump,
+        es_credentials=(
+            {
+                "ELASTICSEARCH_CLUSTER": es.url,
+                "ELASTICSEARCH_USER": "user",
+                "ELASTICSEARCH_PASSWORD": "password",
+            }
+            if es
+            else {}
+        ),
+        index_name="test" if es else None,
+        disable_refresh_on_index=False,
+        **kwargs,
+    )
+    d.start()
+    d.dump_to_es()
+
+    return d
+
+
+def qids(path) -> list:
+    return [json.loads(line)["id"] for line in read_dump_lines(str(path))]
+
+
+def test_ndjson_sink(tmp_path):
+    out = tmp_path / "out"
+
+    with sinks.NDJSONSink(str(out), shard_size=3, batch_size=2) as sink:
+        results = list(sink.write({"id": f"Q{i}", "labels": "x"} for i in range(5)))
+
+    assert results[0] == (True, {"index": {"_id": "Q0", "status": 201}})
+    assert sink.count == 5
+    assert qids(out) == [f"Q{i}" for i in range(5)]
+    assert sorted(p.name for p in out.iterdir()) == [
+        "part-00000.ndjson",
+        "part-00001.ndjson",
+    ]
+
+    with pytest.raises(ValueError):
+        with sinks.NDJSONSink(str(tmp_path / "deletes")) as sink:
+            list(sink.write([dump_to_es.delete_action("Q1")]))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_files_to_sink(files_path, tmp_path, workers):
+    out = tmp_path / "out"
+    d = load(
+        files_path,
+        files=True,
+        sink=sinks.NDJSONSink(str(out), compression="gzip"),
+        workers=workers,
+        batch_size=4,
+        properties=["P31"],
+    )
+
+    # nothing is sent to Elasticsearch, and documents are written in file order
+    assert not hasattr(d, "es")
+    assert qids(out) == [f"Q{i}" for i in range(1, 61)]
+
+    doc = json.loads(next(read_dump_lines(str(out))))
+    assert doc["labels"] == "label Q1"
+    assert doc["claims"] == {"P31": ["Q5"]}
+
+
+def test_files_to_es(es, files_path, tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    load(
+        files_path,
+        es,
+        files=True,
+        entity_filter=EntityFilter(claim_values={"P31": ["Q3305213"]}),
+        checkpoint=Checkpoint(path, "dump", files_path),
+    )
+
+    assert sorted(es.docs("test"), key=lambda qid: int(qid[1:])) == [
+        f"Q{i}" for i in range(3, 61, 3)
+    ]
+
+    # files read whole are done once every entity in them is acknowledged
+    checkpoint = Checkpoint(path, "dump", files_path, resume=True)
+    assert set(checkpoint.watermarks) == {
+        "a-response.json",
+        "b-response.json",
+        "c-list.json.gz",
+        "d-entities.ndjson",
+    }
+
+
+def test_query_to_sink(tmp_path, monkeypatch):
+    def local_init(self):
+        self.endpoint = wikidata.endpoint
+        self.properties = ["info", "labels", "aliases", "claims", "descriptions"]
+
+    out = tmp_path / "out"
+
+    with SparqlStandIn(
+        [f"Q{i}" for i in range(1, 31)]
+    ) as sparql, WbgetentitiesStandIn() as wikidata:
+        monkeypatch.setattr(wd_entities.get_entities, "__init__", local_init)
+        entities = sparql_to_es.iter_entities_from_query(
+            "SELECT ?item WHERE { ?item wdt:P31 wd:Q5 }",
+            page_size=10,
+            endpoint_url=sparql.endpoint,
+        )
+        load(entities, sink=sinks.NDJSONSink(str(out)))
+
+    assert sorted(qids(out), key=lambda qid: int(qid[1:])) == [
+        f"Q{i}" for i in range(1, 31)
+    ]
+
+
+def test_sink_options(files_path, tmp_path):
+    # checkpoints, incremental updates and new indices need an index
+    with pytest.raises(ValueError):
+        load(
+            files_path,
+            files=True,
+            sink=sinks.NDJSONSink(str(tmp_path / "out")),
+            checkpoint=Checkpoint(str(tmp_path / "checkpoint.json"), "dump", "x"),
+        )
+
+
+def test_parquet_sink(files_path, tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    out = tmp_path / "out"
+    simplifier = EntitySimplifier(["en", "fr"], ["P31", "P569"])
+    load(
+        files_path,
+        files=True,
+        sink=sinks.ParquetSink(
+            str(out), simplifier, row_group_size=7, shard_size=40, batch_size=5
+        ),
+        lang=["en", "fr"],
+        properties=["P31", "P569"],
+    )
+
+    assert sorted(p.name for p in out.iterdir()) == [
+        "part-00000.parquet",
+        "part-00001.parquet",
+    ]
+    assert (
+        pyarrow.parquet.ParquetFile(str(out / "part-00000.parquet")).num_row_groups == 6
+    )
+
+    table = pyarrow.parquet.read_table(str(out))
+    assert table.num_rows == 60
+    assert table.column_names == [
+        "id",
+        "lastrevid",
+        "modified",
+        "labels",
+        "descriptions",
+        "aliases",
+        "claims",
+        "claim_labels",
+    ]
+    assert pyarrow.types.is_dictionary(
+        table.schema.field("claims").type["P31"].type.value_type
+    )
+
+    rows = table.to_pylist()
+    assert [row["id"] for row in rows] == [f"Q{i}" for i in range(1, 61)]
+    assert rows[0]["labels"] == {"en": "label Q1", "fr": None}
+    assert rows[0]["claims"] == {"P31": ["Q5"], "P569": []}
+    assert rows[2]["claims"]["P31"] == ["Q3305213"]
+
+
+@pytest.mark.skipif(sinks.pyarrow is not None, reason="pyarrow is installed")
+def test_parquet_sink_needs_pyarrow(tmp_path):
+    with pytest.raises(ImportError):
+        sinks.ParquetSink(str(tmp_path / "out"), EntitySimplifier("en", ["P31"]))
@@ -0,0 +1,86 @@
+from elastic_wikidata import sparql_helpers, sparql_to_es
+import pytest
+from stand_ins import SparqlStandIn
+
+QUERY = """SELECT ?item WHERE {
+    ?item wdt:P31 wd:Q5.
+}"""
+
+
+@pytest.fixture
+def sparql():
+    with SparqlStandIn([f"Q{i}" for i in range(1, 251)]) as sparql:
+        yield sparql
+
+
+def test_get_select_variable():
+    assert sparql_helpers.get_select_variable(QUERY) == "item"
+    assert sparql_helpers.get_select_variable("select distinct ?human {}") == "human"
+
+    with pytest.raises(ValueError):
+        sparql_helpers.get_select_variable("SELECT * WHERE {}")
+
+
+def test_keyset_query():
+    query = sparql_helpers.keyset_query(
+        QUERY + " ORDER BY ?item", 100, after="http://www.wikidata.org/entity/Q5"
+    )
+
+    assert 'FILTER(STR(?item) > "http://www.wikidata.org/entity/Q5")\n}' in query
+    assert query.count("ORDER BY") == 1
+    assert query.rstrip().endswith("ORDER BY STR(?item)\nLIMIT 100")
+
+    with pytest.raises(ValueError):
+        sparql_helpers.keyset_query(QUERY + " LIMIT 10", 100)
+
+
+def test_slice_query_by_qid():
+    queries = sparql_helpers.slice_query_by_qid(QUERY, 3, max_qid=300)
+
+    assert len(queries) == 3
+    assert ">= 100 &&" in queries[1] and "< 200)" in queries[1]
+    # the last slice has no upper bound
+    assert ">= 200)" in queries[2]
+
+
+@pytest.mark.parametrize("slices", [1, 4])
+def test_get_entities_keyset(sparql, slices):
+    entities = sparql_to_es.get_entities_from_query(
+        QUERY, page_size=30, slices=slices, endpoint_url=sparql.endpoint
+    )
+
+    assert sorted(entities) == sorted(f"Q{i}" for i in range(1, 251))
+    assert not any("OFFSET" in query for query in sparql.queries)
+
+
+def test_get_entities_keyset_slices(sparql, monkeypatch):
+    monkeypatch.setattr(sparql_helpers, "MAX_QID", 200)
+    entities = sparql_to_es.get_entities_from_query(
+        QUERY, page_size=50, slices=2, workers=2, endpoint_url=sparql.endpoint
+    )
+
+    assert len(entities) == 250
+    # Q1-Q99 and Q100-Q250 are paginated separately, in 2 and 4 pages
+    assert len(sparql.queries) == 6
+
+
+def test_get_entities_keyset_limit(sparql):
+    entities = sparql_to_es.get_entities_from_query(
+        QUERY, page_size=30, limit=45, endpoint_url=sparql.endpoint
+    )
+
+    assert len(entities) == 45
+    # the next page of a slice is requested as soon as the previous one arrives
+    assert len(sparql.queries) == 3
+
+
+def test_get_entities_offset(sparql):
+    entities = sparql_to_es.get_entities_from_query(
+        QUERY + " ORDER BY ?item",
+        page_size=100,
+        pagination="offset",
+        endpoint_url=sparql.endpoint,
+    )
+
+    assert len(entities) == 250
+    assert len(sparql.queries) == 3
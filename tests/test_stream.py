@@ -0,0 +1,155 @@
+from elastic_wikidata import stream, wd_entities
+from elastic_wikidata.label_index import build_label_index
+from stand_ins import (
+    ElasticsearchStandIn,
+    EventStreamStandIn,
+    WbgetentitiesStandIn,
+    make_entity,
+    recentchange,
+)
+import json
+import pytest
+
+
+def test_iter_sse_events():
+    lines = [
+        b":comment",
+        b"event: message",
+        b"id: 1",
+        b'data: {"a":',
+        b"data: 1}",
+        b"",
+        b"data: second",
+        b"",
+    ]
+
+    assert list(stream.iter_sse_events(lines)) == [
+        {"event": "message", "id": "1", "data": '{"a":\n1}'},
+        {"event": "message", "id": "1", "data": "second"},
+    ]
+
+
+def test_changed_entity():
+    assert stream.changed_entity(recentchange("Q1")) == ("Q1", False)
+    assert stream.changed_entity(recentchange("Property:P31", "new")) == ("P31", False)
+    assert stream.changed_entity(
+        recentchange("Q1", "log", log_type="delete", log_action="delete")
+    ) == ("Q1", True)
+    assert stream.changed_entity(recentchange("Q1", "categorize")) is None
+    assert stream.changed_entity(recentchange("Q1", wiki="enwiki")) is None
+    assert stream.changed_entity(dict(recentchange("Q1"), namespace=1)) is None
+
+
+@pytest.fixture
+def wikidata(monkeypatch):
+    with WbgetentitiesStandIn() as server:
+
+        def __init__(self):
+            self.endpoint = server.endpoint
+            self.properties = ["info", "labels", "aliases", "claims", "descriptions"]
+
+        monkeypatch.setattr(wd_entities.get_entities, "__init__", __init__)
+        yield server
+
+
+def test_stream_updates(wikidata):
+    events = [
+        recentchange("Q1"),
+        recentchange("Q2"),
+        recentchange("Q1"),
+        # not in the index
+        recentchange("Q100"),
+        recentchange("Q3", "log", log_type="delete", log_action="delete"),
+        recentchange("Q1", wiki="commonswiki"),
+    ]
+
+    with ElasticsearchStandIn() as es, EventStreamStandIn(events) as eventstream:
+        es.create_index("test")
+        for i in range(1, 5):
+            es.docs("test")[f"Q{i}"] = {
+                "id": f"Q{i}",
+                "labels": "old",
+                "embedding": [i],
+            }
+
+        updates = stream.streamUpdates(
+            es_credentials={
+                "ELASTICSEARCH_CLUSTER": es.url,
+                "ELASTICSEARCH_USER": "user",
+                "ELASTICSEARCH_PASSWORD": "password",
+            },
+            index_name="test",
+            url=eventstream.url,
+            window=0.2,
+            reconnect=False,
+        )
+        updates.start_elasticsearch()
+        updates.run()
+
+        docs = es.docs("test")
+
+    # Q1 and Q2 are fetched once, in a single request
+    assert [params["ids"] for params in wikidata.requests] == [["Q1|Q2"]]
+    assert sorted(docs.keys()) == ["Q1", "Q2", "Q4"]
+    assert docs["Q1"]["labels"] == "label Q1"
+    # documents are replaced, so nothing removed from the entity is left behind
+    assert "embedding" not in docs["Q1"]
+    assert docs["Q4"]["labels"] == "old"
+
+
+@pytest.mark.parametrize("enrich_labels", ["api", "dump"])
+def test_stream_updates_enrich_labels(wikidata, tmp_path, enrich_labels):
+    kwargs = {"enrich_labels": enrich_labels}
+    label = "label Q5"
+    if enrich_labels == "dump":
+        label = "human"
+        entity = make_entity("Q5")
+        entity["labels"]["en"]["value"] = label
+        dump_path = tmp_path / "dump.ndjson"
+        dump_path.write_text(json.dumps(entity) + "\n")
+        kwargs["label_index"] = str(tmp_path / "labels.idx")
+        build_label_index(str(dump_path), kwargs["label_index"], "en")
+
+    with ElasticsearchStandIn() as es, EventStreamStandIn(
+        [recentchange("Q1")]
+    ) as eventstream:
+        es.create_index("test")
+        es.docs("test")["Q1"] = {"id": "Q1"}
+
+        updates = stream.streamUpdates(
+            es_credentials={
+                "ELASTICSEARCH_CLUSTER": es.url,
+                "ELASTICSEARCH_USER": "user",
+                "ELASTICSEARCH_PASSWORD": "password",
+            },
+            index_name="test",
+            url=eventstream.url,
+            window=0.2,
+            reconnect=False,
+            **kwargs,
+        )
+        updates.start_elasticsearch()
+        updates.run()
+
+        docs = es.docs("test")
+
+    # updated documents have the labels of their claims, like the rest of the index
+    assert docs["Q1"]["claim_labels"] == {"P31": [label]}
+
+
+def test_stream_updates_need_a_label_index():
+    # there's no dump to read labels from
+    with pytest.raises(ValueError):
+        stream.streamUpdates(es_credentials={}, index_name="test", enrich_labels="dump")
+
+
+def test_batches_are_bounded():
+    updates = stream.streamUpdates.__new__(stream.streamUpdates)
+    updates.window = 10
+    updates.max_batch_size = 2
+    updates.changes = stream.queue.Queue()
+
+    for change in [("Q1", False), ("Q2", False), ("Q1", True), None]:
+        updates.changes.put(change)
+
+    assert list(updates.batches()) == [{"Q1": False, "Q2": False}, {"Q1": True}]
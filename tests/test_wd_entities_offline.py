@@ -0,0 +1,429 @@
+from elastic_wikidata import wd_entities
+from elastic_wikidata.entity_cache import EntityCache
+from stand_ins import WbgetentitiesStandIn
+import pytest
+import requests
+import threading
+import time
+
+
+@pytest.fixture
+def stand_in():
+    with WbgetentitiesStandIn() as server:
+        yield server
+
+
+@pytest.fixture
+def ge(stand_in):
+    class local_entities(wd_entities.get_entities):
+        def __init__(self):
+            super().__init__()
+            self.endpoint = stand_in.endpoint
+
+    return local_entities
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_result_generator(ge, stand_in, workers):
+    qids = [f"Q{i}" for i in range(1, 501)]
+
+    pages = list(ge.result_generator(qids, page_limit=50, timeout=5, workers=workers))
+
+    assert len(pages) == 10
+    assert sorted(doc["id"] for page in pages for doc in page) == sorted(qids)
+    assert all(
+        params["maxlag"] == [str(wd_entities.MAXLAG)] for params in stand_in.requests
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_result_generator_backs_off(ge, stand_in, workers):
+    stand_in.responses = [429, "maxlag", 429]
+    qids = [f"Q{i}" for i in range(1, 201)]
+
+    pages = list(ge.result_generator(qids, page_limit=50, timeout=5, workers=workers))
+
+    assert sorted(doc["id"] for page in pages for doc in page) == sorted(qids)
+    assert len(stand_in.requests) == 4 + 3
+
+
+def test_result_generator_retries_server_errors(ge, stand_in):
+    stand_in.responses = [502, 500, 504]
+    qids = [f"Q{i}" for i in range(1, 51)]
+
+    pages = list(ge.result_generator(qids, page_limit=50, timeout=5))
+
+    assert sorted(doc["id"] for page in pages for doc in page) == sorted(qids)
+    assert len(stand_in.requests) == 4
+
+
+def test_result_generator_raises_http_errors(ge, stand_in):
+    stand_in.responses = [403]
+
+    # the status is reported rather than a failure to parse the error page
+    with pytest.raises(requests.HTTPError, match="403"):
+        list(ge.result_generator(["Q1"], page_limit=50, timeout=5))
+
+
+def test_get_labels(ge):
+    assert ge().get_labels(["Q1", "Q2", "Q1"], timeout=5, workers=2) == {
+        "Q1": "label Q1",
+        "Q2": "label Q2",
+    }
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_result_generator_cache(ge, stand_in, tmp_path, workers):
+    cache = EntityCache(str(tmp_path))
+    qids = [f"Q{i}" for i in range(1, 121)]
+
+    pages = list(
+        ge.result_generator(qids[:60], page_limit=50, workers=workers, cache=cache)
+    )
+    assert len(stand_in.requests) == 2
+
+    # only the 60 uncached entities are requested, in full pages
+    pages = list(ge.result_generator(qids, page_limit=50, workers=workers, cache=cache))
+    assert sorted(
+        len(params["ids"][0].split("|")) for params in stand_in.requests[2:]
+    ) == [10, 50]
+    assert sorted(doc["id"] for page in pages for doc in page) == sorted(qids)
+
+    # labels come from the same cache
+    assert ge().get_labels(qids, cache=cache) == {qid: f"label {qid}" for qid in qids}
+    assert len(stand_in.requests) == 4
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_result_generator_reads_iterable_lazily(ge, stand_in, workers):
+    read = []
+
+    def qids():
+        for i in range(1, 501):
+            read.append(i)
+            yield f"Q{i}"
+
+    pages = ge.result_generator(qids(), page_limit=50, timeout=5, workers=workers)
+    first = next(pages)
+
+    assert len(first) == 50
+    # only the QIDs for the pages in flight have been read
+    assert len(read) <= 50 * (workers + 1)
+    assert sum(len(page) for page in pages) == 450
+
+
+def test_result_generator_posts_long_requests(ge, stand_in):
+    qids = [f"Q{i}" for i in range(100_000_001, 100_000_601)]
+
+    pages = list(ge.result_generator(qids, page_limit=500, timeout=5))
+
+    assert [len(page) for page in pages] == [500, 100]
+    assert [params.get("method") for params in stand_in.requests] == [["POST"], None]
+    assert stand_in.requests[0]["maxlag"] == [str(wd_entities.MAXLAG)]
+
+
+def test_page_sizer():
+    assert wd_entities.PageSizer(500).size() == 500
+
+    # pages of large entities shrink towards the target response size
+    sizer = wd_entities.PageSizer(500, target_bytes=100_000, smoothing=1)
+    assert sizer.size() == 50
+    sizer.observe(50, 1_000_000, 1)
+    assert sizer.size() == 5
+
+    # and pages of small ones grow, at most doubling each time
+    sizer.observe(5, 1000, 1)
+    assert sizer.size() == 10
+    for _ in range(10):
+        sizer.observe(sizer.size(), 1000, 1)
+    assert sizer.size() == 500
+
+    sizer = wd_entities.PageSizer(50, target_seconds=1, smoothing=1)
+    sizer.observe(50, 1000, 10)
+    assert sizer.size() == 5
+
+
+def test_result_generator_adaptive(ge, stand_in):
+    qids = [f"Q{i}" for i in range(1, 201)]
+    sizer = wd_entities.PageSizer(50, target_bytes=10_000, smoothing=1)
+
+    pages = list(ge.result_generator(qids, timeout=5, page_sizer=sizer))
+
+    sizes = [len(params["ids"][0].split("|")) for params in stand_in.requests]
+    assert sizes[0] == 50
+    assert set(sizes[1:-1]) == {sizes[1]}
+    assert 10 < sizes[1] < 30
+    assert sorted(doc["id"] for page in pages for doc in page) == sorted(qids)
+
+
+def test_result_generator_coalesces_requests(ge, stand_in):
+    stand_in.delay = 0.3
+    qids = [f"Q{i}" for i in range(1, 51)]
+    results = {}
+
+    def fetch(name, qids, **kwargs):
+        pages = ge.result_generator(qids, timeout=5, **kwargs)
+        results[name] = sorted(doc["id"] for page in pages for doc in page)
+
+    first = threading.Thread(target=fetch, args=("entities", qids))
+    first.start()
+    while not stand_in.requests:
+        time.sleep(0.01)
+
+    # labels of entities which are already being fetched in full are taken from that request
+    fetch("labels", qids[25:] + ["Q51"], props=["labels"])
+    first.join()
+
+    assert results["entities"] == sorted(qids)
+    assert results["labels"] == sorted(qids[25:] + ["Q51"])
+    assert [params["ids"][0] for params in stand_in.requests[1:]] == ["Q51"]
+
+
+def snak(datavalue: dict = None, snaktype: str = "value") -> dict:
+    mainsnak = {"snaktype": snaktype, "property": "P1"}
+    if datavalue is not None:
+        mainsnak["datavalue"] = datavalue
+
+    return {"mainsnak": mainsnak, "type": "statement", "rank": "normal"}
+
+
+def test_entity_simplifier():
+    doc = {
+        "type": "item",
+        "id": "Q2",
+        "redirects": {"from": "Q1", "to": "Q2"},
+        "lastrevid": 10,
+        "labels": {"en": {"language": "en", "value": "label"}},
+        "descriptions": [],
+        "aliases": {"fr": [{"language": "fr", "value": "alias"}]},
+        "claims": {
+            "P31": [
+                snak(
+                    {
+                        "value": {"entity-type": "item", "numeric-id": 5, "id": "Q5"},
+                        "type": "wikibase-entityid",
+                    }
+                ),
+                snak(snaktype="novalue"),
+                snak(snaktype="somevalue"),
+            ],
+            "P569": [
+                snak({"value": {"time": "+1900-01-01T00:00:00Z"}, "type": "time"})
+            ],
+            "P1476": [
+                snak(
+                    {
+                        "value": {"text": "title", "language": "en"},
+                        "type": "monolingualtext",
+                    }
+                )
+            ],
+            "P1082": [snak({"value": {"amount": "+100"}, "type": "quantity"})],
+            "P625": [snak({"value": {"latitude": 1, "longitude": 2}, "type": "globe"})],
+            "P18": [snak({"value": "image.jpg", "type": "string"})],
+            "P2": [snak(snaktype="novalue")],
+        },
+    }
+    properties = ["P31", "P569", "P1476", "P1082", "P625", "P18", "P2", "P3", "P31"]
+    expected = {
+        "id": "Q1",
+        "lastrevid": 10,
+        "labels": "label",
+        "aliases": [],
+        "claims": {
+            "P31": ["Q5"],
+            "P569": ["+1900-01-01T00:00:00Z"],
+            "P1476": ["title"],
+            "P1082": ["+100"],
+            "P625": [{"latitude": 1, "longitude": 2}],
+            "P18": ["image.jpg"],
+            "P2": [],
+        },
+    }
+
+    simplifier = wd_entities.EntitySimplifier("en", properties)
+    assert simplifier.simplify(doc) == expected
+    assert simplifier.simplify_batch([doc, doc]) == [expected, expected]
+    assert wd_entities.EntitySimplifier("en", properties, True)(doc)["id"] == "Q2"
+
+    assert wd_entities.simplify_wbgetentities_result(doc, "en", properties) == expected
+    assert wd_entities.simplify_wbgetentities_result([doc], "en", properties) == [
+        expected
+    ]
+
+    # entities with no labels, descriptions, aliases or claims
+    assert simplifier.simplify(
+        {"id": "Q3", "labels": [], "aliases": [], "claims": []}
+    ) == {"id": "Q3", "aliases": [], "claims": {}}
+
+
+def statement(qid: str, rank: str = "normal", **kwargs) -> dict:
+    return dict(
+        snak({"value": {"id": qid}, "type": "wikibase-entityid"}), rank=rank, **kwargs
+    )
+
+
+def test_entity_simplifier_ranks_and_qualifiers():
+    start = snak({"value": {"time": "+2000-01-01T00:00:00Z"}, "type": "time"})[
+        "mainsnak"
+    ]
+    doc = {
+        "id": "Q1",
+        "claims": {
+            "P31": [statement("Q5", "deprecated"), statement("Q6"), statement("Q7")],
+            "P39": [
+                statement(
+                    "Q11696",
+                    "preferred",
+                    qualifiers={"P580": [start], "P1545": [start]},
+                    references=[{"snaks": {"P248": [statement("Q36578")["mainsnak"]]}}],
+                ),
+                statement("Q30185"),
+            ],
+        },
+    }
+
+    def claims(**kwargs) -> dict:
+        return wd_entities.EntitySimplifier("en", ["P31", "P39"], **kwargs)(doc)[
+            "claims"
+        ]
+
+    assert claims() == {"P31": ["Q5", "Q6", "Q7"], "P39": ["Q11696", "Q30185"]}
+    assert claims(ranks="non-deprecated") == {
+        "P31": ["Q6", "Q7"],
+        "P39": ["Q11696", "Q30185"],
+    }
+    assert claims(ranks="best") == {"P31": ["Q6", "Q7"], "P39": ["Q11696"]}
+
+    rich = claims(ranks="best", qualifiers=["P580", "P582"], references=["P248"])
+    assert rich["P31"][0] == {
+        "value": "Q6",
+        "rank": "normal",
+        "qualifiers": {},
+        "references": [],
+    }
+    assert rich["P39"] == [
+        {
+            "value": "Q11696",
+            "rank": "preferred",
+            "qualifiers": {"P580": ["+2000-01-01T00:00:00Z"]},
+            "references": [{"P248": ["Q36578"]}],
+        }
+    ]
+    assert claims(rich_claims=True)["P31"][0] == {"value": "Q5", "rank": "deprecated"}
+
+    with pytest.raises(ValueError):
+        wd_entities.EntitySimplifier("en", ["P31"], ranks="preferred")
+
+
+def test_entity_simplifier_mappings():
+    assert wd_entities.EntitySimplifier("en", ["P31"]).mappings() == {
+        "properties": {
+            "labels": {"type": "text", "copy_to": "labels_aliases"},
+            "aliases": {"type": "text", "copy_to": "labels_aliases"},
+            "labels_aliases": {"type": "text", "store": "true"},
+        }
+    }
+
+    mappings = wd_entities.EntitySimplifier(
+        "en", ["P31", "P39"], qualifiers=["P580"]
+    ).mappings()["properties"]
+    assert mappings["claims"]["properties"]["P39"] == {
+        "type": "nested",
+        "properties": {"rank": {"type": "keyword"}, "qualifiers": {"type": "object"}},
+    }
+
+
+def multilingual_entity() -> dict:
+    def values(**by_lang) -> dict:
+        return {lang: {"language": lang, "value": v} for lang, v in by_lang.items()}
+
+    return {
+        "id": "Q1",
+        "labels": values(en="universe", fr="univers", de="Universum"),
+        "descriptions": values(en="totality of space", de="Gesamtheit"),
+        "aliases": {"fr": [{"language": "fr", "value": "cosmos"}]},
+        "claims": {},
+    }
+
+
+def test_entity_simplifier_languages():
+    doc = multilingual_entity()
+
+    simplifier = wd_entities.EntitySimplifier(
+        ["en", "fr", "de-ch", "ja"], [], fallback=["en"]
+    )
+    assert simplifier(doc) == {
+        "id": "Q1",
+        "labels": {
+            "en": "universe",
+            "fr": "univers",
+            "de-ch": "Universum",
+            "ja": "universe",
+        },
+        "descriptions": {
+            "en": "totality of space",
+            "fr": "totality of space",
+            "de-ch": "Gesamtheit",
+            "ja": "totality of space",
+        },
+        "aliases": {"fr": ["cosmos"]},
+        "claims": {},
+    }
+
+    # without a fallback only variants fall back, to their base language
+    assert wd_entities.EntitySimplifier(["ja", "de-ch"], [])(doc)["labels"] == {
+        "de-ch": "Universum"
+    }
+
+    everything = wd_entities.EntitySimplifier(wd_entities.ALL_LANGUAGES, [])(doc)
+    assert everything["labels"] == {
+        "en": "universe",
+        "fr": "univers",
+        "de": "Universum",
+    }
+    assert everything["aliases"] == {"fr": ["cosmos"]}
+
+    # a single language keeps the original format
+    assert (
+        wd_entities.simplify_wbgetentities_result(doc, "fr", [])["labels"] == "univers"
+    )
+    assert wd_entities.simplify_wbgetentities_result(doc, ["fr"], [])["labels"] == {
+        "fr": "univers"
+    }
+
+
+def test_entity_simplifier_language_mappings():
+    properties = wd_entities.EntitySimplifier(["en", "de-ch", "xx"], []).mappings()[
+        "properties"
+    ]
+    labels = properties["labels"]["properties"]
+    assert labels["en"] == {
+        "type": "text",
+        "analyzer": "english",
+        "copy_to": "labels_aliases",
+    }
+    assert labels["de-ch"]["analyzer"] == "german"
+    assert labels["xx"]["analyzer"] == "standard"
+    assert "copy_to" not in properties["descriptions"]["properties"]["en"]
+
+    mappings = wd_entities.EntitySimplifier(wd_entities.ALL_LANGUAGES, []).mappings()
+    templates = {
+        name: template
+        for t in mappings["dynamic_templates"]
+        for name, template in t.items()
+    }
+    assert templates["aliases_fr"]["mapping"]["analyzer"] == "french"
+    assert templates["labels"]["path_match"] == "labels.*"
+    # the catch-all template for each field comes after the language-specific ones
+    assert list(templates).index("labels") > list(templates).index("labels_fr")
+
+
+@pytest.mark.parametrize(
+    "lang,languages",
+    [("en", ["en"]), (["en", "fr"], ["en|fr"]), (wd_entities.ALL_LANGUAGES, None)],
+)
+def test_result_generator_languages(ge, stand_in, lang, languages):
+    list(ge.result_generator(["Q1"], lang=lang, timeout=5))
+
+    assert stand_in.requests[0].get("languages") == languages